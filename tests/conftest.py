@@ -0,0 +1,80 @@
+import collections
+import threading
+from types import SimpleNamespace
+
+import pytest
+from werkzeug.serving import make_server
+
+from webshopper import create_app
+from webshopper.Communicator import Communicator, TokenManager
+from webshopper.db import init_db
+from webshopper.kroger_sim import create_sim_app
+
+
+def reset_process_state():
+    """ Communicator and TokenManager keep per-process state that must not leak between tests """
+    Communicator._http_pid = None
+    Communicator._search_cache = None
+    Communicator._client_token = None
+    TokenManager._latest.clear()
+    TokenManager._active.clear()
+
+
+@pytest.fixture
+def app_factory(tmp_path):
+    """ create_app with a fresh database under tmp_path. Keyword arguments override the config. """
+    def make(**config):
+        test_config: dict = {
+            'TESTING': True,
+            'DATABASE': str(tmp_path / 'webshopper.sqlite'),
+            'KROGER_RATE_LIMIT_DB': str(tmp_path / 'kroger_rate.sqlite'),
+            'TOKEN_PROACTIVE_REFRESH': False,
+        }
+        test_config.update(config)
+        app = create_app(test_config)
+        with app.app_context():
+            init_db()
+        reset_process_state()
+        return app
+    return make
+
+
+@pytest.fixture
+def app(app_factory):
+    return app_factory()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def kroger_sim():
+    """
+        Starts webshopper.kroger_sim on a free port: kroger_sim(**SIM_config) returns a namespace
+        with url (for KROGER_API_BASE), state (the SimState) and calls, a Counter of
+        (<method>, <path>) for every request it received.
+    """
+    servers: list = []
+
+    def start(**config):
+        sim = create_sim_app(config)
+        calls = collections.Counter()
+        lock = threading.Lock()
+        wsgi_app = sim.wsgi_app
+
+        def counting_app(environ, start_response):
+            with lock:
+                calls[(environ['REQUEST_METHOD'], environ['PATH_INFO'])] += 1
+            return wsgi_app(environ, start_response)
+
+        sim.wsgi_app = counting_app
+        server = make_server('127.0.0.1', 0, sim, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return SimpleNamespace(url=f'http://127.0.0.1:{server.server_port}/v1/', state=sim.sim_state, calls=calls)
+
+    yield start
+    for server in servers:
+        server.shutdown()
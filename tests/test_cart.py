@@ -0,0 +1,63 @@
+import time
+
+from flask import session
+
+from webshopper.Communicator import Communicator
+
+
+def add_to_cart(app, sim, items: list):
+    """ Communicator.add_to_cart inside a request whose session holds a valid sim token """
+    tokens: dict = sim.state.issue(1800)
+    with app.test_request_context():
+        session.update({'user_id': 1, 'access_token': tokens['access_token'], 'access_token_timestamp': time.time(),
+                        'refresh_token': tokens['refresh_token'], 'refresh_token_timestamp': time.time()})
+        return Communicator.add_to_cart(items)
+
+
+def test_only_rejected_items_fail(app_factory, kroger_sim):
+    sim = kroger_sim()
+    app = app_factory(KROGER_API_BASE=sim.url, CART_CHUNK_SIZE=5)
+    items: list = [{'upc': f'{i:013d}', 'quantity': 0 if i in (3, 21) else 1} for i in range(23)]
+    ret = add_to_cart(app, sim, items)
+
+    assert ret[0] == 0
+    assert [result['upc'] for result in ret[1]['results']] == [item['upc'] for item in items]
+    assert [result['added'] for result in ret[1]['results']] == [i not in (3, 21) for i in range(23)]
+    assert ret[1]['results'][3]['error'].startswith('400')
+    assert (ret[1]['added'], ret[1]['failed']) == (21, 2)
+    # 5 chunks, then the 5 and 3 items of the two rejected chunks one at a time
+    assert sim.calls[('PUT', '/v1/cart/add')] == 5 + 5 + 3
+
+
+def test_chunks_are_sent_concurrently(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_LATENCY={'cart': 'fixed:200'})
+    app = app_factory(KROGER_API_BASE=sim.url, CART_CHUNK_SIZE=5, KROGER_CART_WORKERS=4)
+    items: list = [{'upc': f'{i:013d}', 'quantity': 1} for i in range(20)]
+    start: float = time.perf_counter()
+    ret = add_to_cart(app, sim, items)
+    elapsed: float = time.perf_counter() - start
+
+    assert (ret[1]['added'], ret[1]['failed']) == (20, 0)
+    assert sim.calls[('PUT', '/v1/cart/add')] == 4
+    assert elapsed < 0.6  # Four 200ms chunks one after another would take 0.8s
+
+
+def test_gateway_errors_are_retried(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_ERROR_RATES={503: 1.0})
+    app = app_factory(KROGER_API_BASE=sim.url, CART_CHUNK_SIZE=5, KROGER_MAX_RETRIES=2, KROGER_BACKOFF_FACTOR=0.01)
+    ret = add_to_cart(app, sim, [{'upc': f'{i:013d}', 'quantity': 1} for i in range(10)])
+
+    assert (ret[1]['added'], ret[1]['failed']) == (0, 10)
+    assert all(result['error'].startswith('503') for result in ret[1]['results'])
+    # Each chunk sent once and retried twice, never split per item
+    assert sim.calls[('PUT', '/v1/cart/add')] == 2 * 3
+
+
+def test_server_errors_are_not_retried(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_ERROR_RATES={500: 1.0})
+    app = app_factory(KROGER_API_BASE=sim.url, CART_CHUNK_SIZE=5, KROGER_BACKOFF_FACTOR=0.01)
+    ret = add_to_cart(app, sim, [{'upc': f'{i:013d}', 'quantity': 1} for i in range(10)])
+
+    assert (ret[1]['added'], ret[1]['failed']) == (0, 10)
+    assert all(result['error'].startswith('500') for result in ret[1]['results'])
+    assert sim.calls[('PUT', '/v1/cart/add')] == 2
@@ -0,0 +1,30 @@
+from webshopper.Communicator import Communicator
+
+
+def retrying_app(app_factory, sim):
+    return app_factory(KROGER_API_BASE=sim.url, KROGER_MAX_RETRIES=2, KROGER_BACKOFF_FACTOR=0)
+
+
+def test_get_is_retried_on_5xx(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_ERROR_RATES={503: 1.0})
+    with retrying_app(app_factory, sim).app_context():
+        ret = Communicator._request('GET', sim.url + 'products')
+    assert ret[1]['response'].status_code == 503
+    assert sim.calls[('GET', '/v1/products')] == 3
+
+
+def test_put_is_not_retried_on_5xx(app_factory, kroger_sim):
+    # Kroger may have added the items before failing, so a retry could add them twice
+    sim = kroger_sim(SIM_ERROR_RATES={503: 1.0})
+    with retrying_app(app_factory, sim).app_context():
+        ret = Communicator._request('PUT', sim.url + 'cart/add', json={'items': []})
+    assert ret[1]['response'].status_code == 503
+    assert sim.calls[('PUT', '/v1/cart/add')] == 1
+
+
+def test_post_is_retried_on_429(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_ERROR_RATES={429: 1.0}, SIM_RETRY_AFTER=0)
+    with retrying_app(app_factory, sim).app_context():
+        ret = Communicator._request('POST', sim.url + 'connect/oauth2/token', data={'grant_type': 'refresh_token'})
+    assert ret[1]['response'].status_code == 429
+    assert sim.calls[('POST', '/v1/connect/oauth2/token')] == 3
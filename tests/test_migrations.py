@@ -0,0 +1,88 @@
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from webshopper import create_app
+from webshopper.db import DBInterface, migrate_db, pending_migrations
+from webshopper.units import UnitCache
+
+# Committed database from before reference_version and the migrations existed
+LEGACY_DATABASE = os.path.join(os.path.dirname(__file__), '..', 'instance', 'webshopper.sqlite')
+
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    database: str = str(tmp_path / 'legacy.sqlite')
+    shutil.copyfile(LEGACY_DATABASE, database)
+    return database
+
+
+def legacy_app(database: str, **config):
+    return create_app(dict({'TESTING': True, 'DATABASE': database,
+                            'KROGER_RATE_LIMIT_DB': database + '.rate'}, **config))
+
+
+def test_existing_database_is_migrated_on_start(legacy_database):
+    app = legacy_app(legacy_database)
+    with app.app_context():
+        db = DBInterface.get_db()
+        assert db.execute('PRAGMA user_version').fetchone()[0] == pending_migrations(0)[-1][0]
+        # The data survived and UnitCache works without init-db
+        assert db.execute('SELECT COUNT(*) FROM units').fetchone()[0] > 0
+        ret = UnitCache.load()
+        assert ret[0] == 0
+        assert UnitCache.base_factor('gram') == 1
+
+
+def test_migrate_on_start_can_be_turned_off(legacy_database):
+    app = legacy_app(legacy_database, DB_MIGRATE_ON_START=False)
+    with app.app_context():
+        assert DBInterface.get_db().execute('PRAGMA user_version').fetchone()[0] == 0
+
+
+def test_concurrent_workers_migrate_once(legacy_database):
+    app = legacy_app(legacy_database, DB_MIGRATE_ON_START=False)
+    applied: list = []
+    errors: list = []
+
+    def worker():
+        with app.app_context():
+            try:
+                applied.extend(migrate_db())
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with app.app_context():
+        assert sorted(applied) == [version for version, _ in pending_migrations(0)]
+        assert DBInterface.get_db().execute('SELECT COUNT(*) FROM reference_version').fetchone()[0] == 1
+
+
+def test_location_cache_works_on_existing_database(legacy_database, kroger_sim, caplog):
+    sim = kroger_sim()
+    app = legacy_app(legacy_database, KROGER_API_BASE=sim.url)
+    tokens: dict = sim.state.issue(1800)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update({'user_id': 1, 'access_token': tokens['access_token'], 'access_token_timestamp': time.time(),
+                     'refresh_token': tokens['refresh_token'], 'refresh_token_timestamp': time.time()})
+
+    first = client.post('/location/search_loc', json={'zipcode': '99201'})
+    second = client.post('/location/search_loc', json={'zipcode': '99201'})
+
+    assert first.status_code == second.status_code == 200
+    assert first.get_json() == second.get_json()
+    assert sim.calls[('GET', '/v1/locations')] == 1
+    assert 'location cache' not in caplog.text
+    result = app.test_cli_runner().invoke(args=['location-cache', 'purge'])
+    assert result.exit_code == 0, result.output
+    assert 'Purged 1 zipcodes' in result.output
@@ -0,0 +1,107 @@
+import random
+from math import floor
+
+from webshopper.quantities import containers_needed, encode_ingredients, tally_products
+from webshopper.recipes import ROUNDING_THRESHOLD
+from webshopper.units import UnitCache
+
+
+# Ports of the per-ingredient loops that quantities.py replaced, kept as the reference results
+
+def loop_tally(recipes: list) -> dict:
+    tally: dict = {}
+    for recipe in recipes:
+        ingredients: dict = recipe['ingredients']
+        for ing_id in ingredients:
+            ingredient = ingredients[ing_id]
+            productId = ingredient['productId']
+            unit = ingredient['ingredient_unit']
+            unit_type = UnitCache.unit_type(unit)
+            base_unit: str = 'gram' if unit_type == 'weight' else 'ml'
+            normalized_quantity = UnitCache.factor(unit, base_unit) * float(ingredient['ingredient_quantity'])
+            if productId in tally:
+                tally[productId] += normalized_quantity
+            else:
+                tally[productId] = normalized_quantity
+    return tally
+
+
+def loop_containers(order_tally: dict, products_dict: dict) -> tuple:
+    final_tally: dict = {}
+    rounded_values: dict = {}
+    for prod_id in order_tally:
+        final_tally[prod_id] = order_tally[prod_id] / products_dict[prod_id]['total_container_quantity']
+        floored: int = floor(final_tally[prod_id])
+        diff: float = final_tally[prod_id] - floored
+        if diff > ROUNDING_THRESHOLD:
+            rounded_values[prod_id] = {
+                'product_description': products_dict[prod_id]['description'],
+                'original_value': final_tally[prod_id],
+            }
+            final_tally[prod_id] = floor(final_tally[prod_id] + 1)
+            rounded_values[prod_id]['rounded_value'] = final_tally[prod_id]
+    return final_tally, rounded_values
+
+
+def engine(recipes: list, products_dict: dict) -> tuple:
+    ret = encode_ingredients(recipes)
+    assert ret[0] == 0
+    quantities = tally_products(ret[1])
+    order_tally: dict = dict(zip(ret[1]['product_ids'], quantities.tolist()))
+    ret = containers_needed(ret[1]['product_ids'], quantities, products_dict, ROUNDING_THRESHOLD)
+    assert ret[0] == 0
+    return order_tally, ret[1]['final_tally'], ret[1]['rounded_values']
+
+
+def assert_same(recipes: list, products_dict: dict):
+    order_tally, final_tally, rounded_values = engine(recipes, products_dict)
+    expected_tally: dict = loop_tally(recipes)
+    expected_final, expected_rounded = loop_containers(expected_tally, products_dict)
+    # Same values, same key order and the same int/float types
+    assert list(order_tally.items()) == list(expected_tally.items())
+    assert list(final_tally.items()) == list(expected_final.items())
+    assert [type(value) for value in final_tally.values()] == [type(value) for value in expected_final.values()]
+    assert list(rounded_values.items()) == list(expected_rounded.items())
+
+
+def recipe(*ingredients) -> dict:
+    return {'ingredients': {str(i): {'productId': productId, 'ingredient_unit': unit, 'ingredient_quantity': quantity}
+                            for i, (productId, unit, quantity) in enumerate(ingredients)}}
+
+
+def product(container: float) -> dict:
+    return {'total_container_quantity': container, 'description': f'{container} container'}
+
+
+def test_rounding_threshold_boundary(app):
+    products_dict: dict = {'above': product(100), 'below': product(100), 'at': product(100),
+                           'whole': product(100), 'shared': product(250)}
+    recipes: list = [
+        recipe(('above', 'gram', 105.01), ('below', 'gram', 104.99), ('at', 'gram', 105),
+               ('whole', 'gram', 300), ('shared', 'cup', 1.5)),
+        recipe(('shared', 'tbsp', 3), ('shared', 'floz', 2)),
+        recipe(('shared', 'tsp', 7)),
+    ]
+    with app.app_context():
+        assert UnitCache.load()[0] == 0
+        assert_same(recipes, products_dict)
+        _, final_tally, rounded_values = engine(recipes, products_dict)
+    assert final_tally['above'] == 2 and 'above' in rounded_values
+    assert final_tally['below'] == 104.99 / 100 and 'below' not in rounded_values
+    assert final_tally['whole'] == 3.0 and type(final_tally['whole']) is float
+
+
+def test_matches_loops_on_random_meal_plans(app):
+    rng = random.Random(8)
+    with app.app_context():
+        assert UnitCache.load()[0] == 0
+        units: list = sorted(UnitCache._tables['unit_types'])
+        for _ in range(200):
+            product_ids: list = [f'{rng.randrange(10 ** 12):013d}' for _ in range(rng.randint(1, 8))]
+            products_dict: dict = {productId: product(rng.choice([1, 28.35, 100, 236.6, 453.6, 946.4]))
+                                   for productId in product_ids}
+            recipes: list = [recipe(*[(rng.choice(product_ids), rng.choice(units),
+                                       rng.choice([rng.randint(1, 4), round(rng.uniform(0.1, 20), 2)]))
+                                      for _ in range(rng.randint(1, 12))])
+                             for _ in range(rng.randint(1, 6))]
+            assert_same(recipes, products_dict)
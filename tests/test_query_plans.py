@@ -0,0 +1,13 @@
+from webshopper.db import DBInterface, check_query_plans, pending_migrations
+
+
+def test_every_query_uses_an_index():
+    # Runs every DBInterface method under EXPLAIN QUERY PLAN and checks foreign key indexes
+    assert check_query_plans() == []
+
+
+def test_init_db_applies_every_migration(app):
+    with app.app_context():
+        version: int = DBInterface.get_db().execute('PRAGMA user_version').fetchone()[0]
+        assert version == pending_migrations(0)[-1][0]
+        assert pending_migrations(version) == []
@@ -0,0 +1,61 @@
+import multiprocessing
+import time
+
+import pytest
+
+from webshopper import create_app
+from webshopper.Communicator import Communicator
+from webshopper.ratelimit import RateLimiter
+
+
+def test_bucket_is_shared_across_processes(tmp_path):
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        pytest.skip('needs fork')
+    config: dict = {'TESTING': True, 'DATABASE': str(tmp_path / 'webshopper.sqlite'),
+                    'KROGER_RATE_LIMIT_DB': str(tmp_path / 'kroger_rate.sqlite'),
+                    'KROGER_RATE_LIMIT': 50, 'KROGER_RATE_BURST': 5, 'KROGER_RATE_MAX_WAIT': 10}
+    queue = context.Queue()
+
+    def worker():
+        with create_app(config).app_context():
+            queue.put([RateLimiter.acquire()[0] for _ in range(10)])
+
+    start: float = time.time()
+    processes = [context.Process(target=worker) for _ in range(3)]
+    for process in processes:
+        process.start()
+    results: list = [queue.get(timeout=30) for _ in processes]
+    elapsed: float = time.time() - start
+    for process in processes:
+        process.join()
+
+    assert results == [[0] * 10] * 3
+    # 30 calls with 5 in the burst: the other 25 go out at 50 per second between them
+    assert elapsed >= 25 / 50 * 0.9
+
+
+def test_wait_past_deadline_is_refused(app_factory):
+    app = app_factory(KROGER_RATE_LIMIT=1, KROGER_RATE_BURST=1, KROGER_RATE_MAX_WAIT=0.5)
+    with app.app_context():
+        assert RateLimiter.acquire()[0] == 0
+        start: float = time.perf_counter()
+        ret = RateLimiter.acquire()
+        assert ret[0] != 0
+        assert time.perf_counter() - start < 0.5  # Refused without queueing
+        # The refused call reserved nothing
+        assert RateLimiter.budget()[1]['tokens'] > -0.5
+
+
+def test_retries_on_429_take_tokens(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_ERROR_RATES={429: 1.0}, SIM_RETRY_AFTER=0)
+    app = app_factory(KROGER_API_BASE=sim.url, KROGER_MAX_RETRIES=2, KROGER_BACKOFF_FACTOR=0,
+                      KROGER_RATE_LIMIT=0.01, KROGER_RATE_BURST=10)
+    with app.app_context():
+        ret = Communicator._request('GET', sim.url + 'products')
+        tokens: float = RateLimiter.budget()[1]['tokens']
+
+    assert ret[1]['response'].status_code == 429
+    assert sim.calls[('GET', '/v1/products')] == 3
+    assert 6.9 < tokens < 7.1  # One token per attempt, none left to urllib3
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from webshopper.Communicator import TokenManager
+from webshopper.db import DBInterface
+
+
+def user_with_expired_access_token(app, sim) -> int:
+    tokens: dict = sim.state.issue(1800)
+    with app.app_context():
+        DBInterface.new_user('refresher', 'password')
+        user_id: int = DBInterface.get_user('refresher', 'password')[1]['user']['user_id']
+        DBInterface.deposit_tokens(user_id, {'access_token': tokens['access_token'],
+                                             'access_token_timestamp': time.time() - 3600,
+                                             'refresh_token': tokens['refresh_token'],
+                                             'refresh_token_timestamp': time.time()})
+    return user_id
+
+
+def test_concurrent_refreshes_make_one_kroger_call(app_factory, kroger_sim):
+    sim = kroger_sim(SIM_LATENCY={'token': 'fixed:100'})
+    app = app_factory(KROGER_API_BASE=sim.url)
+    user_id: int = user_with_expired_access_token(app, sim)
+    barrier = threading.Barrier(8)
+    results: list = []
+
+    def refresh():
+        with app.app_context():
+            barrier.wait()
+            results.append(TokenManager.refresh(user_id))
+
+    threads = [threading.Thread(target=refresh) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Refresh tokens are single use, so a second exchange would have failed with invalid_grant
+    assert [ret[0] for ret in results] == [0] * 8
+    assert len({ret[1]['access_token'] for ret in results}) == 1
+    assert sim.calls[('POST', '/v1/connect/oauth2/token')] == 1
+    with app.app_context():
+        stored: dict = DBInterface.get_tokens(user_id)[1]['tokens']
+    assert stored['access_token'] == results[0][1]['access_token']
+
+
+def test_refresh_picks_up_tokens_another_worker_stored(app_factory, kroger_sim):
+    sim = kroger_sim()
+    app = app_factory(KROGER_API_BASE=sim.url)
+    user_id: int = user_with_expired_access_token(app, sim)
+    fresh: dict = sim.state.issue(1800)
+    with app.app_context():
+        DBInterface.deposit_tokens(user_id, {'access_token': fresh['access_token'],
+                                             'access_token_timestamp': time.time(),
+                                             'refresh_token': fresh['refresh_token'],
+                                             'refresh_token_timestamp': time.time()})
+        ret = TokenManager.refresh(user_id)
+    assert ret[1]['access_token'] == fresh['access_token']
+    assert sim.calls[('POST', '/v1/connect/oauth2/token')] == 0
@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+from typing import Tuple
+from webshopper.Communicator import Communicator
+
+from flask import current_app
+
+
+class AsyncCommunicator:
+    """
+        Awaitable interface for Kroger API, for async views and batch jobs.
+
+        Each call runs the matching Communicator method on a bounded thread pool, so it shares
+        the pooled keep-alive session, the search cache and TokenManager with synchronous code.
+        The caller's Flask app/request context is carried into the worker thread, which means
+        session-based calls work from an async view exactly as they do from a sync one.
+
+            results = await asyncio.gather(AsyncCommunicator.search_product('milk', locationId),
+                                           AsyncCommunicator.search_product('eggs', locationId))
+    """
+    _executor: ThreadPoolExecutor = None
+    _executor_pid: int = None
+    _lock: threading.Lock = threading.Lock()
+
+    @staticmethod
+    def _pool() -> ThreadPoolExecutor:
+        """ One executor per worker process, sized by KROGER_ASYNC_WORKERS """
+        pid: int = os.getpid()
+        if AsyncCommunicator._executor is None or AsyncCommunicator._executor_pid != pid:
+            with AsyncCommunicator._lock:
+                if AsyncCommunicator._executor is None or AsyncCommunicator._executor_pid != pid:
+                    AsyncCommunicator._executor = ThreadPoolExecutor(
+                        max_workers=current_app.config['KROGER_ASYNC_WORKERS'],
+                        thread_name_prefix='kroger-async')
+                    AsyncCommunicator._executor_pid = pid
+        return AsyncCommunicator._executor
+
+    @staticmethod
+    async def _run(func: Callable, *args) -> Tuple[int, dict]:
+        loop = asyncio.get_running_loop()
+        context: contextvars.Context = contextvars.copy_context()
+        return await loop.run_in_executor(AsyncCommunicator._pool(),
+                                          functools.partial(context.run, func, *args))
+
+    @staticmethod
+    async def tokens_from_auth(auth_code: str) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.tokens_from_auth, auth_code)
+
+    @staticmethod
+    async def refresh_tokens() -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.refresh_tokens)
+
+    @staticmethod
+    async def search_locations(zipcode: str) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.search_locations, zipcode)
+
+    @staticmethod
+    async def search_product(search_term: str, locationId: str, fulfillment: str = 'csp',
+                             start: int = 1) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.search_product, search_term, locationId, fulfillment,
+                                            start)
+
+    @staticmethod
+    async def add_to_cart(shopping_list: List[dict]) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.add_to_cart, shopping_list)
+
+    # Session-free variants for batch jobs that hold an explicit token
+    # (e.g. from Communicator.client_token or TokenManager.refresh)
+
+    @staticmethod
+    async def client_token() -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator.client_token)
+
+    @staticmethod
+    async def fetch_locations(access_token: str, zipcode: str) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator._fetch_locations, access_token, zipcode)
+
+    @staticmethod
+    async def fetch_products(access_token: str, search_term: str, locationId: str,
+                             fulfillment: str = 'csp', start: int = 1) -> Tuple[int, dict]:
+        return await AsyncCommunicator._run(Communicator._fetch_products, access_token, search_term,
+                                            locationId, fulfillment, start)
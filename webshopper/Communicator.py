@@ -1,17 +1,85 @@
 import os
+import threading
+import time
 import requests
 import sqlite3
 import webshopper.db as db
 import datetime
+import logging
 import urllib.parse
+from typing import Iterator
+from typing import Optional
 from typing import Tuple
 from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InvalidHeader
+from urllib3.util.retry import Retry
+from webshopper.cache import TTLCache
 from webshopper.db import DBInterface
+from webshopper.metrics import Metrics, observe_kroger
+from webshopper.ratelimit import RateLimiter
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
 
+logger = logging.getLogger(__name__)
+
+# Kroger image sizes, smallest first. Precomputed so picking the largest is one dict lookup per size.
+IMAGE_SIZE_RANK: dict = {size: rank for rank, size in enumerate(('thumbnail', 'small', 'medium', 'large', 'xlarge'))}
+
+
+def project_search(payload: dict) -> dict:
+    """
+        Cuts a decoded product search payload down to what products.trim_products and search
+        paging read. Prices, aisle locations, items and the like are dropped, and each image's
+        'sizes' list becomes the url of its largest size: {'perspective': <>, 'url': <>}.
+        The projection is what the search cache holds, so every later hit skips the work too.
+    """
+    data: list = []
+    for product in payload.get('data', ()):
+        images: list = []
+        for image in product.get('images', ()):
+            entry: dict = {'perspective': image['perspective']}
+            url = largest_image_url(image.get('sizes', ()))
+            if url is not None:
+                entry['url'] = url
+            images.append(entry)
+        data.append({'productId': product['productId'],
+                     'upc': product['upc'],
+                     'description': product['description'],
+                     'images': images})
+    return {'data': data, 'meta': {'pagination': payload.get('meta', {}).get('pagination', {})}}
+
+
+def largest_image_url(sizes: list) -> Optional[str]:
+    """ [{'size': 'large', 'url': 'http...'}, ...] -> url of the largest known size, if any """
+    largest: int = -1
+    url = None
+    for size_set in sizes:
+        rank: int = IMAGE_SIZE_RANK.get(size_set.get('size'), -1)
+        if rank > largest:
+            largest = rank
+            url = size_set.get('url')
+    return url
+
+
+class UnappliedRetry(Retry):
+    """ Retry for requests that must not be repeated once Kroger may have acted on them.
+        urllib3 honors Retry-After on 503s as well, but a 503 can come from a handler that
+        already ran, so only 429s count here.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset([429])
+
+
+class StatuslessRetry(Retry):
+    """ Retry for connection and read errors only, used while RateLimiter is on. Retries on a
+        status are made by Communicator._request, which takes a token from the bucket first.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset()
+
 
 class Communicator:
     """
@@ -20,25 +88,149 @@ class Communicator:
     client_id = os.getenv('kroger_app_client_id')
     client_secret = os.getenv('kroger_app_client_secret')
     redirect_uri = os.getenv('kroger_app_redirect_uri')
-    api_base = "https://api.kroger.com/v1/"
+    api_base = "https://api.kroger.com/v1/"  # Default for the KROGER_API_BASE config key
     api_token: str = 'connect/oauth2/token'
     api_authorize: str = 'connect/oauth2/authorize'  # "human" consent w/ redirect endpoint
     token_timeout: float = 1500  # Seconds after which we are considering the token expired. Actually 1800.
     refresh_timeout: float = 60 * 60 * 24 * 7 * 4 * 5  # ~Seconds in a 5 month period (tokens last 6 months)
+    retry_statuses: tuple = (429, 500, 502, 503, 504)
+    # Raised in front of Kroger's handlers, so a cart/add that got one was not applied
+    gateway_statuses: tuple = (502, 503, 504)
+    search_page_size: int = 50  # Kroger's maximum filter.limit
+    # Process-wide pooled HTTP sessions, see _http. Rebuilt after a fork so workers never share sockets.
+    _http_sessions: dict = None  # {'GET': Session, 'other': Session}
+    _http_pid: int = None
+    _http_limited: bool = None  # RateLimiter.enabled() when the sessions were built
+    _http_lock: threading.Lock = threading.Lock()
+    _search_cache: TTLCache = None
+    _executor: ThreadPoolExecutor = None
+    _page_executor: ThreadPoolExecutor = None
+    _cart_executor: ThreadPoolExecutor = None
+    _client_token: str = None
+    _client_token_expiry: float = 0
+
+    @staticmethod
+    def _http(method: str = 'GET') -> requests.Session:
+        """ Returns the shared keep-alive session for the HTTP method, building both on first use.
+            GETs are retried on retry_statuses, read errors and connection errors. A PUT or POST
+            that failed after it was sent may already have been applied (items added to the cart,
+            a single-use refresh token spent), so those are only retried on connection errors and
+            429s, neither of which reaches Kroger's handlers. Pool sizes, retries and backoff come
+            from the app config (see create_app).
+        """
+        pid: int = os.getpid()
+        limited: bool = RateLimiter.enabled()
+        if Communicator._http_pid != pid or Communicator._http_limited != limited:
+            with Communicator._http_lock:
+                if Communicator._http_pid != pid or Communicator._http_limited != limited:
+                    config = current_app.config
+                    # With the rate limiter on, status retries move to _request (see retry_on)
+                    idempotent = (StatuslessRetry if limited else Retry)(
+                        total=config['KROGER_MAX_RETRIES'],
+                        backoff_factor=config['KROGER_BACKOFF_FACTOR'],
+                        status_forcelist=() if limited else Communicator.retry_statuses,
+                        allowed_methods=frozenset(['GET']),
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+                    unapplied = (StatuslessRetry if limited else UnappliedRetry)(
+                        total=config['KROGER_MAX_RETRIES'],
+                        read=False,
+                        other=0,
+                        backoff_factor=config['KROGER_BACKOFF_FACTOR'],
+                        status_forcelist=() if limited else (429,),
+                        allowed_methods=frozenset(['PUT', 'POST']),
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+                    Communicator._http_sessions = {'GET': Communicator._pooled_session(idempotent),
+                                                   'other': Communicator._pooled_session(unapplied)}
+                    Communicator._http_pid = pid
+                    Communicator._http_limited = limited
+        sessions: dict = Communicator._http_sessions
+        return sessions['GET'] if method.upper() == 'GET' else sessions['other']
+
+    @staticmethod
+    def _pooled_session(retry: Retry) -> requests.Session:
+        config = current_app.config
+        adapter = HTTPAdapter(pool_connections=config['KROGER_POOL_CONNECTIONS'],
+                              pool_maxsize=config['KROGER_POOL_MAXSIZE'],
+                              max_retries=retry)
+        http_session = requests.Session()
+        http_session.mount('https://', adapter)
+        http_session.mount('http://', adapter)
+        return http_session
+
+    @staticmethod
+    def _api_base() -> str:
+        """ KROGER_API_BASE from the config, e.g. to point at webshopper.kroger_sim """
+        return current_app.config.get('KROGER_API_BASE', Communicator.api_base)
+
+    @staticmethod
+    def _request(method: str, target_url: str, **kwargs) -> Tuple[int, dict]:
+        """ Sends the request through the pooled session with the configured timeouts, after
+            waiting for the shared rate limiter. Connection failures, timeouts and rate limiter
+            waits past KROGER_RATE_MAX_WAIT are returned as errors rather than raised.
+
+            While the rate limiter is on, retries on a status happen here rather than in the
+            session, so that each one takes its own token from the bucket.
+        """
+        config = current_app.config
+        kwargs.setdefault('timeout', (config['KROGER_CONNECT_TIMEOUT'], config['KROGER_READ_TIMEOUT']))
+        retry_on: tuple = (Communicator.retry_statuses if method.upper() == 'GET' else (429,)) \
+            if RateLimiter.enabled() else ()
+        attempt: int = 0
+        while True:
+            ret = RateLimiter.acquire()
+            if ret[0] != 0:
+                return ret
+            start: float = time.perf_counter() if Metrics.enabled else 0
+            try:
+                req: requests.Response = Communicator._http(method).request(method, target_url, **kwargs)
+            except requests.RequestException as e:
+                logger.warning('request error calling %s: %s', target_url, e)
+                if Metrics.enabled:
+                    observe_kroger(Communicator._call_name(target_url), method, start, 'error', 0)
+                return -1, {'error': f'request error: {e}'}
+            if Metrics.enabled:
+                retries = getattr(req.raw, 'retries', None)
+                observe_kroger(Communicator._call_name(target_url), method, start, str(req.status_code),
+                               (len(retries.history) if retries is not None else 0) + attempt)
+            if req.status_code not in retry_on or attempt >= config['KROGER_MAX_RETRIES']:
+                return 0, {'response': req}
+            delay: float = Communicator._retry_delay(req, attempt)
+            if delay > config['KROGER_RATE_MAX_WAIT']:
+                return 0, {'response': req}
+            logger.debug('%s %s returned %s, retrying in %.2fs', method, target_url, req.status_code, delay)
+            req.close()
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _retry_delay(req: requests.Response, attempt: int) -> float:
+        """ Seconds to wait before retrying req: its Retry-After if it has one, else the backoff """
+        retry_after: str = req.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return Retry.DEFAULT.parse_retry_after(retry_after)
+            except InvalidHeader:
+                pass
+        return current_app.config['KROGER_BACKOFF_FACTOR'] * (2 ** attempt)
+
+    @staticmethod
+    def _call_name(target_url: str) -> str:
+        """ Metrics label for a Kroger URL, e.g. 'products' or 'connect/oauth2/token' """
+        base: str = Communicator._api_base()
+        if target_url.startswith(base):
+            return target_url[len(base):].split('?', 1)[0]
+        return urllib.parse.urlparse(target_url).path
 
     @staticmethod
     def check_ctoken(timestamp: int) -> bool:
         """ Evaluates given timestamp freshness based on client token expiry rules """
         now: datetime.datetime = datetime.datetime.now()
         then: datetime.datetime = datetime.datetime.fromtimestamp(timestamp)
-        print(now)
-        print(then)
         if (now - then).total_seconds() >= Communicator.token_timeout:
-            val = (now - then).seconds
-            print(f'nts: {val}')
-            print('Token expired')
+            logger.debug('access token expired, issued %s', then)
             return False
-        print('Token good')
         return True
 
     @staticmethod
@@ -47,9 +239,8 @@ class Communicator:
         now: datetime.datetime = datetime.datetime.now()
         then: datetime.datetime = datetime.datetime.fromtimestamp(timestamp)
         if (now - then).total_seconds() >= Communicator.refresh_timeout:
-            print('refresh token expired')
+            logger.debug('refresh token expired, issued %s', then)
             return False
-        print('refresh token good')
         return True
 
     @staticmethod
@@ -65,7 +256,7 @@ class Communicator:
             , 'state': 'oftheunion'
         }
         encoded_params = urllib.parse.urlencode(params)
-        target_url = Communicator.api_base + Communicator.api_authorize + '?' + encoded_params
+        target_url = Communicator._api_base() + Communicator.api_authorize + '?' + encoded_params
         return target_url
 
     @staticmethod
@@ -81,11 +272,14 @@ class Communicator:
             , 'scope': 'profile.compact cart.basic:write product.compact'
             , 'code': auth_code
         }
-        target_url: str = Communicator.api_base + Communicator.api_token
-        req = requests.post(target_url, headers=headers, data=data,
-                            auth=(Communicator.client_id, Communicator.client_secret))
+        target_url: str = Communicator._api_base() + Communicator.api_token
+        ret = Communicator._request('POST', target_url, headers=headers, data=data,
+                                    auth=(Communicator.client_id, Communicator.client_secret))
+        if ret[0] != 0:
+            return -1, {'error_message': ret[1]['error']}
+        req: requests.Response = ret[1]['response']
         if req.status_code != 200:
-            print(req.text)
+            logger.warning('auth code exchange failed: %s %s', req.status_code, req.text)
             return -1, {'error_message': f'{req.text}'}
         req = req.json()
         access_timestamp: float = datetime.datetime.now().timestamp()
@@ -95,63 +289,66 @@ class Communicator:
             'refresh_token': req['refresh_token'],
             'refresh_token_timestamp': access_timestamp
         }
-        print("..Tokens retrieved")
+        logger.debug('tokens retrieved from auth code')
         return 0, token_dict
 
     @staticmethod
     def refresh_tokens() -> Tuple[int, dict]:
-        """  Exchange refresh token for new tokens. Update session and db with new values
+        """  Exchange refresh token for new tokens. Update session and db with new values.
+             Goes through TokenManager so concurrent refreshes for the user share one Kroger call.
         """
-        if not Communicator.check_rtoken(session['refresh_token_timestamp']):
-            return -1, {'error': 'expired refresh token'}
+        ret = TokenManager.refresh(session['user_id'])
+        if ret[0] != 0:
+            logger.warning('error refreshing tokens: %s', ret[1], extra={'user_id': session['user_id']})
+            return ret
+        TokenManager.to_session(ret[1])
+        logger.debug('tokens refreshed', extra={'user_id': session['user_id']})
+        return 0, {}
 
+    @staticmethod
+    def _exchange_refresh_token(refresh_token: str) -> Tuple[int, dict]:
+        """ Trades a refresh token for a new token pair. Does not touch the session or db """
         # Prepping request
-        print('refreshing tokens')
+        logger.debug('exchanging refresh token')
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded'
         }
         data = {
             'grant_type': 'refresh_token'
-            , 'refresh_token': session['refresh_token']
+            , 'refresh_token': refresh_token
         }
-        target_url: str = Communicator.api_base + Communicator.api_token
+        target_url: str = Communicator._api_base() + Communicator.api_token
         # Evaluating response
-        req = requests.post(target_url, headers=headers, data=data,
-                            auth=(Communicator.client_id, Communicator.client_secret))
+        ret = Communicator._request('POST', target_url, headers=headers, data=data,
+                                    auth=(Communicator.client_id, Communicator.client_secret))
+        if ret[0] != 0:
+            return ret
+        req: requests.Response = ret[1]['response']
         if req.status_code != 200:
-            print(f'request error refreshing tokens: {req.text}')
+            logger.warning('refresh token exchange failed: %s %s', req.status_code, req.text)
             return -1, {'error': f'request error: {req.text}'}
         req = req.json()
-        # Dispersing new tokens
-        session['access_token'] = req['access_token']
-        session['access_token_timestamp'] = datetime.datetime.now().timestamp()
-        session['refresh_token'] = req['refresh_token']
-        session['refresh_token_timestamp'] = datetime.datetime.now().timestamp()
-        user_id: int = session['user_id']
+        now: float = datetime.datetime.now().timestamp()
         token_dict = {
-            'access_token': session['access_token'],
-            'access_token_timestamp': session['access_token_timestamp'],
-            'refresh_token': session['refresh_token'],
-            'refresh_token_timestamp': session['refresh_token_timestamp']
-
+            'access_token': req['access_token'],
+            'access_token_timestamp': now,
+            'refresh_token': req['refresh_token'],
+            'refresh_token_timestamp': now
         }
-        ret = DBInterface.deposit_tokens(user_id, token_dict)
-        if ret[0] != 0:
-            print(f'Error depositing tokens: {ret}')
-            return ret
-        print('tokens refreshed')
-        return 0, {}
+        return 0, token_dict
 
     @staticmethod
     def search_locations(zipcode: str) -> Tuple[int, dict]:
-        print('searchign locations')
-        if not Communicator.check_ctoken(session['access_token_timestamp']):
-            ret = Communicator.refresh_tokens()
-            if ret[0] != 0:
-                print(f'error searching lcoations {ret}')
-                return ret
+        ret = Communicator._access_token()
+        if ret[0] != 0:
+            logger.warning('error searching locations: %s', ret[1])
+            return ret
         # Fresh tokens in hand
-        access_token = session['access_token']
+        return Communicator._fetch_locations(ret[1]['access_token'], zipcode)
+
+    @staticmethod
+    def _fetch_locations(access_token: str, zipcode: str) -> Tuple[int, dict]:
+        """ Location search with an explicit token, so it works outside of a user session """
         # Building request
         headers = {
             'Accept': 'application/json',
@@ -162,26 +359,141 @@ class Communicator:
             'filter.zipCode.near': zipcode,
             'filter.limit': '50'
         }
-        target_url: str = Communicator.api_base + 'locations'
-        req: requests.Response = requests.get(target_url, headers=headers, params=params)
+        target_url: str = Communicator._api_base() + 'locations'
+        ret = Communicator._request('GET', target_url, headers=headers, params=params)
+        if ret[0] != 0:
+            return ret
+        req: requests.Response = ret[1]['response']
         if req.status_code != 200:
-            print(f'request error searching lcoations: {req.text}')
+            logger.warning('location search failed: %s %s', req.status_code, req.text)
             return -1, {'error': f'{req.status_code}: {req.text}'}
-        print('successfully searched locations')
+        logger.debug('searched locations near %s', zipcode)
         return 0, {'results': req.json()}
 
     @staticmethod
-    def search_product(search_term: str, locationId: str) -> Tuple[int, dict]:
-        """ Submits search term to Kroger API """
+    def client_token() -> Tuple[int, dict]:
+        """ Application (client credentials) token for calls that are not tied to a customer,
+            e.g. location lookups from the CLI. Reused until shortly before it expires.
+        """
+        if Communicator._client_token is not None and time.time() < Communicator._client_token_expiry:
+            return 0, {'access_token': Communicator._client_token}
+        headers: dict = {
+            'Content-Type': 'application/x-www-form-urlencoded'
+        }
+        data: dict = {
+            'grant_type': 'client_credentials'
+        }
+        target_url: str = Communicator._api_base() + Communicator.api_token
+        ret = Communicator._request('POST', target_url, headers=headers, data=data,
+                                    auth=(Communicator.client_id, Communicator.client_secret))
+        if ret[0] != 0:
+            return ret
+        req: requests.Response = ret[1]['response']
+        if req.status_code != 200:
+            return -1, {'error': f'{req.status_code}: {req.text}'}
+        req = req.json()
+        Communicator._client_token = req['access_token']
+        Communicator._client_token_expiry = time.time() + float(req.get('expires_in', 1800)) - 60
+        return 0, {'access_token': Communicator._client_token}
+
+    @staticmethod
+    def search_product(search_term: str, locationId: str, fulfillment: str = 'csp',
+                       start: int = 1) -> Tuple[int, dict]:
+        """ Submits search term to Kroger API. Returns the page of up to search_page_size
+            results beginning at the 1-based position start.
+
+            Results are served from the search cache when possible. A stale entry is returned
+            immediately and revalidated in the background with the caller's access token.
+        """
 
         if len(search_term) < 3:
             return -1, {'error_message': 'String must be at least 3 characters'}
-        if not Communicator.check_ctoken(session['access_token_timestamp']):
-            ret = Communicator.refresh_tokens()
-            if ret[0] != 0:
-                return ret
+        cache: TTLCache = Communicator.search_cache()
+        cache_key: tuple = Communicator._search_key(search_term, locationId, fulfillment, start)
+        state, cached = cache.get(cache_key)
+        if state == 'fresh':
+            return 0, cached
+        ret = Communicator._access_token()
+        if ret[0] != 0:
+            if state == 'stale':
+                return 0, cached
+            return ret
         # Fresh tokens in hand
-        access_token: str = session['access_token']
+        access_token: str = ret[1]['access_token']
+        if state == 'stale':
+            if cache.begin_refresh(cache_key):
+                app = current_app._get_current_object()
+                Communicator._background().submit(Communicator._revalidate_search, app, cache_key,
+                                                  access_token, search_term, locationId, fulfillment, start)
+            return 0, cached
+        ret = Communicator._fetch_products(access_token, search_term, locationId, fulfillment, start)
+        if ret[0] == 0:
+            cache.set(cache_key, ret[1])
+        return ret
+
+    @staticmethod
+    def search_product_pages(search_term: str, locationId: str, fulfillment: str = 'csp',
+                             max_results: int = 250) -> Iterator[Tuple[int, dict]]:
+        """
+            Generator over the pages of a search, up to max_results products. The first page
+            comes from search_product. Its pagination total decides how many more there are,
+            and those are requested concurrently on the search page pool, through the search
+            cache, and yielded as they complete. Every page carries its 'start'.
+
+            Must be consumed inside the request (e.g. through stream_with_context). Closing
+            the generator early cancels the pages that have not been requested yet.
+        """
+        ret = Communicator.search_product(search_term, locationId, fulfillment)
+        if ret[0] != 0:
+            yield ret
+            return
+        yield 0, {'start': 1, 'results': ret[1]['results']}
+        total: int = ret[1]['results'].get('meta', {}).get('pagination', {}).get('total', 0)
+        starts = range(1 + Communicator.search_page_size, min(total, max_results) + 1,
+                       Communicator.search_page_size)
+        if not starts:
+            return
+        ret = Communicator._access_token()
+        if ret[0] != 0:
+            yield ret
+            return
+        access_token: str = ret[1]['access_token']
+        app = current_app._get_current_object()
+        futures: list = [Communicator._search_pool().submit(Communicator._search_page, app, access_token,
+                                                             search_term, locationId, fulfillment, start)
+                         for start in starts]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    @staticmethod
+    def _search_page(app, access_token: str, search_term: str, locationId: str, fulfillment: str,
+                     start: int) -> Tuple[int, dict]:
+        """ Runs on the search page pool. One later page of search_product_pages """
+        with app.app_context():
+            cache: TTLCache = Communicator.search_cache()
+            cache_key: tuple = Communicator._search_key(search_term, locationId, fulfillment, start)
+            state, cached = cache.get(cache_key)
+            if state == 'miss':
+                ret = Communicator._fetch_products(access_token, search_term, locationId, fulfillment, start)
+                if ret[0] != 0:
+                    ret[1]['start'] = start
+                    return ret
+                cache.set(cache_key, ret[1])
+                cached = ret[1]
+        return 0, {'start': start, 'results': cached['results']}
+
+    @staticmethod
+    def _search_key(search_term: str, locationId: str, fulfillment: str, start: int) -> tuple:
+        return ' '.join(search_term.lower().split()), locationId, fulfillment, start
+
+    @staticmethod
+    def _fetch_products(access_token: str, search_term: str, locationId: str,
+                        fulfillment: str, start: int = 1) -> Tuple[int, dict]:
+        """ The uncached product search request """
         headers: dict = {
             'Accept': 'application/json'
             , 'Authorization': f'Bearer {access_token}'
@@ -189,33 +501,309 @@ class Communicator:
         params = {
             'filter.term': search_term,
             'filter.locationId': locationId,
-            'filter.fulfillment': 'csp',
-            'filter.start': '1',
-            'filter.limit': '50',
+            'filter.fulfillment': fulfillment,
+            'filter.start': str(start),
+            'filter.limit': str(Communicator.search_page_size),
         }
-        target_url: str = f'{Communicator.api_base}products'
-        req = requests.get(target_url, headers=headers, params=params)
+        target_url: str = f'{Communicator._api_base()}products'
+        ret = Communicator._request('GET', target_url, headers=headers, params=params)
+        if ret[0] != 0:
+            return -1, {'error_message': ret[1]['error']}
+        req: requests.Response = ret[1]['response']
         if req.status_code != 200:
             return -1, {'error_message': f'{req.status_code}: {req.text}'}
+        if current_app.config['SEARCH_PROJECTION']:
+            return 0, {'results': project_search(req.json())}
         return 0, {'results': req.json()}
 
+    @staticmethod
+    def _revalidate_search(app, cache_key: tuple, access_token: str, search_term: str,
+                           locationId: str, fulfillment: str, start: int):
+        """ Runs on the background executor. Replaces a stale search cache entry """
+        try:
+            with app.app_context():
+                ret = Communicator._fetch_products(access_token, search_term, locationId, fulfillment, start)
+            if ret[0] == 0:
+                Communicator.search_cache().set(cache_key, ret[1])
+            else:
+                logger.warning('error revalidating search %s: %s', cache_key, ret[1])
+        finally:
+            Communicator.search_cache().end_refresh(cache_key)
+
+    @staticmethod
+    def search_cache() -> TTLCache:
+        """ Process-wide product search cache sized by the SEARCH_CACHE_* config keys """
+        if Communicator._search_cache is None:
+            with Communicator._http_lock:
+                if Communicator._search_cache is None:
+                    config = current_app.config
+                    Communicator._search_cache = TTLCache(config['SEARCH_CACHE_SIZE'],
+                                                          config['SEARCH_CACHE_TTL'],
+                                                          config['SEARCH_CACHE_STALE_TTL'])
+        return Communicator._search_cache
+
+    @staticmethod
+    def _background() -> ThreadPoolExecutor:
+        """ Small executor for work that must not hold up the request, e.g. cache revalidation """
+        if Communicator._executor is None:
+            with Communicator._http_lock:
+                if Communicator._executor is None:
+                    Communicator._executor = ThreadPoolExecutor(max_workers=2,
+                                                                thread_name_prefix='communicator')
+        return Communicator._executor
+
+    @staticmethod
+    def _search_pool() -> ThreadPoolExecutor:
+        """ Executor for the later pages of search_product_pages, sized by KROGER_SEARCH_PAGE_WORKERS """
+        if Communicator._page_executor is None:
+            with Communicator._http_lock:
+                if Communicator._page_executor is None:
+                    Communicator._page_executor = ThreadPoolExecutor(
+                        max_workers=current_app.config['KROGER_SEARCH_PAGE_WORKERS'],
+                        thread_name_prefix='kroger-search')
+        return Communicator._page_executor
+
+    @staticmethod
+    def _cart_pool() -> ThreadPoolExecutor:
+        """ Executor for the chunks of add_to_cart, sized by KROGER_CART_WORKERS """
+        if Communicator._cart_executor is None:
+            with Communicator._http_lock:
+                if Communicator._cart_executor is None:
+                    Communicator._cart_executor = ThreadPoolExecutor(
+                        max_workers=current_app.config['KROGER_CART_WORKERS'],
+                        thread_name_prefix='kroger-cart')
+        return Communicator._cart_executor
+
+    @staticmethod
+    def _access_token() -> Tuple[int, dict]:
+        """ Returns the session's access token, refreshing it first if it has expired """
+        return TokenManager.access_token()
+
     @staticmethod
     def add_to_cart(shopping_list: List[dict]) -> Tuple[int, dict]:
-        if not Communicator.check_ctoken(session['access_token_timestamp']):
-            ret = Communicator.refresh_tokens()
-            if ret[0] != 0:
-                return ret
+        """
+            Adds [{'upc': <>, 'quantity': <>}, ...] to the customer's cart in chunks of
+            CART_CHUNK_SIZE items, sent concurrently on the cart pool with one access token.
+            The pooled session retries 429s and connection errors, and a chunk answered with
+            one of gateway_statuses is resent up to KROGER_MAX_RETRIES times with backoff. A 500
+            or a timeout is not retried: cart/add is not idempotent and Kroger may have added the
+            items. A chunk Kroger rejects outright is resent item by item, so only the offending
+            items fail.
+
+            Returns {'results': [{'upc', 'quantity', 'added': <bool>, 'error'?}, ...] in
+            shopping_list order, 'added': <count>, 'failed': <count>}
+        """
+        if not shopping_list:
+            return 0, {'results': [], 'added': 0, 'failed': 0}
+        ret = Communicator._access_token()
+        if ret[0] != 0:
+            return ret
         # Valid tokens in hand
-        access_token: str = session['access_token']
+        access_token: str = ret[1]['access_token']
+        chunk_size: int = max(1, current_app.config['CART_CHUNK_SIZE'])
+        chunks: list = [shopping_list[i:i + chunk_size] for i in range(0, len(shopping_list), chunk_size)]
+        app = current_app._get_current_object()
+        if len(chunks) == 1:
+            chunk_errors: list = [Communicator._cart_chunk(app, access_token, chunks[0])]
+        else:
+            futures: list = [Communicator._cart_pool().submit(Communicator._cart_chunk, app, access_token, chunk)
+                             for chunk in chunks]
+            chunk_errors = [future.result() for future in futures]
+        results: list = []
+        failed: int = 0
+        for chunk, errors in zip(chunks, chunk_errors):
+            for item, error in zip(chunk, errors):
+                result: dict = {'upc': item.get('upc'), 'quantity': item.get('quantity'), 'added': error is None}
+                if error is not None:
+                    result['error'] = error
+                    failed += 1
+                results.append(result)
+        return 0, {'results': results, 'added': len(results) - failed, 'failed': failed}
+
+    @staticmethod
+    def _cart_chunk(app, access_token: str, items: List[dict]) -> List[Optional[str]]:
+        """ Runs on the cart pool. Returns the error for each item, None for those added """
+        with app.app_context():
+            ret = Communicator._put_cart(access_token, items)
+            attempt: int = 0
+            while (ret[0] != 0 and ret[1]['status'] in Communicator.gateway_statuses
+                   and attempt < app.config['KROGER_MAX_RETRIES']):
+                delay: float = app.config['KROGER_BACKOFF_FACTOR'] * (2 ** attempt)
+                logger.debug('cart/add returned %s, retrying in %.2fs', ret[1]['status'], delay)
+                time.sleep(delay)
+                attempt += 1
+                ret = Communicator._put_cart(access_token, items)
+            if ret[0] == 0:
+                return [None] * len(items)
+            status = ret[1]['status']
+            if (len(items) > 1 and status is not None and 400 <= status < 500
+                    and status not in (401, 403) and status not in Communicator.retry_statuses):
+                # Most likely a bad item, not a bad request. Find out which.
+                return [Communicator._put_cart(access_token, [item])[1].get('error') for item in items]
+            return [ret[1]['error']] * len(items)
+
+    @staticmethod
+    def _put_cart(access_token: str, items: List[dict]) -> Tuple[int, dict]:
+        """ One cart/add request. Errors carry the HTTP status, None if there was no response """
         headers: dict = {
             'Accept': 'application/json'
             , 'Authorization': f'Bearer {access_token}'
         }
         data: dict = {
-            'items': shopping_list
+            'items': items
         }
-        target_url: str = f'{Communicator.api_base}cart/add'
-        req = requests.put(target_url, headers=headers, json=data)
+        target_url: str = f'{Communicator._api_base()}cart/add'
+        ret = Communicator._request('PUT', target_url, headers=headers, json=data)
+        if ret[0] != 0:
+            return -1, {'error': ret[1]['error'], 'status': None}
+        req: requests.Response = ret[1]['response']
         if req.status_code != 204:
-            return -1, {'error': req.text}
-        return 0, {'response': req.text}
\ No newline at end of file
+            return -1, {'error': f'{req.status_code}: {req.text}', 'status': req.status_code}
+        return 0, {}
+
+
+@Metrics.collector
+def _search_cache_metrics():
+    cache: TTLCache = Communicator._search_cache
+    if cache is None:
+        return
+    stats: dict = cache.stats()
+    for event in ('hits', 'stale_hits', 'misses', 'evictions'):
+        Metrics.set('webshopper_search_cache_events_total', (('event', event),), stats[event])
+    Metrics.set('webshopper_search_cache_entries', (), stats['size'])
+
+
+class TokenManager:
+    """
+        Coordinates customer token refreshes within a worker process.
+
+        Concurrent refreshes for one user are merged into a single Kroger call, and a daemon
+        thread refreshes the tokens of recently active users TOKEN_REFRESH_LEAD seconds before
+        they expire. Requests pick those tokens up from memory, so they rarely wait on a refresh.
+        Other workers see the new tokens through the users table when their own copy expires.
+    """
+    _lock: threading.Lock = threading.Lock()
+    _user_locks: dict = {}  # {<user_id>: threading.Lock}
+    _latest: dict = {}  # {<user_id>: token_dict} newest tokens seen by this process
+    _active: dict = {}  # {<user_id>: <time.time() of last use>}
+    _thread: threading.Thread = None
+    _thread_pid: int = None
+
+    @staticmethod
+    def access_token() -> Tuple[int, dict]:
+        """ Session-aware entry point used by every Communicator call """
+        user_id: int = session['user_id']
+        TokenManager._touch(user_id)
+        latest: dict = TokenManager._latest.get(user_id)
+        if latest is not None and latest['access_token_timestamp'] > session['access_token_timestamp']:
+            # Refreshed in the background or by a parallel request
+            TokenManager.to_session(latest)
+        if not Communicator.check_ctoken(session['access_token_timestamp']):
+            ret = TokenManager.refresh(user_id)
+            if ret[0] != 0:
+                return ret
+            TokenManager.to_session(ret[1])
+        return 0, {'access_token': session['access_token']}
+
+    @staticmethod
+    def refresh(user_id: int, lead: float = 0) -> Tuple[int, dict]:
+        """ Returns a token_dict whose access token is good for at least `lead` more seconds,
+            calling Kroger only if neither this process nor the db already has one.
+            Callers for the same user queue on a per-user lock behind the first one.
+        """
+        with TokenManager._user_lock(user_id):
+            latest: dict = TokenManager._latest.get(user_id)
+            if latest is not None and TokenManager._fresh(latest, lead):
+                return 0, latest
+            # Another worker may have refreshed already. Its refresh token supersedes ours.
+            ret = DBInterface.get_tokens(user_id)
+            if ret[0] != 0:
+                return ret
+            token_dict: dict = ret[1]['tokens']
+            if TokenManager._fresh(token_dict, lead):
+                TokenManager._latest[user_id] = token_dict
+                return 0, token_dict
+            if not Communicator.check_rtoken(token_dict['refresh_token_timestamp']):
+                return -1, {'error': 'expired refresh token'}
+            ret = Communicator._exchange_refresh_token(token_dict['refresh_token'])
+            if ret[0] != 0:
+                return ret
+            token_dict = ret[1]
+            ret = DBInterface.deposit_tokens(user_id, token_dict)
+            if ret[0] != 0:
+                logger.error('error depositing tokens: %s', ret[1], extra={'user_id': user_id})
+                return ret
+            TokenManager._latest[user_id] = token_dict
+            return 0, token_dict
+
+    @staticmethod
+    def remember(user_id: int, token_dict: dict):
+        """ Records tokens obtained outside of refresh(), e.g. from the auth code exchange """
+        with TokenManager._user_lock(user_id):
+            TokenManager._latest[user_id] = token_dict
+
+    @staticmethod
+    def to_session(token_dict: dict):
+        session['access_token'] = token_dict['access_token']
+        session['access_token_timestamp'] = token_dict['access_token_timestamp']
+        session['refresh_token'] = token_dict['refresh_token']
+        session['refresh_token_timestamp'] = token_dict['refresh_token_timestamp']
+        g.pop('session_user', None)  # auth.session_user's copy of the old tokens
+
+    @staticmethod
+    def _fresh(token_dict: dict, lead: float) -> bool:
+        age: float = datetime.datetime.now().timestamp() - token_dict['access_token_timestamp']
+        return age < Communicator.token_timeout - lead
+
+    @staticmethod
+    def _user_lock(user_id: int) -> threading.Lock:
+        with TokenManager._lock:
+            if user_id not in TokenManager._user_locks:
+                TokenManager._user_locks[user_id] = threading.Lock()
+            return TokenManager._user_locks[user_id]
+
+    @staticmethod
+    def _touch(user_id: int):
+        """ Marks the user active and makes sure this process runs the refresh thread """
+        TokenManager._active[user_id] = time.time()
+        if not current_app.config['TOKEN_PROACTIVE_REFRESH']:
+            return
+        pid: int = os.getpid()
+        if TokenManager._thread is not None and TokenManager._thread_pid == pid:
+            return
+        with TokenManager._lock:
+            if TokenManager._thread is None or TokenManager._thread_pid != pid:
+                app = current_app._get_current_object()
+                TokenManager._thread = threading.Thread(target=TokenManager._run, args=(app,),
+                                                        name='token-refresh', daemon=True)
+                TokenManager._thread_pid = pid
+                TokenManager._thread.start()
+
+    @staticmethod
+    def _run(app):
+        """ Background loop refreshing tokens for users seen within TOKEN_ACTIVE_WINDOW """
+        while True:
+            time.sleep(app.config['TOKEN_REFRESH_INTERVAL'])
+            cutoff: float = time.time() - app.config['TOKEN_ACTIVE_WINDOW']
+            with TokenManager._lock:
+                for user_id, last_seen in list(TokenManager._active.items()):
+                    if last_seen < cutoff:
+                        TokenManager._forget(user_id)
+                user_ids: list = list(TokenManager._active)
+            for user_id in user_ids:
+                try:
+                    with app.app_context():
+                        ret = TokenManager.refresh(user_id, app.config['TOKEN_REFRESH_LEAD'])
+                except Exception as e:
+                    ret = -1, {'error': str(e)}
+                if ret[0] != 0:
+                    # Most likely an expired refresh token. The user's next request surfaces it.
+                    logger.info('background token refresh failed: %s', ret[1], extra={'user_id': user_id})
+                    with TokenManager._lock:
+                        TokenManager._forget(user_id)
+
+    @staticmethod
+    def _forget(user_id: int):
+        """ Caller holds TokenManager._lock """
+        TokenManager._active.pop(user_id, None)
+        TokenManager._latest.pop(user_id, None)
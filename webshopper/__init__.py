@@ -1,3 +1,4 @@
+import logging
 import os
 
 from flask import Flask
@@ -13,10 +14,84 @@ def create_app(test_config=None):
     # and supports_credentials so that we can submit the cookies
     CORS(app, supports_credentials=True)
 
-    print(f'This is the flask_env: {os.getenv("FLASK_ENV")}')
     app.config.from_mapping(
         SECRET_KEY='dev',
-        DATABASE=os.path.join(app.instance_path, 'webshopper.sqlite')
+        DATABASE=os.path.join(app.instance_path, 'webshopper.sqlite'),
+        # Applied once per pooled sqlite connection. CACHE_SIZE is negative KiB, i.e. 16MB.
+        DB_JOURNAL_MODE='WAL',
+        DB_SYNCHRONOUS='NORMAL',
+        DB_MMAP_SIZE=256 * 1024 * 1024,
+        DB_CACHE_SIZE=-16000,
+        # Apply pending migrations to an existing database when the app starts, so an upgrade
+        # never needs the destructive init-db. 'flask migrate-db' does the same by hand.
+        DB_MIGRATE_ON_START=True,
+        # Kroger HTTP client. Timeouts are in seconds, pools are per worker process.
+        # Point KROGER_API_BASE at webshopper.kroger_sim (e.g. http://127.0.0.1:5055/v1/) to run offline.
+        KROGER_API_BASE='https://api.kroger.com/v1/',
+        KROGER_POOL_CONNECTIONS=10,
+        KROGER_POOL_MAXSIZE=20,
+        KROGER_CONNECT_TIMEOUT=3.05,
+        KROGER_READ_TIMEOUT=10,
+        KROGER_MAX_RETRIES=3,
+        KROGER_BACKOFF_FACTOR=0.3,
+        # Token bucket shared by all workers through a sqlite file (RateLimiter): LIMIT calls per
+        # second with bursts of up to BURST. Calls queue for at most MAX_WAIT seconds, then fail.
+        # LIMIT 0 disables it. LIMIT_DB defaults to kroger_rate.sqlite in the instance folder.
+        KROGER_RATE_LIMIT=0,
+        KROGER_RATE_BURST=20,
+        KROGER_RATE_MAX_WAIT=10,
+        KROGER_RATE_LIMIT_DB=None,
+        KROGER_ASYNC_WORKERS=20,  # Threads behind AsyncCommunicator, i.e. Kroger calls in flight
+        # Threads fetching the later pages of streamed product searches, and the deepest
+        # result a search may page to (Kroger stops at 250)
+        KROGER_SEARCH_PAGE_WORKERS=8,
+        SEARCH_MAX_RESULTS=250,
+        # Items per cart/add request, and threads sending those requests in parallel
+        CART_CHUNK_SIZE=25,
+        KROGER_CART_WORKERS=4,
+        # Background refresh of customer tokens. Users idle for longer than ACTIVE_WINDOW are
+        # skipped; active users are refreshed LEAD seconds before Communicator.token_timeout.
+        TOKEN_PROACTIVE_REFRESH=True,
+        TOKEN_REFRESH_INTERVAL=60,
+        TOKEN_REFRESH_LEAD=300,
+        TOKEN_ACTIVE_WINDOW=60 * 30,
+        # Kroger product search cache. Entries are fresh for TTL seconds, then served stale
+        # (and revalidated in the background) for STALE_TTL more. SIZE 0 disables caching.
+        SEARCH_CACHE_SIZE=2048,
+        SEARCH_CACHE_TTL=300,
+        SEARCH_CACHE_STALE_TTL=1800,
+        # Cache and serve product searches cut down to the fields the app uses (Communicator.project_search)
+        SEARCH_PROJECTION=True,
+        # Seconds a zipcode's store list is served from the location_cache table (30 days)
+        LOCATION_CACHE_TTL=60 * 60 * 24 * 30,
+        # Prometheus text metrics at /metrics. Off means no timing work at all.
+        METRICS_ENABLED=False,
+        # Seconds between checks of the reference_version row behind UnitCache
+        UNIT_CACHE_CHECK_INTERVAL=30,
+        # Page sizes for the cursor-paginated GET /products and GET /recipes
+        PAGE_SIZE=100,
+        PAGE_SIZE_MAX=500,
+        # Whether /auth/login returns the whole product and recipe library by default.
+        # Clients that page through the list endpoints send 'include_library': false.
+        LOGIN_INCLUDE_LIBRARY=True,
+        # Most items accepted by one bulk request (/products/add_products)
+        BULK_MAX_ITEMS=1000,
+        # JSON encoder for responses: 'auto' (orjson when installed), 'orjson' or 'stdlib'
+        JSON_PROVIDER='auto',
+        # gzip/deflate for buffered JSON and text responses of at least MIN_SIZE bytes
+        COMPRESS_ENABLED=True,
+        COMPRESS_MIN_SIZE=1024,
+        COMPRESS_LEVEL=6,
+        # Where session data lives: 'cookie' (Flask's signed cookie), 'memory' (per-process LRU
+        # of MEMORY_SIZE sessions, single worker only) or 'sqlite' (the sessions table). The
+        # server-side backends put only a session id in the cookie.
+        SESSION_BACKEND='cookie',
+        SESSION_MEMORY_SIZE=10000,
+        # Logging for the 'webshopper' logger tree. FORMAT is 'text' or 'json' (one object per
+        # line). DEBUG_SAMPLE_RATE is the fraction of DEBUG records kept when LEVEL is DEBUG.
+        LOG_LEVEL='INFO',
+        LOG_FORMAT='text',
+        LOG_DEBUG_SAMPLE_RATE=1.0,
     )
 
     if test_config is None:
@@ -32,10 +107,26 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    from . import logs
+    logs.init_app(app)
+    logging.getLogger(__name__).debug('FLASK_ENV is %s', os.getenv('FLASK_ENV'))
+
     # Adding database init
     from . import db
     db.init_app(app)
 
+    from . import metrics
+    metrics.init_app(app)
+
+    from . import sessions
+    sessions.init_app(app)
+
+    from . import responses
+    responses.init_app(app)
+
+    from . import bench
+    app.cli.add_command(bench.bench_command)
+
     # Adding auth registration
     from . import auth
     app.register_blueprint(auth.bp)
@@ -43,6 +134,7 @@ def create_app(test_config=None):
     # Adding non-auth endpoints
     from . import location
     app.register_blueprint(location.bp)
+    app.cli.add_command(location.location_cache_command)
 
     from . import products
     app.register_blueprint(products.bp)
@@ -50,4 +142,7 @@ def create_app(test_config=None):
     from . import recipes
     app.register_blueprint(recipes.bp)
 
+    from . import sync
+    app.register_blueprint(sync.bp)
+
     return app
\ No newline at end of file
@@ -1,21 +1,34 @@
 import functools
+import logging
 from sqlite3 import Connection
 import sqlite3
-import json
 
 from webshopper.Communicator import Communicator
+from webshopper.Communicator import TokenManager
 from webshopper.db import DBInterface
+from webshopper import etags
+from webshopper.etags import library_etag
+from webshopper.etags import set_library_etag
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
 )
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
+logger = logging.getLogger(__name__)
 
 
 @bp.route('/login', methods=('POST', 'OPTIONS'))
 def login():
     """
+        Returns the user's profile and, unless 'include_library' is false (LOGIN_INCLUDE_LIBRARY
+        sets the default), every product and recipe. Clients that page through GET /products
+        and GET /recipes should send 'include_library': false. 'version' is the starting
+        point for /sync.
+
+        The library comes with an ETag. A client that sends it back in If-None-Match still
+        gets a 200 (the session has to be set up), but without 'products' and 'recipes'
+        when its copy is current.
     """
     if request.method == 'OPTIONS':
         # Preflighting
@@ -29,15 +42,13 @@ def login():
     username = credentials.get('username', None)
     password = credentials.get('password', None)
     if not username:
-        print('no username')
         return {'error': 'Missing username'}, 400
     if not password:
-        print('no password')
         return {'error': 'Missing password'}, 400
     # Evaluating credentials
     ret = DBInterface.get_user(username, password)
     if ret[0] != 0:
-        print('incorrect credentials')
+        logger.info('failed login for %s', username)
         return ret[1], 401
     user: sqlite3.Row = ret[1]['user']
     # Credentials validated
@@ -48,26 +59,35 @@ def login():
     session['refresh_token'] = user['refresh_token']
     session['refresh_token_timestamp'] = user['refresh_token_timestamp']
     session['locationId'] = user['locationId']
-    # Pulling user's products
-    ret = DBInterface.get_user_prods(user['user_id'])
-    if ret[0] != 0:
-        print(f'error retrieving products from database: {ret}')
-        return {'error': f'error retrieving products from database: {ret}'}, 500
-    products: list = ret[1]['products']
-    # Pulling user's recipes
-    ret = DBInterface.get_user_recipes(user['user_id'])
+    session.permanent = True
+    profile: dict = {'username': user['username'],
+                     'location_chain': user['location_chain'],
+                     'location_address': user['location_address']}
+    # Read before the library so that writes racing with it show up in the client's first /sync
+    ret = DBInterface.get_library_version(user['user_id'])
     if ret[0] != 0:
         return ret[1], 500
-    recipes: dict = ret[1]['recipes']
-    print(f"Here is the recipe set: {ret[1]['recipes']}")
-
-    session.permanent = True
+    profile['version'] = ret[1]['version']
+    include_library: bool = credentials.get('include_library', current_app.config['LOGIN_INCLUDE_LIBRARY'])
+    etag: str = library_etag(user['user_id'], profile['version'], 'login')
+    if include_library and not etags.matches(etag):
+        # Pulling user's products
+        ret = DBInterface.get_user_prods(user['user_id'])
+        if ret[0] != 0:
+            logger.error('error retrieving products from database: %s', ret[1], extra={'user_id': user['user_id']})
+            return {'error': f'error retrieving products from database: {ret}'}, 500
+        profile['products'] = ret[1]['products']
+        # Pulling user's recipes
+        ret = DBInterface.get_user_recipes(user['user_id'])
+        if ret[0] != 0:
+            return ret[1], 500
+        profile['recipes'] = ret[1]['recipes']
+        logger.debug('login loaded %d products and %d recipes', len(profile['products']),
+                     len(profile['recipes']), extra={'user_id': user['user_id']})
     # Sending response
-    resp = Response(response=json.dumps({'username': user['username'],
-                                         'location_chain': user['location_chain'],
-                                         'location_address': user['location_address'],
-                                         'products': products,
-                                         'recipes': recipes}))
+    resp = Response(response=current_app.json.dumps(profile), mimetype='application/json')
+    if include_library:
+        set_library_etag(resp, etag)
     resp.headers['Access-Control-Allow-Origin'] = 'http://localhost:3000'
     resp.headers['Access-Control-Allow-Credentials'] = 'true'
     resp.headers['Access-Control-Allow-Headers'] = "Content-Type"
@@ -88,10 +108,8 @@ def register():
     username = credentials.get('username', None)
     password = credentials.get('password', None)
     if not username:
-        print('Missing username')
         return {'error_message': 'Missing username'}, 400
     if not password:
-        print('Missing password')
         return {'error_message': 'Missing password'}, 400
     ret = DBInterface.new_user(username, password)
     if ret[0] != 0:
@@ -110,10 +128,10 @@ def register():
 def authcode_from():
     # Redirect destination from kroger bringing auth code
     # Updates ktok cookie and redirects to hardcoded IP
-    print('in authcode_from')
     auth_code: str = request.args.get('code')
     ret = Communicator.tokens_from_auth(auth_code)
     if ret[0] != 0:
+        logger.warning('error trading auth code for tokens: %s', ret[1], extra={'user_id': session['user_id']})
         return f'error trading auth code for tokens: {ret[1]}'
     token_dict: dict = ret[1]
     ret = DBInterface.deposit_tokens(session['user_id'], token_dict)
@@ -123,6 +141,7 @@ def authcode_from():
     session['access_token_timestamp'] = token_dict['access_token_timestamp']
     session['refresh_token'] = token_dict['refresh_token']
     session['refresh_token_timestamp'] = token_dict['refresh_token_timestamp']
+    TokenManager.remember(session['user_id'], token_dict)
     resp = make_response(redirect('http://35.88.61.178'))
     resp.set_cookie('ktok', 'GUD')
     return resp, 200
@@ -131,19 +150,30 @@ def authcode_from():
 @bp.route('/authcode_to', methods=('GET',))
 def authcode_to():
     # Constructs URL and redirects client to Kroger's client consent page.
-    print('in authcode_to redirect endpoint')
     url: str = Communicator.build_auth_url()
-    print(f'redirect url: {url}')
+    logger.debug('redirecting to %s', url)
     return redirect(url)
 
 
+SESSION_USER_KEYS = ('user_id', 'access_token', 'access_token_timestamp',
+                     'refresh_token', 'refresh_token_timestamp', 'locationId')
+
+
+def session_user() -> dict:
+    """ The session's user and token fields, read from the session (and so from the
+        session store) once per request. Missing fields are None.
+        TokenManager.to_session drops the cached copy when it replaces the tokens.
+    """
+    if 'session_user' not in g:
+        g.session_user = {key: session.get(key) for key in SESSION_USER_KEYS}
+    return g.session_user
+
+
 def login_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if session['user_id'] is None:
-            print('User is not logged in')
+        if session_user()['user_id'] is None:
             return {'error': 'Must be logged in'}, 401
-        print('user is logged in')
         return view(**kwargs)
     return wrapped_view
 
@@ -154,21 +184,21 @@ def valid_tokens(view):
     # session has relevant token entries
     @functools.wraps(view)
     def wrapped_view(**kwargs):
+        user: dict = session_user()
         invalid_tokens = True
-        if Communicator.check_ctoken(session['access_token_timestamp']):
+        if Communicator.check_ctoken(user['access_token_timestamp']):
             invalid_tokens = False
-        elif Communicator.check_rtoken(session['refresh_token_timestamp']):
+        elif Communicator.check_rtoken(user['refresh_token_timestamp']):
             invalid_tokens = False
         if invalid_tokens:
-            print('tokens invalid')
             resp = jsonify(error='Invalid tokens')
-            if session['access_token'] == '0':
-                print('tokens missing')
+            if user['access_token'] == '0':
+                logger.debug('tokens missing', extra={'user_id': user['user_id']})
                 resp.set_cookie('ktok', 'MIS')
             else:
-                print('tokens expired')
+                logger.debug('tokens expired', extra={'user_id': user['user_id']})
                 resp.set_cookie('ktok', 'EXP')
             return resp
         else:
             return view(**kwargs)
-    return wrapped_view
\ No newline at end of file
+    return wrapped_view
@@ -0,0 +1,272 @@
+import datetime
+import json
+import os
+import random
+import time
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+import click
+from werkzeug.security import generate_password_hash
+
+BENCH_PASSWORD = 'bench'
+
+UNITS = {'weight': ['oz', 'gram', 'lb'], 'volume': ['tbsp', 'tsp', 'cup', 'floz', 'ml']}
+PERSPECTIVES = ['front', 'back', 'left', 'right', 'top']
+
+
+def percentile(sorted_samples: List[float], pct: float) -> float:
+    """ Nearest-rank percentile of an already sorted list """
+    rank = max(1, int(round(pct / 100 * len(sorted_samples))))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def library_sizes(users: int, max_products: int, max_recipes: int, rng: random.Random) -> List[Tuple[int, int]]:
+    """ [(<products>, <recipes>), ...] per user. The first user is the large tenant with the
+        maximum library, the rest follow a long-tailed (Pareto) distribution like real usage.
+    """
+    sizes = [(max_products, max_recipes)]
+    for _ in range(users - 1):
+        share = min(1.0, rng.paretovariate(1.2) / 50)
+        sizes.append((max(1, int(max_products * share)), max(1, int(max_recipes * share))))
+    return sizes
+
+
+def seed_database(users: int, max_products: int, max_recipes: int, ingredients: int, seed: int) -> dict:
+    """ Fills the current app's (freshly initialized) database with synthetic users.
+        Goes straight to sqlite with executemany; seeding through DBInterface would take hours.
+    """
+    from webshopper.db import DBInterface
+    rng = random.Random(seed)
+    db = DBInterface.get_db()
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    totals = {'users': 0, 'products': 0, 'imgurls': 0, 'recipes': 0, 'ingredients': 0}
+    for index, (product_count, recipe_count) in enumerate(library_sizes(users, max_products, max_recipes, rng)):
+        crsr = db.execute(""" INSERT INTO users (username, password_hash, locationId)
+                              VALUES (?, ?, ?)
+                          """, (f'bench{index}', password_hash, '70100123'))
+        user_id = crsr.lastrowid
+        products = []
+        imgurls = []
+        for p in range(product_count):
+            productId = f'{p:013d}'
+            unit_type = rng.choice(['weight', 'volume'])
+            unit = rng.choice(UNITS[unit_type])
+            products.append((user_id, productId, productId, f'bench product {p}', rng.uniform(0.5, 4),
+                             rng.uniform(1, 24), unit, unit_type, rng.uniform(50, 2000),
+                             'gram' if unit_type == 'weight' else 'ml', 'false', 1, 1, unit))
+            for perspective in rng.sample(PERSPECTIVES, rng.randint(1, len(PERSPECTIVES))):
+                imgurls.append((user_id, productId, perspective,
+                                f'https://www.kroger.com/product/images/xlarge/{perspective}/{productId}'))
+        db.executemany('INSERT INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', products)
+        db.executemany('INSERT INTO products_imgurls VALUES (?, ?, ?, ?)', imgurls)
+        ingredient_rows = []
+        for r in range(recipe_count):
+            crsr = db.execute(""" INSERT INTO recipes (user_id, recipe_name, recipe_text)
+                                  VALUES (?, ?, ?)
+                              """, (user_id, f'bench recipe {r}', 'Stir. ' * rng.randint(10, 200)))
+            recipe_id = crsr.lastrowid
+            for _ in range(ingredients):
+                product = rng.choice(products)
+                unit_type = product[7]
+                ingredient_rows.append((user_id, recipe_id, product[1], f'ingredient of {r}',
+                                        rng.uniform(0.25, 8), rng.choice(UNITS[unit_type]), product[3]))
+        db.executemany(""" INSERT INTO ingredients (user_id, recipe_id, productId, ingredient_name,
+                                                    ingredient_quantity, ingredient_unit, product_description)
+                           VALUES (?, ?, ?, ?, ?, ?, ?)
+                       """, ingredient_rows)
+        db.commit()
+        totals['users'] += 1
+        totals['products'] += len(products)
+        totals['imgurls'] += len(imgurls)
+        totals['recipes'] += recipe_count
+        totals['ingredients'] += len(ingredient_rows)
+    db.execute('ANALYZE')
+    db.commit()
+    return totals
+
+
+def benchmark_cases(username: str, user_id: int, rng: random.Random) -> List[Tuple[str, Callable]]:
+    """ One (name, callable) per DBInterface method. Write cases undo themselves
+        so every iteration sees the same data.
+    """
+    from webshopper.db import DBInterface
+    ret = DBInterface.get_user_prods(user_id)
+    products: list = ret[1]['products']
+    productIds: list = [product['productId'] for product in products]
+    ret = DBInterface.get_user_recipes(user_id)
+    recipe_ids: list = list(ret[1]['recipes'].keys())
+    counter = iter(range(10 ** 9))
+
+    def add_and_delete_product():
+        new_product = dict(products[0])
+        new_product['productId'] = f'bench-new-{next(counter)}'
+        DBInterface.add_product(user_id, new_product)
+        DBInterface.delete_product(user_id, new_product['productId'])
+
+    def add_and_delete_products():
+        batch: list = [dict(product, productId=f'bench-bulk-{next(counter)}') for product in products[:100]]
+        DBInterface.add_products(user_id, batch)
+        for product in batch:
+            DBInterface.delete_product(user_id, product['productId'])
+
+    def add_and_delete_ingredient():
+        ret = DBInterface.new_ingredient(user_id, rng.choice(recipe_ids), rng.choice(productIds),
+                                         'bench', 1, 'oz', 'bench')
+        DBInterface.delete_ingredient(ret[1]['ingredient_id'])
+
+    def add_and_delete_ingredients():
+        ingredients: list = [{'productId': rng.choice(productIds), 'ingredient_name': 'bench',
+                              'ingredient_quantity': 1, 'ingredient_unit': 'oz',
+                              'product_description': 'bench'} for _ in range(20)]
+        ret = DBInterface.new_ingredients(user_id, rng.choice(recipe_ids), ingredients)
+        for ingredient_id in ret[1]['ingredient_ids']:
+            DBInterface.delete_ingredient(ingredient_id)
+
+    def save_and_delete_session():
+        sid: str = f'bench-{next(counter)}'
+        DBInterface.save_session(sid, session_data, time.time() + 60)
+        DBInterface.delete_session(sid)
+
+    session_data: dict = {'user_id': user_id, 'access_token': 'a' * 1000, 'access_token_timestamp': time.time(),
+                          'refresh_token': 'r' * 40, 'refresh_token_timestamp': time.time(),
+                          'locationId': '70100123', '_permanent': True}
+    DBInterface.save_session('bench-read', session_data, time.time() + 3600)
+
+    return [
+        ('get_user', lambda: DBInterface.get_user(username, BENCH_PASSWORD)),
+        ('get_tokens', lambda: DBInterface.get_tokens(user_id)),
+        ('deposit_tokens', lambda: DBInterface.deposit_tokens(user_id, {
+            'access_token': 'a', 'access_token_timestamp': 0, 'refresh_token': 'r', 'refresh_token_timestamp': 0})),
+        ('update_location', lambda: DBInterface.update_location(user_id, '70100123', 'FRED', '1 Main St')),
+        ('get_user_prods', lambda: DBInterface.get_user_prods(user_id)),
+        ('get_product_page', lambda: DBInterface.get_product_page(user_id, rng.choice(productIds), 100)),
+        ('get_user_imgurls', lambda: DBInterface.get_user_imgurls(user_id)),
+        ('get_imgurls', lambda: DBInterface.get_imgurls(user_id, rng.choice(productIds))),
+        ('get_specific_prods', lambda: DBInterface.get_specific_prods(user_id, rng.sample(productIds, min(40, len(productIds))))),
+        ('edit_product', lambda: DBInterface.edit_product(user_id, rng.choice(products))),
+        ('add_product+delete_product', add_and_delete_product),
+        ('add_products+delete_product x100', add_and_delete_products),
+        ('get_user_recipes', lambda: DBInterface.get_user_recipes(user_id)),
+        ('get_recipe_page', lambda: DBInterface.get_recipe_page(user_id, rng.choice(recipe_ids), 100)),
+        ('update_recipe_text', lambda: DBInterface.update_recipe_text(user_id, rng.choice(recipe_ids), 'bench')),
+        ('new_ingredient+delete_ingredient', add_and_delete_ingredient),
+        ('new_ingredients+delete_ingredient x20', add_and_delete_ingredients),
+        ('get_library_version', lambda: DBInterface.get_library_version(user_id)),
+        ('get_changes', lambda: DBInterface.get_changes(user_id, 0)),
+        ('get_products_by_id', lambda: DBInterface.get_products_by_id(user_id, rng.sample(productIds, min(40, len(productIds))))),
+        ('get_recipes_by_id', lambda: DBInterface.get_recipes_by_id(user_id, rng.sample(recipe_ids, min(10, len(recipe_ids))))),
+        ('get_unit_translations', DBInterface.get_unit_translations),
+        ('get_units', DBInterface.get_units),
+        ('get_reference_version', DBInterface.get_reference_version),
+        ('get_cached_locations', lambda: DBInterface.get_cached_locations('99201', 60)),
+        ('get_session', lambda: DBInterface.get_session('bench-read')),
+        ('save_session+delete_session', save_and_delete_session),
+    ]
+
+
+def run_benchmarks(username: str, iterations: int, seed: int) -> dict:
+    """ Times every case for the given user. Returns {<case>: {<stat>: <ms>, ...}, ...} """
+    from webshopper.db import DBInterface
+    ret = DBInterface.get_user(username, BENCH_PASSWORD)
+    if ret[0] != 0:
+        raise click.ClickException(f'No bench user {username}. Run "flask bench seed" first.')
+    user_id: int = ret[1]['user']['user_id']
+    results: dict = {}
+    for name, case in benchmark_cases(username, user_id, random.Random(seed)):
+        case()  # warm up caches before timing
+        samples: list = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            case()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        results[name] = {
+            'iterations': iterations,
+            'mean_ms': sum(samples) / len(samples),
+            'p50_ms': percentile(samples, 50),
+            'p95_ms': percentile(samples, 95),
+            'p99_ms': percentile(samples, 99),
+            'max_ms': samples[-1],
+        }
+        DBInterface.close_db()
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> List[str]:
+    """ Cases whose p50 or p95 grew by more than threshold percent """
+    regressions: list = []
+    for name, stats in current.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for stat in ('p50_ms', 'p95_ms'):
+            if old[stat] > 0 and (stats[stat] - old[stat]) / old[stat] * 100 > threshold:
+                regressions.append(f'{name} {stat}: {old[stat]:.3f} -> {stats[stat]:.3f}')
+    return regressions
+
+
+@click.group('bench')
+def bench_command():
+    """ DBInterface benchmarks over a synthetic database """
+
+
+@bench_command.command('seed')
+@click.option('--database', required=True, help='Path of the sqlite file to create')
+@click.option('--users', default=50, show_default=True)
+@click.option('--products', 'max_products', default=10000, show_default=True,
+              help='Products of the largest tenant')
+@click.option('--recipes', 'max_recipes', default=1000, show_default=True,
+              help='Recipes of the largest tenant')
+@click.option('--ingredients', default=20, show_default=True, help='Ingredients per recipe')
+@click.option('--seed', default=0, show_default=True)
+def seed_command(database, users, max_products, max_recipes, ingredients, seed):
+    """ Create a database with a skewed synthetic tenant distribution """
+    from webshopper import create_app
+    from webshopper.db import init_db
+    if os.path.exists(database):
+        raise click.ClickException(f'{database} already exists')
+    app = create_app({'DATABASE': database, 'TOKEN_PROACTIVE_REFRESH': False})
+    with app.app_context():
+        init_db()
+        totals = seed_database(users, max_products, max_recipes, ingredients, seed)
+    click.echo(f'Seeded {database}: {totals}')
+
+
+@bench_command.command('run')
+@click.option('--database', required=True, help='Database created by "flask bench seed"')
+@click.option('--user', 'username', default='bench0', show_default=True,
+              help='bench0 is the largest tenant')
+@click.option('--iterations', default=50, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', default=None, help='Write results as a JSON baseline')
+@click.option('--baseline', default=None, help='JSON baseline to diff against')
+@click.option('--threshold', default=10.0, show_default=True,
+              help='Percent slowdown in p50/p95 that counts as a regression')
+def run_command(database, username, iterations, seed, output, baseline, threshold):
+    """ Time every DBInterface method and report p50/p95/p99 """
+    from webshopper import create_app
+    app = create_app({'DATABASE': database, 'TOKEN_PROACTIVE_REFRESH': False})
+    with app.app_context():
+        results = run_benchmarks(username, iterations, seed)
+    click.echo(f"{'case':<34}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in results.items():
+        click.echo(f"{name:<34}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}"
+                   f"{stats['p99_ms']:>10.3f}{stats['max_ms']:>10.3f}")
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'created': datetime.datetime.now().isoformat(),
+                       'database': database,
+                       'user': username,
+                       'iterations': iterations,
+                       'results': results}, f, indent=2)
+        click.echo(f'Wrote {output}')
+    if baseline is not None:
+        with open(baseline) as f:
+            regressions = compare(json.load(f)['results'], results, threshold)
+        for regression in regressions:
+            click.echo(f'REGRESSION {regression}', err=True)
+        if regressions:
+            raise click.ClickException(f'{len(regressions)} regressions against {baseline}')
+        click.echo(f'No regressions against {baseline}')
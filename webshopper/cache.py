@@ -0,0 +1,91 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+from typing import Hashable
+from typing import Tuple
+
+
+class TTLCache:
+    """
+        Thread-safe, size-bounded LRU cache with two ages per entry.
+
+        An entry is 'fresh' for `ttl` seconds after it is stored and 'stale' for a further
+        `stale_ttl` seconds, after which it is dropped. Stale entries are still served so the
+        caller can answer immediately and revalidate in the background (stale-while-revalidate).
+        begin_refresh/end_refresh make sure only one revalidation per key is in flight.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0):
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.stale_ttl: float = stale_ttl
+        self._entries: OrderedDict = OrderedDict()  # {<key>: (<value>, <stored_at>)}
+        self._refreshing: set = set()
+        self._lock: threading.Lock = threading.Lock()
+        self.hits: int = 0
+        self.stale_hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+
+    def get(self, key: Hashable) -> Tuple[str, Any]:
+        """ Returns (state, value) where state is 'fresh', 'stale' or 'miss' """
+        now: float = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return 'miss', None
+            value, stored_at = entry
+            age: float = now - stored_at
+            if age >= self.ttl + self.stale_ttl:
+                del self._entries[key]
+                self.misses += 1
+                return 'miss', None
+            self._entries.move_to_end(key)
+            if age >= self.ttl:
+                self.stale_hits += 1
+                return 'stale', value
+            self.hits += 1
+            return 'fresh', value
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def begin_refresh(self, key: Hashable) -> bool:
+        """ True if the caller won the right to revalidate key. Must be paired with end_refresh """
+        with self._lock:
+            if key in self._refreshing:
+                return False
+            self._refreshing.add(key)
+            return True
+
+    def end_refresh(self, key: Hashable):
+        with self._lock:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
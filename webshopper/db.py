@@ -1,5 +1,11 @@
+import os
+import shutil
 import sqlite3
 import json
+import logging
+import tempfile
+import threading
+import time
 from typing import Tuple
 from typing import List
 
@@ -8,39 +14,96 @@ from flask import current_app, g
 from flask.cli import with_appcontext
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from webshopper.metrics import Metrics, observe_query
+
+logger = logging.getLogger(__name__)
+
+# Bound parameters per IN (...) list, under sqlite's historical 999 variable limit
+SQL_VARIABLE_CHUNK = 500
+
+PRODUCT_INSERT = """ INSERT INTO products
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 """
+IMGURL_INSERT = """ INSERT INTO products_imgurls
+                    VALUES (?, ?, ?, ?)
+                """
+
+
+class FetchedCursor:
+    """ Stands in for a cursor whose rows were read up front so they could be timed and counted.
+        Only used while metrics are enabled.
+    """
+
+    def __init__(self, cursor: sqlite3.Cursor):
+        self.rows: list = cursor.fetchall()
+        self.lastrowid: int = cursor.lastrowid
+        self.rowcount: int = cursor.rowcount
+        self.description = cursor.description
+        self._position: int = 0
+
+    def fetchone(self):
+        if self._position >= len(self.rows):
+            return None
+        self._position += 1
+        return self.rows[self._position - 1]
+
+    def fetchall(self) -> list:
+        rows: list = self.rows[self._position:]
+        self._position = len(self.rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
 
 class DBInterface:
     """ Static class """
+    # Connections are reused for the life of the thread: {'pid': <>, <database path>: Connection}
+    _local: threading.local = threading.local()
 
     @staticmethod
     def _execute_query(sql_string: str
                        , parameters: tuple = None
-                       , selection: bool = False) -> Tuple[int, dict]:
+                       , selection: bool = False
+                       , *
+                       , name: str) -> Tuple[int, dict]:
         """ selection: returns cursor after executing query
+            name: the DBInterface method running it, the label for metrics and logs
         """
         db: sqlite3.Connection = DBInterface.get_db()
         cursor: sqlite3.Cursor = db.cursor()
-        cursor.execute('PRAGMA foreign_keys = 1')  # Enforce foreign key constraints per connection
+        start: float = time.perf_counter() if Metrics.enabled else 0
         try:
             if parameters is None:
                 cursor.execute(sql_string)
-                db.commit()
             else:
                 cursor.execute(sql_string, parameters)
+            # Reads never open a transaction, so only writes pay for a commit
+            if db.in_transaction:
                 db.commit()
+            if Metrics.enabled:
+                # sqlite does most of the work while rows are fetched, so fetch here to time it
+                cursor = FetchedCursor(cursor)
+                observe_query(name, start,
+                              len(cursor.rows) if cursor.rows else max(cursor.rowcount, 0))
             if selection:
                 return 0, {'cursor': cursor}
             else:
                 return 0, {}
         except sqlite3.Error as e:
+            if db.in_transaction:
+                db.rollback()
+            logger.warning('%s failed: %s', name, e)
             return -1, {'error': e}
 
     @staticmethod
     def close_db(e=None):
-        """ Runs on teardown """
+        """ Runs on teardown. The connection stays open for the thread's next request,
+            so anything a failed request left uncommitted is rolled back here.
+        """
         db = g.pop('db', None)
-        if db is not None:
-            db.close()
+        if db is not None and db.in_transaction:
+            db.rollback()
 
     @staticmethod
     def get_db() -> sqlite3.Connection:
@@ -50,20 +113,40 @@ class DBInterface:
             Helper for all db functions
         """
         if 'db' not in g:
-            g.db = sqlite3.connect(
-                current_app.config['DATABASE'],
-                detect_types=sqlite3.PARSE_DECLTYPES
-            )
-            g.db.row_factory = sqlite3.Row
+            database: str = current_app.config['DATABASE']
+            connections: dict = getattr(DBInterface._local, 'connections', None)
+            if connections is None or connections['pid'] != os.getpid():
+                # First use on this thread, or a forked child that must not share the parent's handles
+                connections = {'pid': os.getpid()}
+                DBInterface._local.connections = connections
+            if database not in connections:
+                connections[database] = DBInterface._connect(database)
+            g.db = connections[database]
         return g.db
 
+    @staticmethod
+    def _connect(database: str) -> sqlite3.Connection:
+        """ Opens a connection and applies the per-connection PRAGMAs once """
+        config = current_app.config
+        db: sqlite3.Connection = sqlite3.connect(
+            database,
+            detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA foreign_keys = 1')  # Enforce foreign key constraints per connection
+        db.execute(f"PRAGMA journal_mode = {config['DB_JOURNAL_MODE']}")
+        db.execute(f"PRAGMA synchronous = {config['DB_SYNCHRONOUS']}")
+        db.execute(f"PRAGMA mmap_size = {int(config['DB_MMAP_SIZE'])}")
+        db.execute(f"PRAGMA cache_size = {int(config['DB_CACHE_SIZE'])}")
+        return db
+
     @staticmethod
     def new_user(username: str, password) -> Tuple[int, dict]:
         query = """ INSERT INTO users (username, password_hash)
                     VALUES (?, ?)
                 """
         ret = DBInterface._execute_query(query,
-                                         (username, generate_password_hash(password)))
+                                         (username, generate_password_hash(password)), name='new_user')
         if ret[0] != 0:
             err: sqlite3.Error = ret[1]['error']
             if err is sqlite3.IntegrityError:
@@ -80,7 +163,7 @@ class DBInterface:
                     FROM users
                     WHERE username = ?
                 """
-        ret = DBInterface._execute_query(query, (username,), selection=True)
+        ret = DBInterface._execute_query(query, (username,), selection=True, name='get_user')
         if ret[0] != 0:
             return -1, {'error': str(ret[1])}
         user: sqlite3.Row = ret[1]['cursor'].fetchone()
@@ -104,11 +187,29 @@ class DBInterface:
                                                  , token_dict['access_token_timestamp']
                                                  , token_dict['refresh_token']
                                                  , token_dict['refresh_token_timestamp']
-                                                 , user_id))
+                                                 , user_id), name='deposit_tokens')
         if ret[0] != 0:
             return -1, {'error': str(ret[1])}
         return 0, {}
 
+    @staticmethod
+    def get_tokens(user_id: int) -> Tuple[int, dict]:
+        """ Returns the user's stored token_dict as written by deposit_tokens """
+        query = """ SELECT access_token
+                          ,access_token_timestamp
+                          ,refresh_token
+                          ,refresh_token_timestamp
+                    FROM users
+                    WHERE user_id = ?
+                """
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_tokens')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        row = ret[1]['cursor'].fetchone()
+        if row is None:
+            return -1, {'error': f'No user with id {user_id}'}
+        return 0, {'tokens': dict(row)}
+
     @staticmethod
     def update_location(user_id: int, locationId: str,
                         location_chain: str, location_address: str):
@@ -122,7 +223,7 @@ class DBInterface:
         ret = DBInterface._execute_query(query, (locationId,
                                                  location_chain,
                                                  location_address,
-                                                 user_id))
+                                                 user_id), name='update_location')
         if ret[0] != 0:
             return -1, ret
         return 0, {}
@@ -150,45 +251,105 @@ class DBInterface:
             'alternateSPC: <>,
             'alternateSU': <>}
         """
+        start: float = time.perf_counter() if Metrics.enabled else 0
         db: sqlite3.Connection = DBInterface.get_db()
         crsr: sqlite3.Cursor = db.cursor()
-        product_query = """ INSERT INTO products
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                        """
         try:
-            crsr.execute(product_query, (user_id,
-                                         new_product['productId'],
-                                         new_product['upc'],
-                                         new_product['description'],
-                                         float(new_product['servingSize']),
-                                         float(new_product['servingsPerContainer']),
-                                         new_product['servingUnit'],
-                                         new_product['unitType'],
-                                         new_product['total_container_quantity'],
-                                         new_product['total_quantity_unit'],
-                                         new_product['includeAlternate'],
-                                         float(new_product['alternateSS']),
-                                         float(new_product['alternateSPC']),
-                                         new_product['alternateSU']))
+            crsr.execute(PRODUCT_INSERT, DBInterface._product_row(user_id, new_product))
         except sqlite3.Error as e:
             return -1, {'error': str(e)}
 
-        url_query = """ INSERT INTO products_imgurls
-                        VALUES (?, ?, ?, ?)
-                    """
         urls: list = new_product['image_urls']
         for url in urls:
             try:
-                crsr.execute(url_query, (user_id,
-                                         new_product['productId'],
-                                         url['perspective'],
-                                         url['url']))
+                crsr.execute(IMGURL_INSERT, (user_id,
+                                             new_product['productId'],
+                                             url['perspective'],
+                                             url['url']))
             except sqlite3.Error as e:
                 return -1, {'error': str(e)}
         # Successfully inserted all values
         db.commit()
+        if Metrics.enabled:
+            observe_query('add_product', start, 1 + len(urls))
         return 0, {}
 
+    @staticmethod
+    def add_products(user_id: int, new_products: List[dict]) -> Tuple[int, dict]:
+        """
+            Bulk add_product. Each product must already carry total_container_quantity and
+            total_quantity_unit. Products that are already saved, repeat an earlier entry of
+            the batch, or have unusable values are skipped and reported; the rest go in with
+            one executemany per table in a single transaction.
+
+            Returns {'added': [<productId>, ...],
+                     'failed': {<productId>: <reason>, ...}}
+        """
+        start: float = time.perf_counter() if Metrics.enabled else 0
+        db: sqlite3.Connection = DBInterface.get_db()
+        productIds: list = [product['productId'] for product in new_products]
+        existing: set = set()
+        try:
+            for chunk_start in range(0, len(productIds), SQL_VARIABLE_CHUNK):
+                chunk: list = productIds[chunk_start:chunk_start + SQL_VARIABLE_CHUNK]
+                query = f""" SELECT productId
+                             FROM products
+                             WHERE user_id = ?
+                                   AND productId IN ({', '.join('?' * len(chunk))})
+                         """
+                existing.update(row['productId'] for row in db.execute(query, (user_id, *chunk)))
+        except sqlite3.Error as e:
+            return -1, {'error': str(e)}
+        added: list = []
+        failed: dict = {}
+        product_rows: list = []
+        url_rows: list = []
+        for product in new_products:
+            productId: str = product['productId']
+            if productId in existing:
+                failed[productId] = 'product already saved'
+                continue
+            try:
+                product_row: tuple = DBInterface._product_row(user_id, product)
+                urls: set = {(url['perspective'], url['url']) for url in product['image_urls']}
+            except (KeyError, TypeError, ValueError) as e:
+                failed[productId] = f'invalid product: {e!r}'
+                continue
+            existing.add(productId)
+            added.append(productId)
+            product_rows.append(product_row)
+            url_rows.extend((user_id, productId, perspective, url) for perspective, url in urls)
+        try:
+            db.executemany(PRODUCT_INSERT, product_rows)
+            db.executemany(IMGURL_INSERT, url_rows)
+            db.commit()
+        except sqlite3.Error as e:
+            if db.in_transaction:
+                db.rollback()
+            logger.warning('add_products failed: %s', e, extra={'user_id': user_id})
+            return -1, {'error': str(e)}
+        if Metrics.enabled:
+            observe_query('add_products', start, len(product_rows) + len(url_rows))
+        return 0, {'added': added, 'failed': failed}
+
+    @staticmethod
+    def _product_row(user_id: int, product: dict) -> tuple:
+        """ products table row for a product dictionary as documented in add_product """
+        return (user_id,
+                product['productId'],
+                product['upc'],
+                product['description'],
+                float(product['servingSize']),
+                float(product['servingsPerContainer']),
+                product['servingUnit'],
+                product['unitType'],
+                product['total_container_quantity'],
+                product['total_quantity_unit'],
+                product['includeAlternate'],
+                float(product['alternateSS']),
+                float(product['alternateSPC']),
+                product['alternateSU'])
+
     @staticmethod
     def get_specific_prods(user_id: int, productIds: list) -> Tuple[int, dict]:
         """
@@ -207,7 +368,7 @@ class DBInterface:
                     where user_id = ?
                           AND productId in 
                 """ + ids_as_string
-        ret = DBInterface._execute_query(query, (user_id,), selection=True)
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_specific_prods')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         crsr: sqlite3.Cursor = ret[1]['cursor']
@@ -237,11 +398,11 @@ class DBInterface:
     @staticmethod
     def get_user_prods(user_id: int) -> Tuple[int, dict]:
         """
-            Pulls from products table. Calls helper function to pull
-            image urls from products_imgurls table.
+            Pulls from products table, then pulls every image url the user has
+            from products_imgurls in a single query and groups them by productId.
+            Two queries total regardless of library size.
 
-            Failure by get_imgurls helper function results in total failure
-            of this function call.
+            Failure of either query results in total failure of this function call.
 
         :param user_id:
         :return:  On success the results value will be a list of product dictionaries
@@ -265,43 +426,115 @@ class DBInterface:
                     FROM products 
                     WHERE products.user_id = ?
                 """
-        ret = DBInterface._execute_query(query, (user_id,), selection=True)
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_user_prods')
         if ret[0] != 0:
             return ret
         cursor: sqlite3.Cursor = ret[1]['cursor']
         ret_rows: List[dict] = cursor.fetchall()
+        # Retrieving every img_url for the user at once
+        ret = DBInterface.get_user_imgurls(user_id)
+        if ret[0] != 0:
+            return ret
+        urls_by_product: dict = ret[1]['urls']
         # Building return list
-        products: list = []
-        for row in ret_rows:
-            prod_dict = {
-                'productId': row['productId'],
-                'upc': row['upc'],
-                'description': row['description'],
-                'image_urls': 'PLACEHOLDER',
-                'servingSize': row['serving_size'],
-                'servingUnit': row['serving_unit'],
-                'servingsPerContainer': row['servings_per_container'],
-                'unitType': row['unit_type'],
-                'total_container_quantity': row['total_container_quantity'],
-                'total_quantity_unit': row['total_quantity_unit'],
-                'includeAlternate': row['include_alternate'],
-                'alternateSS': row['alternate_ss'],
-                'alternateSPC': row['alternate_spc'],
-                'alternateSU': row['alternate_su']
-            }
-            # Retrieving the img_urls
-            ret = DBInterface.get_imgurls(user_id, prod_dict['productId'])
-            if ret[0] != 0:
-                return ret
-            prod_dict['image_urls'] = ret[1]['urls']
-            products.append(prod_dict)
+        products: list = [DBInterface._product_dict(row, urls_by_product.get(row['productId'], []))
+                          for row in ret_rows]
         return 0, {'products': products}
 
+    @staticmethod
+    def get_product_page(user_id: int, after: str, limit: int) -> Tuple[int, dict]:
+        """
+            Keyset page of get_user_prods: up to limit products with productId > after, in
+            productId order. after=None starts at the beginning. Both queries are range scans
+            of the primary keys, so every page costs the same however deep it is.
+
+            Returns {'products': [<product dict>, ...], 'last': <productId of the final product,
+            or None when there are no further pages>}
+        """
+        query = """ SELECT *
+                    FROM products
+                    WHERE user_id = ?
+                          AND productId > ?
+                    ORDER BY productId
+                    LIMIT ?
+                """
+        ret = DBInterface._execute_query(query, (user_id, after or '', limit + 1),
+                                         selection=True, name='get_product_page')
+        if ret[0] != 0:
+            return ret
+        rows: list = ret[1]['cursor'].fetchall()
+        more: bool = len(rows) > limit
+        rows = rows[:limit]
+        if not rows:
+            return 0, {'products': [], 'last': None}
+        query = """ SELECT productId, perspective, url
+                    FROM products_imgurls
+                    WHERE user_id = ?
+                          AND productId > ?
+                          AND productId <= ?
+                """
+        ret = DBInterface._execute_query(query, (user_id, after or '', rows[-1]['productId']),
+                                         selection=True, name='get_product_page')
+        if ret[0] != 0:
+            return ret
+        urls: dict = {}
+        for row in ret[1]['cursor']:
+            urls.setdefault(row['productId'], []).append({'perspective': row['perspective'], 'url': row['url']})
+        products: list = [DBInterface._product_dict(row, urls.get(row['productId'], [])) for row in rows]
+        return 0, {'products': products, 'last': rows[-1]['productId'] if more else None}
+
+    @staticmethod
+    def _product_dict(row: sqlite3.Row, image_urls: list) -> dict:
+        """ products row -> the product dictionary described in get_user_prods """
+        return {
+            'productId': row['productId'],
+            'upc': row['upc'],
+            'description': row['description'],
+            'image_urls': image_urls,
+            'servingSize': row['serving_size'],
+            'servingUnit': row['serving_unit'],
+            'servingsPerContainer': row['servings_per_container'],
+            'unitType': row['unit_type'],
+            'total_container_quantity': row['total_container_quantity'],
+            'total_quantity_unit': row['total_quantity_unit'],
+            'includeAlternate': row['include_alternate'],
+            'alternateSS': row['alternate_ss'],
+            'alternateSPC': row['alternate_spc'],
+            'alternateSU': row['alternate_su']
+        }
+
+    @staticmethod
+    def get_user_imgurls(user_id: int) -> Tuple[int, dict]:
+        """
+            Returns every image url belonging to the user grouped on productId
+            {<productId>: [{'perspective': <>, 'url': <>}, ...], ...}
+            Intended as a helper function for get_user_prods.
+        """
+        query = """ SELECT productId, perspective, url
+                    FROM products_imgurls
+                    WHERE user_id = ?
+                """
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_user_imgurls')
+        if ret[0] != 0:
+            return ret
+        cursor: sqlite3.Cursor = ret[1]['cursor']
+        urls: dict = {}
+        for row in cursor:
+            tmp_dict = {
+                'perspective': row['perspective'],
+                'url': row['url']
+            }
+            if row['productId'] in urls:
+                urls[row['productId']].append(tmp_dict)
+            else:
+                urls[row['productId']] = [tmp_dict]
+        return 0, {'urls': urls}
+
     @staticmethod
     def get_imgurls(user_id: int, productId: str) -> Tuple[int, dict]:
         """
             Returns a [{'perspective': <>, 'url': <>}, ...]
-            Intended as a helper function for get_user_prods.
+            for a single product. get_user_prods uses get_user_imgurls instead.
         """
         query = """  SELECT *
                     FROM products p, products_imgurls pi
@@ -310,7 +543,7 @@ class DBInterface:
                          AND p.user_id = ?
                          and p.productId = ?
                 """
-        ret = DBInterface._execute_query(query, (user_id, productId), selection=True)
+        ret = DBInterface._execute_query(query, (user_id, productId), selection=True, name='get_imgurls')
         if ret[0] != 0:
             return ret
         cursor: sqlite3.Cursor = ret[1]['cursor']
@@ -356,7 +589,7 @@ class DBInterface:
                                                  float(edited_product['alternateSPC']),
                                                  edited_product['alternateSU'],
                                                  user_id,
-                                                 edited_product['productId']))
+                                                 edited_product['productId']), name='edit_product')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         return 0, {}
@@ -365,8 +598,12 @@ class DBInterface:
     def delete_product(user_id: int, productId: str) -> Tuple[int, dict]:
         """  Requires two calls, first deleting the entries in 'products_imgurls'
             table before the target entries can be deleted from 'products'
+
+            Products that ingredients still point at are not deleted. The error then carries
+            'recipes': [{'recipe_id': <>, 'recipe_name': <>}, ...] listing where they are used.
         """
 
+        start: float = time.perf_counter() if Metrics.enabled else 0
         db: sqlite3.Connection = DBInterface.get_db()
         crsr: sqlite3.Cursor = db.cursor()
 
@@ -377,24 +614,54 @@ class DBInterface:
         try:
             crsr.execute(query, (user_id, productId))
         except sqlite3.Error as e:
+            db.rollback()
             return -1, {'error': str(e)}
+        rows: int = crsr.rowcount
         query = """ DELETE FROM products
                     WHERE user_id = ?
                           AND productId =?
                 """
         try:
             crsr.execute(query, (user_id, productId))
+        except sqlite3.IntegrityError:
+            # Foreign key from ingredients. Keeps the image urls deleted above too.
+            db.rollback()
+            ret = DBInterface._recipes_using(user_id, productId)
+            if ret[0] != 0:
+                return ret
+            names: str = ', '.join(recipe['recipe_name'] for recipe in ret[1]['recipes'])
+            return -1, {'error': f'product is used by recipe(s) {names}', 'recipes': ret[1]['recipes']}
         except sqlite3.Error as e:
+            db.rollback()
             return -1, {'error': str(e)}
         db.commit()
+        if Metrics.enabled:
+            observe_query('delete_product', start, rows + crsr.rowcount)
         return 0, {}
 
+    @staticmethod
+    def _recipes_using(user_id: int, productId: str) -> Tuple[int, dict]:
+        """ Returns {'recipes': [{'recipe_id': <>, 'recipe_name': <>}, ...]} with an ingredient on the product """
+        query = """ SELECT DISTINCT r.recipe_id, r.recipe_name
+                    FROM ingredients AS i
+                    JOIN recipes AS r ON r.recipe_id = i.recipe_id
+                    WHERE i.user_id = ?
+                          AND i.productId = ?
+                    ORDER BY r.recipe_id
+                """
+        ret = DBInterface._execute_query(query, (user_id, productId), selection=True, name='_recipes_using')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {'recipes': [{'recipe_id': row['recipe_id'], 'recipe_name': row['recipe_name']}
+                               for row in ret[1]['cursor']]}
+
     @staticmethod
     def new_recipe(user_id: int, recipe_name: str) -> Tuple[int, dict]:
         """
             Need to return the last_rowid of inserted value.
 
         """
+        start: float = time.perf_counter() if Metrics.enabled else 0
         conn: sqlite3.Connection = DBInterface.get_db()
         crsr: sqlite3.Cursor = conn.cursor()
         query = """ INSERT INTO recipes (user_id, recipe_name)
@@ -406,8 +673,10 @@ class DBInterface:
         except sqlite3.Error as e:
             return -1, {'error': str(e)}
         # Success
+        if Metrics.enabled:
+            observe_query('new_recipe', start, 1)
         last_rowid: int = crsr.lastrowid
-        print(f'Here is the last_rowid: {last_rowid}')
+        logger.debug('new recipe %s', last_rowid, extra={'user_id': user_id})
         return 0, {'recipe_id': last_rowid}
 
     @staticmethod
@@ -417,7 +686,7 @@ class DBInterface:
                     WHERE user_id = ?
                           AND recipe_id = ?
                 """
-        ret = DBInterface._execute_query(query, (recipe_text, user_id, recipe_id))
+        ret = DBInterface._execute_query(query, (recipe_text, user_id, recipe_id), name='update_recipe_text')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         return ret
@@ -432,13 +701,57 @@ class DBInterface:
                      WHERE r.user_id = ?
                      ORDER BY r.recipe_id
                 """
-        ret = DBInterface._execute_query(query, (user_id,), selection=True)
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_user_recipes')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         crsr: sqlite3.Cursor = ret[1]['cursor']
-        rows = crsr.fetchall()
+        return 0, {'recipes': DBInterface._group_recipes(crsr.fetchall())}
+
+    @staticmethod
+    def get_recipe_page(user_id: int, after: int, limit: int) -> Tuple[int, dict]:
+        """
+            Keyset page of get_user_recipes: up to limit recipes with recipe_id > after, in
+            recipe_id order, with their ingredients. after=None starts at the beginning.
+
+            Returns {'recipes': {<recipe_id>: <recipe dict>, ...}, 'last': <recipe_id of the
+            final recipe, or None when there are no further pages>}
+        """
+        query = """ SELECT recipe_id
+                    FROM recipes
+                    WHERE user_id = ?
+                          AND recipe_id > ?
+                    ORDER BY recipe_id
+                    LIMIT ?
+                """
+        ret = DBInterface._execute_query(query, (user_id, after or 0, limit + 1),
+                                         selection=True, name='get_recipe_page')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        recipe_ids: list = [row['recipe_id'] for row in ret[1]['cursor'].fetchall()]
+        more: bool = len(recipe_ids) > limit
+        recipe_ids = recipe_ids[:limit]
+        if not recipe_ids:
+            return 0, {'recipes': {}, 'last': None}
+        query = """  SELECT *
+                     FROM recipes r LEFT JOIN ingredients i
+                     ON r.recipe_id = i.recipe_id
+                     WHERE r.user_id = ?
+                           AND r.recipe_id > ?
+                           AND r.recipe_id <= ?
+                     ORDER BY r.recipe_id
+                """
+        ret = DBInterface._execute_query(query, (user_id, after or 0, recipe_ids[-1]),
+                                         selection=True, name='get_recipe_page')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        recipes: dict = DBInterface._group_recipes(ret[1]['cursor'].fetchall())
+        return 0, {'recipes': recipes, 'last': recipe_ids[-1] if more else None}
+
+    @staticmethod
+    def _group_recipes(rows: list) -> dict:
+        """ recipes LEFT JOIN ingredients rows, ordered by recipe_id -> {<recipe_id>: <recipe dict>, ...} """
         if len(rows) == 0:
-            return 0, {'recipes': {}}
+            return {}
 
         # Packaging recipes
         # Each recipe is a dictionary, and each ingredient set is a dictionary keyed on
@@ -476,7 +789,7 @@ class DBInterface:
             tmp_rec['ingredients'][ingredient_id] = ingredient
         # Finalize last recipe
         recipes[curr_rec_id] = tmp_rec
-        return 0, {'recipes': recipes}
+        return recipes
 
     @staticmethod
     def new_ingredient(user_id: int, recipe_id: int, productId: str,
@@ -501,29 +814,173 @@ class DBInterface:
                                                  ingredient_quantity,
                                                  ingredient_unit,
                                                  product_description),
-                                         selection=True)
+                                         selection=True, name='new_ingredient')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         crsr: sqlite3.Cursor = ret[1]['cursor']
         last_rowid = crsr.lastrowid
         return 0, {'ingredient_id': last_rowid}
 
+    @staticmethod
+    def new_ingredients(user_id: int, recipe_id: int, ingredients: List[dict]) -> Tuple[int, dict]:
+        """
+            Adds every ingredient to one of the user's recipes in a single transaction, or
+            none of them. Each ingredient is {'productId', 'ingredient_name',
+            'ingredient_quantity', 'ingredient_unit', 'product_description'}.
+
+            Returns {'ingredient_ids': [<ingredient_id>, ...]} in the order given. On failure
+            'index' is the position of the offending ingredient, when there is one.
+        """
+        start: float = time.perf_counter() if Metrics.enabled else 0
+        db: sqlite3.Connection = DBInterface.get_db()
+        crsr: sqlite3.Cursor = db.cursor()
+        query = """ SELECT 1
+                    FROM recipes
+                    WHERE recipe_id = ?
+                          AND user_id = ?
+                """
+        try:
+            if crsr.execute(query, (recipe_id, user_id)).fetchone() is None:
+                return -1, {'error': f'recipe {recipe_id} not found'}
+        except sqlite3.Error as e:
+            return -1, {'error': str(e)}
+        query = """ INSERT INTO ingredients (user_id,
+                                             recipe_id,
+                                             productId,
+                                             ingredient_name,
+                                             ingredient_quantity,
+                                             ingredient_unit,
+                                             product_description)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                """
+        ingredient_ids: list = []
+        for index, ingredient in enumerate(ingredients):
+            try:
+                crsr.execute(query, (user_id,
+                                     recipe_id,
+                                     ingredient['productId'],
+                                     ingredient['ingredient_name'],
+                                     ingredient['ingredient_quantity'],
+                                     ingredient['ingredient_unit'],
+                                     ingredient['product_description']))
+            except sqlite3.Error as e:
+                if db.in_transaction:
+                    db.rollback()
+                return -1, {'error': str(e), 'index': index}
+            ingredient_ids.append(crsr.lastrowid)
+        db.commit()
+        if Metrics.enabled:
+            observe_query('new_ingredients', start, len(ingredient_ids))
+        return 0, {'ingredient_ids': ingredient_ids}
+
     @staticmethod
     def delete_ingredient(ingredient_id: str):
         query = """ DELETE FROM ingredients
                     WHERE ingredient_id = ?
                 """
-        ret = DBInterface._execute_query(query, (ingredient_id,))
+        ret = DBInterface._execute_query(query, (ingredient_id,), name='delete_ingredient')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         return ret
 
+    @staticmethod
+    def get_library_version(user_id: int) -> Tuple[int, dict]:
+        """ The user's latest change_log version, 0 for an empty library. Any product,
+            recipe or ingredient write raises it.
+        """
+        query = """ SELECT MAX(version) AS version
+                    FROM change_log
+                    WHERE user_id = ?
+                """
+        ret = DBInterface._execute_query(query, (user_id,), selection=True, name='get_library_version')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        row: sqlite3.Row = ret[1]['cursor'].fetchone()
+        return 0, {'version': row['version'] or 0}
+
+    @staticmethod
+    def get_changes(user_id: int, since: int) -> Tuple[int, dict]:
+        """
+            Entities written after version since, oldest first. Each entity appears once,
+            with its latest state.
+
+            Returns {'changes': [{'version': <int>, 'entity': <'product', 'recipe'>,
+                                  'entity_id': <productId or recipe_id>, 'deleted': <bool>}, ...]}
+        """
+        query = """ SELECT version, entity, entity_id, deleted
+                    FROM change_log
+                    WHERE user_id = ?
+                          AND version > ?
+                    ORDER BY version
+                """
+        ret = DBInterface._execute_query(query, (user_id, since), selection=True, name='get_changes')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        changes: list = []
+        for row in ret[1]['cursor']:
+            changes.append({'version': row['version'],
+                            'entity': row['entity'],
+                            'entity_id': int(row['entity_id']) if row['entity'] == 'recipe' else row['entity_id'],
+                            'deleted': bool(row['deleted'])})
+        return 0, {'changes': changes}
+
+    @staticmethod
+    def get_products_by_id(user_id: int, productIds: list) -> Tuple[int, dict]:
+        """ Full product dictionaries, image urls included, for the given productIds.
+            Returns {'products': [<product dict as in get_user_prods>, ...]}
+        """
+        products: list = []
+        for start in range(0, len(productIds), SQL_VARIABLE_CHUNK):
+            chunk: list = productIds[start:start + SQL_VARIABLE_CHUNK]
+            placeholders: str = ', '.join('?' * len(chunk))
+            query = f""" SELECT *
+                         FROM products
+                         WHERE user_id = ?
+                               AND productId IN ({placeholders})
+                     """
+            ret = DBInterface._execute_query(query, (user_id, *chunk), selection=True, name='get_products_by_id')
+            if ret[0] != 0:
+                return -1, {'error': str(ret[1]['error'])}
+            rows: list = ret[1]['cursor'].fetchall()
+            query = f""" SELECT productId, perspective, url
+                         FROM products_imgurls
+                         WHERE user_id = ?
+                               AND productId IN ({placeholders})
+                     """
+            ret = DBInterface._execute_query(query, (user_id, *chunk), selection=True, name='get_products_by_id')
+            if ret[0] != 0:
+                return -1, {'error': str(ret[1]['error'])}
+            urls: dict = {}
+            for row in ret[1]['cursor']:
+                urls.setdefault(row['productId'], []).append({'perspective': row['perspective'], 'url': row['url']})
+            products.extend(DBInterface._product_dict(row, urls.get(row['productId'], [])) for row in rows)
+        return 0, {'products': products}
+
+    @staticmethod
+    def get_recipes_by_id(user_id: int, recipe_ids: list) -> Tuple[int, dict]:
+        """ Returns {'recipes': {<recipe_id>: <recipe dict as in get_user_recipes>, ...}} """
+        recipes: dict = {}
+        for start in range(0, len(recipe_ids), SQL_VARIABLE_CHUNK):
+            chunk: list = recipe_ids[start:start + SQL_VARIABLE_CHUNK]
+            query = f"""  SELECT *
+                          FROM recipes r LEFT JOIN ingredients i
+                          ON r.recipe_id = i.recipe_id
+                          WHERE r.user_id = ?
+                                AND r.recipe_id IN ({', '.join('?' * len(chunk))})
+                          ORDER BY r.recipe_id
+                     """
+            ret = DBInterface._execute_query(query, (user_id, *chunk), selection=True, name='get_recipes_by_id')
+            if ret[0] != 0:
+                return -1, {'error': str(ret[1]['error'])}
+            recipes.update(DBInterface._group_recipes(ret[1]['cursor'].fetchall()))
+        return 0, {'recipes': recipes}
+
     @staticmethod
     def get_unit_translations() -> Tuple[int, dict]:
         query = """ SELECT * 
                     FROM unit_translations
                 """
-        ret = DBInterface._execute_query(query, selection=True)
+        ret = DBInterface._execute_query(query, selection=True, name='get_unit_translations')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         crsr: sqlite3.Cursor = ret[1]['cursor']
@@ -549,7 +1006,7 @@ class DBInterface:
         query = """ SELECT *
                     FROM units
                 """
-        ret = DBInterface._execute_query(query, selection=True)
+        ret = DBInterface._execute_query(query, selection=True, name='get_units')
         if ret[0] != 0:
             return -1, {'error': str(ret[1]['error'])}
         crsr: sqlite3.Cursor = ret[1]['cursor']
@@ -562,17 +1019,323 @@ class DBInterface:
                 unit_dict['volume'].append(row['unit'])
         return 0, {'unit_dict': unit_dict}
 
+    @staticmethod
+    def get_cached_locations(zipcode: str, max_age: float) -> Tuple[int, dict]:
+        """ Returns {'stores': [...]} for the zipcode, or {'stores': None} if it is
+            missing or older than max_age seconds.
+        """
+        query = """ SELECT stores
+                    FROM location_cache
+                    WHERE zipcode = ?
+                          AND fetched_at > ?
+                """
+        ret = DBInterface._execute_query(query, (zipcode, time.time() - max_age),
+                                         selection=True, name='get_cached_locations')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        row = ret[1]['cursor'].fetchone()
+        if row is None:
+            return 0, {'stores': None}
+        return 0, {'stores': json.loads(row['stores'])}
+
+    @staticmethod
+    def cache_locations(zipcode: str, stores: list) -> Tuple[int, dict]:
+        """ Inserts or replaces the trimmed store list for the zipcode """
+        query = """ INSERT OR REPLACE INTO location_cache (zipcode, stores, fetched_at)
+                    VALUES (?, ?, ?)
+                """
+        ret = DBInterface._execute_query(query, (zipcode, json.dumps(stores), time.time()), name='cache_locations')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {}
+
+    @staticmethod
+    def get_cached_zipcodes(max_age: float = None) -> Tuple[int, dict]:
+        """ Returns every cached zipcode, or only those older than max_age seconds """
+        query = """ SELECT zipcode
+                    FROM location_cache
+                    WHERE fetched_at <= ?
+                """
+        cutoff: float = float('inf') if max_age is None else time.time() - max_age
+        ret = DBInterface._execute_query(query, (cutoff,), selection=True, name='get_cached_zipcodes')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {'zipcodes': [row['zipcode'] for row in ret[1]['cursor']]}
+
+    @staticmethod
+    def purge_locations(zipcode: str = None, max_age: float = 0) -> Tuple[int, dict]:
+        """ Deletes cached store lists older than max_age seconds, optionally for one zipcode only """
+        query = """ DELETE FROM location_cache
+                    WHERE fetched_at <= ?
+                          AND (? IS NULL OR zipcode = ?)
+                """
+        ret = DBInterface._execute_query(query, (time.time() - max_age, zipcode, zipcode),
+                                         selection=True, name='purge_locations')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {'deleted': ret[1]['cursor'].rowcount}
+
+    @staticmethod
+    def get_reference_version() -> Tuple[int, dict]:
+        """ Returns the current version of the units/unit_translations tables """
+        query = """ SELECT version
+                    FROM reference_version
+                """
+        ret = DBInterface._execute_query(query, selection=True, name='get_reference_version')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        row = ret[1]['cursor'].fetchone()
+        if row is None:
+            return -1, {'error': 'reference_version table is empty'}
+        return 0, {'version': row['version']}
+
+    @staticmethod
+    def get_session(sid: str) -> Tuple[int, dict]:
+        """ Returns {'data': <session dict>, 'expires_at': <float>}, or {'data': None} if the
+            session is missing or expired.
+        """
+        query = """ SELECT data, expires_at
+                    FROM sessions
+                    WHERE sid = ?
+                          AND expires_at > ?
+                """
+        ret = DBInterface._execute_query(query, (sid, time.time()), selection=True, name='get_session')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        row = ret[1]['cursor'].fetchone()
+        if row is None:
+            return 0, {'data': None}
+        return 0, {'data': json.loads(row['data']), 'expires_at': row['expires_at']}
+
+    @staticmethod
+    def save_session(sid: str, data: dict, expires_at: float) -> Tuple[int, dict]:
+        query = """ INSERT OR REPLACE INTO sessions (sid, data, expires_at)
+                    VALUES (?, ?, ?)
+                """
+        ret = DBInterface._execute_query(query, (sid, json.dumps(data), expires_at), name='save_session')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {}
+
+    @staticmethod
+    def delete_session(sid: str) -> Tuple[int, dict]:
+        query = """ DELETE FROM sessions
+                    WHERE sid = ?
+                """
+        ret = DBInterface._execute_query(query, (sid,), name='delete_session')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {}
+
+    @staticmethod
+    def purge_sessions() -> Tuple[int, dict]:
+        """ Deletes expired sessions """
+        query = """ DELETE FROM sessions
+                    WHERE expires_at <= ?
+                """
+        ret = DBInterface._execute_query(query, (time.time(),), selection=True, name='purge_sessions')
+        if ret[0] != 0:
+            return -1, {'error': str(ret[1]['error'])}
+        return 0, {'deleted': ret[1]['cursor'].rowcount}
+
 
 # Auxiliary functions
 def init_db():
+    from webshopper.units import UnitCache
     db = DBInterface.get_db()
     with current_app.open_resource('schema.sql') as f:
         db.executescript(f.read().decode('utf8'))
+    # schema.sql is version 0. Migrations take it the rest of the way.
+    db.execute('PRAGMA user_version = 0')
+    migrate_db()
+    UnitCache.invalidate()
+
+
+def pending_migrations(current_version: int) -> List[Tuple[int, str]]:
+    """ [(<version>, <path>), ...] of migrations newer than current_version, in order.
+        Migration files are named <4 digit version>_<description>.sql
+    """
+    migrations_dir: str = os.path.join(current_app.root_path, 'migrations')
+    migrations: list = []
+    for filename in sorted(os.listdir(migrations_dir)):
+        if not filename.endswith('.sql'):
+            continue
+        version = int(filename.split('_', 1)[0])
+        if version > current_version:
+            migrations.append((version, os.path.join(migrations_dir, filename)))
+    return migrations
+
+
+def migrate_db() -> List[int]:
+    """ Applies pending migrations in place, each in its own transaction.
+        Returns the versions applied. The database version lives in PRAGMA user_version.
+
+        Each transaction is BEGIN IMMEDIATE and reads the version under that lock, so workers
+        starting at the same time apply every migration exactly once between them.
+    """
+    db = DBInterface.get_db()
+    applied: list = []
+    while True:
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            current_version: int = db.execute('PRAGMA user_version').fetchone()[0]
+            pending: list = pending_migrations(current_version)
+            if not pending:
+                db.rollback()
+                return applied
+            version, path = pending[0]
+            with open(path, encoding='utf8') as f:
+                for statement in _statements(f.read()):
+                    db.execute(statement)
+            db.execute(f'PRAGMA user_version = {version}')
+            db.commit()
+        except BaseException:
+            if db.in_transaction:
+                db.rollback()
+            raise
+        applied.append(version)
+
+
+def _statements(script: str) -> List[str]:
+    """ Splits a migration into statements. executescript would commit the open transaction. """
+    statements: list = []
+    statement: str = ''
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ''
+    return statements
+
+
+def migrate_on_start(app):
+    """ Brings an existing database up to date. A database that does not exist yet, or has
+        no tables, is left for init-db.
+    """
+    database: str = app.config['DATABASE']
+    if not app.config['DB_MIGRATE_ON_START'] or not os.path.exists(database):
+        return
+    with app.app_context():
+        db = DBInterface.get_db()
+        if db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone() is None:
+            return
+        applied = migrate_db()
+        if applied:
+            from webshopper.units import UnitCache
+            UnitCache.invalidate()
+            logger.info('applied migrations %s to %s', applied, database)
+
+
+# Tables that are always read whole, so a scan is expected
+FULL_READ_TABLES = ('units', 'unit_translations', 'reference_version')
+
+
+def check_query_plans() -> List[str]:
+    """ Runs every DBInterface method against a scratch copy of the schema and returns
+        a description of each statement whose plan scans a table, plus each foreign key
+        without an index on its child columns. An empty list means everything is indexed.
+    """
+    from webshopper import create_app
+    problems: list = []
+    scratch_dir: str = tempfile.mkdtemp()
+    scratch_db: str = os.path.join(scratch_dir, 'plans.sqlite')
+    app = create_app({'DATABASE': scratch_db,
+                      'TOKEN_PROACTIVE_REFRESH': False})
+    with app.app_context():
+        init_db()
+        db = DBInterface.get_db()
+        statements: list = []
+        db.set_trace_callback(statements.append)
+        try:
+            _exercise_db_interface()
+        finally:
+            db.set_trace_callback(None)
+        for statement in statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                continue
+            # Older sqlite3 modules trace the unexpanded statement. NULLs give the same plan shape.
+            params: tuple = (None,) * statement.count('?')
+            for row in db.execute('EXPLAIN QUERY PLAN ' + statement, params):
+                detail: str = row['detail']
+                if detail.startswith('SCAN ') and detail.split()[1] not in FULL_READ_TABLES:
+                    problems.append(f'{detail}: {" ".join(statement.split())}')
+        # Foreign key checks never show up in a query plan
+        tables = [row['name'] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        for table in tables:
+            foreign_keys: dict = {}
+            for fk in db.execute(f'PRAGMA foreign_key_list({table})'):
+                foreign_keys.setdefault(fk['id'], []).append(fk['from'])
+            index_prefixes: list = []
+            for index in db.execute(f'PRAGMA index_list({table})'):
+                index_prefixes.append([col['name'] for col in db.execute(f"PRAGMA index_info({index['name']})")])
+            for columns in foreign_keys.values():
+                if not any(set(prefix[:len(columns)]) == set(columns) for prefix in index_prefixes):
+                    problems.append(f'No index on foreign key {table}({", ".join(columns)})')
+    DBInterface._local.connections.pop(scratch_db).close()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    return problems
+
+
+def _exercise_db_interface():
+    """ Calls every DBInterface method once against a freshly initialized database """
+    product: dict = {
+        'productId': '0001', 'upc': '0001', 'description': 'plan check',
+        'image_urls': [{'perspective': 'front', 'url': 'http://example.com/front.jpg'}],
+        'servingSize': '1', 'servingsPerContainer': '2', 'servingUnit': 'oz', 'unitType': 'weight',
+        'total_container_quantity': 56.699, 'total_quantity_unit': 'gram', 'includeAlternate': 'false',
+        'alternateSS': '1', 'alternateSPC': '1', 'alternateSU': 'oz'
+    }
+    token_dict: dict = {'access_token': 'a', 'access_token_timestamp': 0,
+                        'refresh_token': 'r', 'refresh_token_timestamp': 0}
+    DBInterface.new_user('plan_check', 'plan_check')
+    user_id: int = DBInterface.get_user('plan_check', 'plan_check')[1]['user']['user_id']
+    DBInterface.deposit_tokens(user_id, token_dict)
+    DBInterface.get_tokens(user_id)
+    DBInterface.update_location(user_id, '70100123', 'FRED', '1 Main St')
+    DBInterface.add_product(user_id, product)
+    DBInterface.add_products(user_id, [dict(product, productId='0002'), product])
+    DBInterface.delete_product(user_id, '0002')
+    DBInterface.get_specific_prods(user_id, [product['productId']])
+    DBInterface.get_user_prods(user_id)
+    DBInterface.get_product_page(user_id, None, 10)
+    DBInterface.get_product_page(user_id, product['productId'], 10)
+    DBInterface.get_imgurls(user_id, product['productId'])
+    DBInterface.edit_product(user_id, product)
+    recipe_id: int = DBInterface.new_recipe(user_id, 'plan check')[1]['recipe_id']
+    DBInterface.update_recipe_text(user_id, recipe_id, 'text')
+    ingredient_id: int = DBInterface.new_ingredient(user_id, recipe_id, product['productId'], 'thing',
+                                                    1, 'oz', 'plan check')[1]['ingredient_id']
+    DBInterface.new_ingredients(user_id, recipe_id, [{'productId': product['productId'], 'ingredient_name': 'more',
+                                                      'ingredient_quantity': 2, 'ingredient_unit': 'oz',
+                                                      'product_description': 'plan check'}])
+    DBInterface.get_user_recipes(user_id)
+    DBInterface.get_library_version(user_id)
+    DBInterface.get_changes(user_id, 0)
+    DBInterface.get_products_by_id(user_id, [product['productId']])
+    DBInterface.get_recipes_by_id(user_id, [recipe_id])
+    DBInterface.get_recipe_page(user_id, None, 10)
+    DBInterface.get_recipe_page(user_id, recipe_id, 10)
+    DBInterface.delete_ingredient(ingredient_id)
+    DBInterface.delete_product(user_id, product['productId'])
+    DBInterface.get_unit_translations()
+    DBInterface.get_units()
+    DBInterface.get_reference_version()
+    DBInterface.cache_locations('99201', [])
+    DBInterface.get_cached_locations('99201', 60)
+    DBInterface.get_cached_zipcodes(60)
+    DBInterface.purge_locations('99201', 0)
+    DBInterface.save_session('plan_check', {'user_id': user_id}, time.time() + 60)
+    DBInterface.get_session('plan_check')
+    DBInterface.delete_session('plan_check')
+    DBInterface.purge_sessions()
 
 
 def init_app(app):
     app.teardown_appcontext(DBInterface.close_db)
+    migrate_on_start(app)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_db_command)
+    app.cli.add_command(check_query_plans_command)
 
 
 @click.command('init-db')
@@ -581,3 +1344,27 @@ def init_db_command():
     """ Clear the existing data and create new tables"""
     init_db()
     click.echo('Initialized the database')
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """ Apply pending schema migrations without touching existing data """
+    applied = migrate_db()
+    if not applied:
+        click.echo('Database is up to date')
+        return
+    from webshopper.units import UnitCache
+    UnitCache.invalidate()
+    click.echo(f'Applied migrations: {", ".join(str(version) for version in applied)}')
+
+
+@click.command('check-query-plans')
+def check_query_plans_command():
+    """ Fail if any DBInterface query scans a table or a foreign key is unindexed """
+    problems = check_query_plans()
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise click.ClickException(f'{len(problems)} unindexed queries')
+    click.echo('Every DBInterface query uses an index')
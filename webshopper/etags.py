@@ -0,0 +1,60 @@
+import functools
+import hashlib
+
+from webshopper.db import DBInterface
+
+from flask import Response, make_response, request, session
+
+
+def library_etag(user_id: int, version: int, scope: str) -> str:
+    """
+        Strong ETag for a response built from the user's library at the given change_log
+        version. scope separates responses that differ for the same version, e.g. each page
+        of GET /products. Returned quoted, ready for the ETag header.
+    """
+    digest: str = hashlib.blake2b(scope.encode(), digest_size=6).hexdigest()
+    return f'"{user_id}-{version}-{digest}"'
+
+
+def current_library_etag(scope: str):
+    """ Returns (<ETag>, <whether the request's If-None-Match already has it>), or (None, False)
+        when the version cannot be read, in which case the caller should just build the response.
+    """
+    ret = DBInterface.get_library_version(session['user_id'])
+    if ret[0] != 0:
+        return None, False
+    etag: str = library_etag(session['user_id'], ret[1]['version'], scope)
+    return etag, matches(etag)
+
+
+def matches(etag: str) -> bool:
+    """ Whether If-None-Match holds etag. Weak comparison, because compressed responses
+        carry the weak form of the same tag (see responses.compress_response).
+    """
+    return request.if_none_match.contains_weak(etag.strip('"'))
+
+
+def set_library_etag(resp: Response, etag: str) -> Response:
+    resp.headers['ETag'] = etag
+    # Per-user content: browsers may keep it but must revalidate, shared caches must not
+    resp.headers['Cache-Control'] = 'private, no-cache'
+    resp.vary.add('Cookie')
+    return resp
+
+
+def conditional_library(view):
+    """
+        For GET views whose response depends only on the user's library and the query string.
+        A client sending If-None-Match with the current ETag gets a 304 before the view
+        (and its queries) run. Apply after login_required.
+    """
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        etag, current = current_library_etag(request.full_path)
+        if current:
+            return set_library_etag(Response(status=304), etag)
+        resp: Response = make_response(view(**kwargs))
+        if etag is not None and resp.status_code == 200:
+            set_library_etag(resp, etag)
+        return resp
+    return wrapped_view
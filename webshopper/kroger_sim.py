@@ -0,0 +1,234 @@
+# Stand-in for the parts of the Kroger API that Communicator uses, for offline and load testing.
+#
+#   python -m webshopper.kroger_sim --port 5055 --latency lognormal:60,0.5 --error 429=0.05 --error 503=0.01
+#
+# then set KROGER_API_BASE = 'http://127.0.0.1:5055/v1/' in instance/config.py
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import Optional
+
+import click
+from flask import Flask, Response, jsonify, redirect, request
+
+DEFAULT_CONFIG = {
+    # '<kind>:<args>' with times in milliseconds, per endpoint or 'default'.
+    #   none | fixed:<ms> | uniform:<low>,<high> | lognormal:<median>,<sigma>
+    'SIM_LATENCY': {'default': 'none'},
+    # {<status code>: <probability>}. 429s carry a Retry-After header.
+    'SIM_ERROR_RATES': {},
+    'SIM_RETRY_AFTER': 1,
+    'SIM_TOKEN_TTL': 1800,  # Seconds an issued access token stays valid
+    'SIM_PRODUCT_TOTAL': 250,  # Matches reported for any search term
+    'SIM_SEED': None,
+}
+
+SIZES = ['thumbnail', 'small', 'medium', 'large', 'xlarge']
+PERSPECTIVES = ['front', 'back', 'left', 'right', 'top']
+CHAINS = ['FRED', 'KROGER', 'QFC', 'SHELL COMPANY']
+
+
+class SimState:
+    """ Tokens issued by one simulator process """
+
+    def __init__(self, seed: Optional[int]):
+        self.lock: threading.Lock = threading.Lock()
+        self.access_tokens: dict = {}  # {<token>: <expiry>}
+        self.refresh_tokens: set = set()
+        self.rng: random.Random = random.Random(seed)
+
+    def issue(self, ttl: float) -> dict:
+        access_token: str = secrets.token_urlsafe(24)
+        refresh_token: str = secrets.token_urlsafe(24)
+        with self.lock:
+            self.access_tokens[access_token] = time.time() + ttl
+            self.refresh_tokens.add(refresh_token)
+        return {'access_token': access_token, 'refresh_token': refresh_token,
+                'expires_in': ttl, 'token_type': 'bearer'}
+
+    def redeem_refresh(self, refresh_token: str) -> bool:
+        """ Refresh tokens are single use, like Kroger's """
+        with self.lock:
+            if refresh_token not in self.refresh_tokens:
+                return False
+            self.refresh_tokens.discard(refresh_token)
+            return True
+
+    def valid(self, access_token: str) -> bool:
+        with self.lock:
+            expiry = self.access_tokens.get(access_token)
+        return expiry is not None and expiry > time.time()
+
+    def roll(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def latency_ms(self, spec: str) -> float:
+        kind, _, args = spec.partition(':')
+        values = [float(arg) for arg in args.split(',')] if args else []
+        with self.lock:
+            if kind == 'fixed':
+                return values[0]
+            if kind == 'uniform':
+                return self.rng.uniform(values[0], values[1])
+            if kind == 'lognormal':
+                return values[0] * self.rng.lognormvariate(0, values[1])
+        return 0
+
+
+def create_sim_app(test_config: dict = None) -> Flask:
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    if test_config is not None:
+        app.config.update(test_config)
+    state = SimState(app.config['SIM_SEED'])
+
+    def simulate(endpoint: str) -> Optional[Response]:
+        """ Sleeps for the configured latency, then maybe returns an injected error """
+        latency: dict = app.config['SIM_LATENCY']
+        time.sleep(state.latency_ms(latency.get(endpoint, latency.get('default', 'none'))) / 1000)
+        roll: float = state.roll()
+        for status, probability in app.config['SIM_ERROR_RATES'].items():
+            if roll < probability:
+                resp = jsonify(errors={'reason': 'injected by kroger_sim', 'code': str(status)})
+                resp.status_code = int(status)
+                if int(status) == 429:
+                    resp.headers['Retry-After'] = str(app.config['SIM_RETRY_AFTER'])
+                return resp
+            roll -= probability
+        return None
+
+    def unauthorized() -> Optional[Response]:
+        header: str = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer ') or not state.valid(header[len('Bearer '):]):
+            resp = jsonify(error='invalid_token', error_description='The access token is invalid or has expired')
+            resp.status_code = 401
+            return resp
+        return None
+
+    @app.route('/v1/connect/oauth2/authorize', methods=('GET',))
+    def authorize():
+        """ Skips the consent page and sends the browser straight back with a code """
+        params = {'code': secrets.token_urlsafe(16), 'state': request.args.get('state', '')}
+        return redirect(request.args['redirect_uri'] + '?' + urllib.parse.urlencode(params))
+
+    @app.route('/v1/connect/oauth2/token', methods=('POST',))
+    def token():
+        error = simulate('token')
+        if error is not None:
+            return error
+        grant_type: str = request.form.get('grant_type', '')
+        if grant_type == 'refresh_token' and not state.redeem_refresh(request.form.get('refresh_token', '')):
+            return {'error': 'invalid_grant', 'error_description': 'Invalid refresh token'}, 400
+        if grant_type not in ('authorization_code', 'refresh_token', 'client_credentials'):
+            return {'error': 'unsupported_grant_type'}, 400
+        tokens: dict = state.issue(app.config['SIM_TOKEN_TTL'])
+        if grant_type == 'client_credentials':
+            del tokens['refresh_token']
+        return tokens, 200
+
+    @app.route('/v1/locations', methods=('GET',))
+    def locations():
+        error = simulate('locations') or unauthorized()
+        if error is not None:
+            return error
+        zipcode: str = request.args.get('filter.zipCode.near', '00000')
+        limit: int = int(request.args.get('filter.limit', '10'))
+        base: int = zlib.crc32(zipcode.encode()) % 10 ** 6
+        data = [{
+            'locationId': f'70{base + i:06d}',
+            'chain': CHAINS[(base + i) % len(CHAINS)],
+            'name': f'Store {i}',
+            'address': {'addressLine1': f'{100 + i} Main St', 'city': 'Simville', 'state': 'WA',
+                        'zipCode': zipcode, 'county': 'Sim'},
+            'geolocation': {'latitude': 47.6, 'longitude': -117.4, 'latLng': '47.6,-117.4'},
+            'hours': {'timezone': 'America/Los_Angeles', 'open24': False},
+            'phone': '5555555555',
+            'departments': [{'departmentId': '09', 'name': 'Pharmacy'}],
+        } for i in range(min(limit, 12))]
+        return {'data': data, 'meta': {'pagination': {'start': 0, 'limit': limit, 'total': len(data)}}}, 200
+
+    @app.route('/v1/products', methods=('GET',))
+    def products():
+        error = simulate('products') or unauthorized()
+        if error is not None:
+            return error
+        term: str = request.args.get('filter.term', '')
+        start: int = int(request.args.get('filter.start', '1'))
+        limit: int = min(int(request.args.get('filter.limit', '10')), 50)
+        total: int = app.config['SIM_PRODUCT_TOTAL']
+        base: int = zlib.crc32(term.lower().encode()) % 10 ** 8
+        data = []
+        for position in range(start, min(start + limit, total + 1)):
+            productId = f'{base + position:013d}'
+            data.append({
+                'productId': productId,
+                'upc': productId,
+                'brand': 'Simulated',
+                'description': f'Simulated {term} #{position}',
+                'categories': ['Simulated'],
+                'aisleLocations': [{'bayNumber': '1', 'description': 'Aisle 1', 'number': '1',
+                                    'numberOfFacings': '2', 'side': 'L', 'shelfNumber': '3'}],
+                'images': [{
+                    'perspective': perspective,
+                    'featured': perspective == 'front',
+                    'sizes': [{'size': size,
+                               'url': f'https://www.kroger.com/product/images/{size}/{perspective}/{productId}'}
+                              for size in SIZES]
+                } for perspective in PERSPECTIVES[:1 + position % len(PERSPECTIVES)]],
+                'items': [{'itemId': productId, 'favorite': False, 'size': '16 oz',
+                           'price': {'regular': 3.99, 'promo': 0},
+                           'fulfillment': {'curbside': True, 'delivery': True, 'inStore': True,
+                                           'shipToHome': False}}],
+                'itemInformation': {'depth': '3.0', 'height': '6.0', 'width': '3.0'},
+                'temperature': {'indicator': 'Ambient', 'heatSensitive': False},
+            })
+        return {'data': data, 'meta': {'pagination': {'start': start, 'limit': limit, 'total': total}}}, 200
+
+    @app.route('/v1/cart/add', methods=('PUT',))
+    def cart_add():
+        error = simulate('cart') or unauthorized()
+        if error is not None:
+            return error
+        items = (request.get_json(silent=True) or {}).get('items')
+        if not isinstance(items, list) or not items:
+            return {'errors': {'reason': 'items must be a non-empty list'}}, 400
+        for item in items:
+            if not item.get('upc') or not isinstance(item.get('quantity'), int) or item['quantity'] < 1:
+                return {'errors': {'reason': f'invalid item {item}'}}, 400
+        return Response(status=204)
+
+    app.sim_state = state
+    return app
+
+
+def parse_errors(values: tuple) -> dict:
+    rates: dict = {}
+    for value in values:
+        status, _, probability = value.partition('=')
+        rates[int(status)] = float(probability)
+    return rates
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', default=5055, show_default=True)
+@click.option('--latency', default='none', show_default=True,
+              help='none | fixed:<ms> | uniform:<low>,<high> | lognormal:<median ms>,<sigma>')
+@click.option('--error', 'errors', multiple=True, help='<status>=<probability>, repeatable')
+@click.option('--token-ttl', default=1800, show_default=True, help='Seconds an access token stays valid')
+@click.option('--seed', default=None, type=int)
+def main(host, port, latency, errors, token_ttl, seed):
+    """ Run the Kroger API simulator """
+    app = create_sim_app({'SIM_LATENCY': {'default': latency},
+                          'SIM_ERROR_RATES': parse_errors(errors),
+                          'SIM_TOKEN_TTL': token_ttl,
+                          'SIM_SEED': seed})
+    app.run(host=host, port=port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
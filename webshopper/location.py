@@ -2,13 +2,19 @@ from webshopper.auth import login_required
 from webshopper.auth import valid_tokens
 from webshopper.Communicator import Communicator
 from webshopper.db import DBInterface
+import logging
 import sqlite3
+from typing import List
 
+import click
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, jsonify, Response,
+    make_response
 )
+from flask.cli import with_appcontext
 
 bp = Blueprint('location', __name__, url_prefix='/location')
+logger = logging.getLogger(__name__)
 
 
 @bp.route('/search_loc', methods=('POST',))
@@ -16,7 +22,6 @@ bp = Blueprint('location', __name__, url_prefix='/location')
 @valid_tokens
 def search_loc():
     json = request.json
-    print(f'This is the')
     zipcode = json.get('zipcode', None)
     if zipcode is None:
         return {'error': 'Missing zipcode'}, 400
@@ -27,21 +32,21 @@ def search_loc():
     if len(zipcode) != 5:
         return {'error': 'Zipcode must be 5 digits'}
 
+    ret = DBInterface.get_cached_locations(zipcode, current_app.config['LOCATION_CACHE_TTL'])
+    if ret[0] != 0:
+        logger.warning('error reading location cache: %s', ret[1])
+    elif ret[1]['stores'] is not None:
+        return {'locations': ret[1]['stores']}, 200
+
     ret = Communicator.search_locations(zipcode)
     if ret[0] != 0:
-        print(f'error calling search_locations: {ret}')
+        logger.warning('error calling search_locations: %s', ret[1])
         return ret[1], 500
-    store_list: [dict] = ret[1]['results']['data']
-    trimmed_stores = []
-    # print(store_list)
-    for store in store_list:
-        tmp_dict = {
-            'locationId': store['locationId'],
-            'chain': store['chain'],
-            'addressLine1': store['address']['addressLine1']
-        }
-        trimmed_stores.append(tmp_dict)
-    print(trimmed_stores)
+    trimmed_stores = trim_stores(ret[1]['results']['data'])
+    logger.debug('found %d stores near %s', len(trimmed_stores), zipcode)
+    ret = DBInterface.cache_locations(zipcode, trimmed_stores)
+    if ret[0] != 0:
+        logger.warning('error writing location cache: %s', ret[1])
     return {'locations': trimmed_stores}, 200
 
 
@@ -61,7 +66,8 @@ def set_loc():
     except ValueError:
         return {'error': 'locationId must be integers only'}, 400
     # Depositing into DB
-    print(f'Updating location id to: {locationId}, {location_chain}, {location_address}')
+    logger.debug('updating location to %s, %s, %s', locationId, location_chain, location_address,
+                 extra={'user_id': session.get('user_id')})
     ret = DBInterface.update_location(session.get('user_id'), locationId,
                                       location_chain, location_address)
     if ret[0] != 0:
@@ -69,3 +75,67 @@ def set_loc():
     return {}, 200
 
 
+
+
+
+def trim_stores(store_list: List[dict]) -> List[dict]:
+    """ Keeps only the store fields the client uses """
+    trimmed_stores = []
+    for store in store_list:
+        tmp_dict = {
+            'locationId': store['locationId'],
+            'chain': store['chain'],
+            'addressLine1': store['address']['addressLine1']
+        }
+        trimmed_stores.append(tmp_dict)
+    return trimmed_stores
+
+
+@click.group('location-cache')
+def location_cache_command():
+    """ Manage the zipcode -> stores cache """
+
+
+@location_cache_command.command('refresh')
+@click.option('--zipcode', default=None, help='Refresh only this zipcode')
+@click.option('--older-than', type=float, default=0,
+              help='Only refresh entries older than this many seconds')
+@with_appcontext
+def refresh_location_cache_command(zipcode, older_than):
+    """ Re-fetch cached store lists from Kroger using an application token """
+    if zipcode is not None:
+        zipcodes = [zipcode]
+    else:
+        ret = DBInterface.get_cached_zipcodes(older_than)
+        if ret[0] != 0:
+            raise click.ClickException(str(ret[1]))
+        zipcodes = ret[1]['zipcodes']
+    ret = Communicator.client_token()
+    if ret[0] != 0:
+        raise click.ClickException(f'error retrieving client token: {ret[1]}')
+    access_token: str = ret[1]['access_token']
+    refreshed = 0
+    for zipcode in zipcodes:
+        ret = Communicator._fetch_locations(access_token, zipcode)
+        if ret[0] != 0:
+            click.echo(f'error refreshing {zipcode}: {ret[1]}', err=True)
+            continue
+        ret = DBInterface.cache_locations(zipcode, trim_stores(ret[1]['results']['data']))
+        if ret[0] != 0:
+            click.echo(f'error caching {zipcode}: {ret[1]}', err=True)
+            continue
+        refreshed += 1
+    click.echo(f'Refreshed {refreshed} of {len(zipcodes)} zipcodes')
+
+
+@location_cache_command.command('purge')
+@click.option('--zipcode', default=None, help='Purge only this zipcode')
+@click.option('--older-than', type=float, default=0,
+              help='Only purge entries older than this many seconds')
+@with_appcontext
+def purge_location_cache_command(zipcode, older_than):
+    """ Delete cached store lists """
+    ret = DBInterface.purge_locations(zipcode, older_than)
+    if ret[0] != 0:
+        raise click.ClickException(str(ret[1]))
+    click.echo(f"Purged {ret[1]['deleted']} zipcodes")
@@ -0,0 +1,72 @@
+import json
+import logging
+import random
+import sys
+
+# Attributes every LogRecord has. Anything else on a record came from extra={...}
+# and is emitted as a structured field.
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RESERVED}
+
+
+class JSONFormatter(logging.Formatter):
+    """ One JSON object per line: ts, level, logger, msg, the extra={...} fields and exc """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: dict = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        entry.update(fields(record))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """ Human readable lines with the extra={...} fields appended as key=value """
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)-7s %(name)s: %(message)s')
+
+    def format(self, record: logging.LogRecord) -> str:
+        line: str = super().format(record)
+        extra: dict = fields(record)
+        if extra:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in extra.items())
+        return line
+
+
+class DebugSampler(logging.Filter):
+    """ Passes rate (0-1) of DEBUG records and everything at INFO and above """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate: float = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+
+def init_app(app):
+    """
+        Configures the 'webshopper' logger, which is both app.logger and the parent of every
+        module logger (webshopper.db, webshopper.Communicator, ...). Modules log through
+        logging.getLogger(__name__) with %-style arguments, so messages below LOG_LEVEL are
+        never formatted.
+    """
+    logger: logging.Logger = logging.getLogger('webshopper')
+    logger.setLevel(app.config['LOG_LEVEL'])
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JSONFormatter() if app.config['LOG_FORMAT'] == 'json' else TextFormatter())
+    handler.addFilter(DebugSampler(app.config['LOG_DEBUG_SAMPLE_RATE']))
+    # Replaces Flask's default handler, and our own from an earlier create_app in this process
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.propagate = False
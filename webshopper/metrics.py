@@ -0,0 +1,170 @@
+import bisect
+import threading
+import time
+from typing import Callable
+from typing import List
+from typing import Tuple
+
+from flask import Blueprint, Response, current_app, g, request
+
+bp = Blueprint('metrics', __name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """
+        Static class. Process-local counters, gauges and histograms rendered in the Prometheus
+        text format at /metrics. Every instrumentation point checks Metrics.enabled first, so
+        with METRICS_ENABLED off the only cost is that attribute lookup.
+    """
+    enabled: bool = False
+    _lock: threading.Lock = threading.Lock()
+    # {<name>: (<'counter', 'gauge', 'histogram'>, <help>, <buckets>)}
+    _families: dict = {}
+    # {<name>: {<label tuple>: <value> or [<bucket counts>, <sum>, <count>]}}
+    _samples: dict = {}
+    _collectors: List[Callable] = []  # Called before rendering to refresh gauges
+
+    @staticmethod
+    def describe(name: str, kind: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        Metrics._families[name] = (kind, help_text, buckets)
+        Metrics._samples.setdefault(name, {})
+
+    @staticmethod
+    def collector(func: Callable) -> Callable:
+        """ Registers func to run before every render. Usable as a decorator """
+        Metrics._collectors.append(func)
+        return func
+
+    @staticmethod
+    def inc(name: str, labels: Tuple[Tuple[str, str], ...] = (), value: float = 1):
+        with Metrics._lock:
+            series: dict = Metrics._samples[name]
+            series[labels] = series.get(labels, 0) + value
+
+    @staticmethod
+    def set(name: str, labels: Tuple[Tuple[str, str], ...] = (), value: float = 0):
+        with Metrics._lock:
+            Metrics._samples[name][labels] = value
+
+    @staticmethod
+    def observe(name: str, labels: Tuple[Tuple[str, str], ...], value: float):
+        buckets: tuple = Metrics._families[name][2]
+        index: int = bisect.bisect_left(buckets, value)
+        with Metrics._lock:
+            series: dict = Metrics._samples[name]
+            sample = series.get(labels)
+            if sample is None:
+                sample = series[labels] = [[0] * (len(buckets) + 1), 0.0, 0]
+            sample[0][index] += 1
+            sample[1] += value
+            sample[2] += 1
+
+    @staticmethod
+    def reset():
+        with Metrics._lock:
+            for name in Metrics._samples:
+                Metrics._samples[name] = {}
+
+    @staticmethod
+    def render() -> str:
+        for collect in Metrics._collectors:
+            collect()
+        lines: list = []
+        with Metrics._lock:
+            for name, (kind, help_text, buckets) in sorted(Metrics._families.items()):
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, sample in sorted(Metrics._samples[name].items()):
+                    if kind != 'histogram':
+                        lines.append(f'{name}{_labels(labels)} {_number(sample)}')
+                        continue
+                    bucket_counts, total, count = sample
+                    cumulative: int = 0
+                    for bound, bucket_count in zip(buckets, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", "+Inf"),))} {count}')
+                    lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+                    lines.append(f'{name}_count{_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{key}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+Metrics.describe('webshopper_http_request_duration_seconds', 'histogram',
+                 'Flask request latency by endpoint, method and status')
+Metrics.describe('webshopper_db_query_duration_seconds', 'histogram',
+                 'Time spent executing and fetching DBInterface statements, by DBInterface method')
+Metrics.describe('webshopper_db_rows_total', 'counter',
+                 'Rows returned or changed by DBInterface statements, by DBInterface method')
+Metrics.describe('webshopper_kroger_request_duration_seconds', 'histogram',
+                 'Kroger API latency by call, including urllib3 retries')
+Metrics.describe('webshopper_kroger_responses_total', 'counter',
+                 'Kroger API responses by call and final status ("error" for connection failures)')
+Metrics.describe('webshopper_kroger_retries_total', 'counter',
+                 'Kroger API retries made by the pooled session, by call')
+Metrics.describe('webshopper_search_cache_events_total', 'counter',
+                 'Product search cache lookups by result (hit, stale_hit, miss) and evictions')
+Metrics.describe('webshopper_search_cache_entries', 'gauge',
+                 'Entries currently held by the product search cache')
+
+
+def observe_query(method: str, start: float, rows: int):
+    """ Records one DBInterface statement. start is the time.perf_counter() before execution """
+    labels: tuple = (('method', method),)
+    Metrics.observe('webshopper_db_query_duration_seconds', labels, time.perf_counter() - start)
+    if rows > 0:
+        Metrics.inc('webshopper_db_rows_total', labels, rows)
+
+
+def observe_kroger(call: str, http_method: str, start: float, status: str, retries: int):
+    """ Records one Communicator round trip """
+    elapsed: float = time.perf_counter() - start
+    Metrics.observe('webshopper_kroger_request_duration_seconds',
+                    (('call', call), ('method', http_method)), elapsed)
+    Metrics.inc('webshopper_kroger_responses_total', (('call', call), ('status', status)))
+    if retries:
+        Metrics.inc('webshopper_kroger_retries_total', (('call', call),), retries)
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+
+
+def _record_request(response: Response) -> Response:
+    start = g.pop('metrics_start', None)
+    if start is not None:
+        labels: tuple = (('endpoint', request.endpoint or 'unmatched'),
+                         ('method', request.method),
+                         ('status', str(response.status_code)))
+        Metrics.observe('webshopper_http_request_duration_seconds', labels, time.perf_counter() - start)
+    return response
+
+
+@bp.route('/metrics', methods=('GET',))
+def metrics():
+    if not Metrics.enabled:
+        return {'error': 'metrics are disabled'}, 404
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    Metrics.enabled = app.config['METRICS_ENABLED']
+    app.register_blueprint(bp)
+    if Metrics.enabled:
+        app.before_request(_start_timer)
+        app.after_request(_record_request)
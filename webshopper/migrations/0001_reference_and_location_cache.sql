@@ -0,0 +1,28 @@
+-- Brings databases created before reference_version and location_cache existed
+-- up to the current schema.sql. A no-op for databases created from it.
+
+CREATE TABLE IF NOT EXISTS location_cache (
+    zipcode TEXT PRIMARY KEY,
+    stores TEXT NOT NULL,       -- JSON list of trimmed stores [{'locationId', 'chain', 'addressLine1'}, ...]
+    fetched_at FLOAT NOT NULL   -- unix timestamp of the Kroger lookup
+);
+
+CREATE TABLE IF NOT EXISTS reference_version (
+    version INTEGER NOT NULL
+);
+insert into reference_version (version)
+    select CAST(strftime('%s', 'now') AS INTEGER)
+    where not exists (select 1 from reference_version);
+
+CREATE TRIGGER IF NOT EXISTS units_insert AFTER INSERT ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS units_update AFTER UPDATE ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS units_delete AFTER DELETE ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS unit_translations_insert AFTER INSERT ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS unit_translations_update AFTER UPDATE ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS unit_translations_delete AFTER DELETE ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
@@ -0,0 +1,14 @@
+-- Indexes behind every DBInterface lookup that the primary keys do not already cover.
+-- Verified by 'flask check-query-plans'.
+
+-- get_user_recipes: recipes by user, already in recipe_id order for ORDER BY r.recipe_id
+CREATE INDEX IF NOT EXISTS recipes_user_id ON recipes (user_id, recipe_id);
+
+-- get_user_recipes: LEFT JOIN ingredients on recipe_id
+CREATE INDEX IF NOT EXISTS ingredients_recipe_id ON ingredients (recipe_id);
+
+-- Foreign key check on ingredients(user_id, productId) when a product is deleted
+CREATE INDEX IF NOT EXISTS ingredients_user_product ON ingredients (user_id, productId);
+
+-- get_cached_zipcodes / purge_locations: location_cache by age
+CREATE INDEX IF NOT EXISTS location_cache_fetched_at ON location_cache (fetched_at);
@@ -0,0 +1,53 @@
+-- Per-user change log behind /sync. One row per product or recipe that has ever existed:
+-- every write replaces the entity's row, which gives it a new, higher version. Versions come
+-- from AUTOINCREMENT so they are never reused, and sqlite's single writer commits them in order.
+-- Ingredient writes are logged as a change to their recipe.
+
+CREATE TABLE IF NOT EXISTS change_log (
+    version INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    entity TEXT NOT NULL CHECK (entity IN ('product', 'recipe')),
+    entity_id TEXT NOT NULL,            -- productId or recipe_id
+    deleted INTEGER NOT NULL DEFAULT 0, -- 1 once the entity is deleted
+
+    UNIQUE (user_id, entity, entity_id)
+);
+
+-- get_changes / get_library_version: a user's entries by version
+CREATE INDEX IF NOT EXISTS change_log_user_version ON change_log (user_id, version);
+
+CREATE TRIGGER IF NOT EXISTS products_changed_insert AFTER INSERT ON products
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'product', NEW.productId, 0); END;
+CREATE TRIGGER IF NOT EXISTS products_changed_update AFTER UPDATE ON products
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'product', NEW.productId, 0); END;
+CREATE TRIGGER IF NOT EXISTS products_changed_delete AFTER DELETE ON products
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (OLD.user_id, 'product', OLD.productId, 1); END;
+
+CREATE TRIGGER IF NOT EXISTS recipes_changed_insert AFTER INSERT ON recipes
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'recipe', NEW.recipe_id, 0); END;
+CREATE TRIGGER IF NOT EXISTS recipes_changed_update AFTER UPDATE ON recipes
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'recipe', NEW.recipe_id, 0); END;
+CREATE TRIGGER IF NOT EXISTS recipes_changed_delete AFTER DELETE ON recipes
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (OLD.user_id, 'recipe', OLD.recipe_id, 1); END;
+
+CREATE TRIGGER IF NOT EXISTS ingredients_changed_insert AFTER INSERT ON ingredients
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'recipe', NEW.recipe_id, 0); END;
+CREATE TRIGGER IF NOT EXISTS ingredients_changed_update AFTER UPDATE ON ingredients
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (NEW.user_id, 'recipe', NEW.recipe_id, 0); END;
+CREATE TRIGGER IF NOT EXISTS ingredients_changed_delete AFTER DELETE ON ingredients
+BEGIN INSERT OR REPLACE INTO change_log (user_id, entity, entity_id, deleted)
+      VALUES (OLD.user_id, 'recipe', OLD.recipe_id, 0); END;
+
+-- Existing libraries start out logged, so /sync?since=0 returns everything
+INSERT OR IGNORE INTO change_log (user_id, entity, entity_id)
+    SELECT user_id, 'product', productId FROM products;
+INSERT OR IGNORE INTO change_log (user_id, entity, entity_id)
+    SELECT user_id, 'recipe', recipe_id FROM recipes;
@@ -0,0 +1,11 @@
+-- Server-side sessions for SESSION_BACKEND = 'sqlite'. The cookie only carries sid;
+-- data is the JSON of what Flask's signed cookie would otherwise hold.
+
+CREATE TABLE IF NOT EXISTS sessions (
+    sid TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    expires_at FLOAT NOT NULL   -- unix timestamp, refreshed whenever the session is saved
+);
+
+-- purge_sessions: expired sessions
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
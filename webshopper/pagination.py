@@ -0,0 +1,36 @@
+import base64
+import binascii
+import json
+from typing import Tuple
+
+from flask import current_app, request
+
+
+def encode_cursor(last) -> str:
+    """ Opaque token for the key of the last row a page returned, or None on the final page """
+    if last is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps([last]).encode()).decode().rstrip('=')
+
+
+def page_args() -> Tuple[int, dict]:
+    """
+        Reads ?cursor= and ?limit= for a keyset-paginated list endpoint.
+        limit defaults to PAGE_SIZE and is capped at PAGE_SIZE_MAX.
+
+        Returns {'after': <key to continue after, None for the first page>, 'limit': <int>}
+    """
+    after = None
+    cursor: str = request.args.get('cursor')
+    if cursor:
+        try:
+            after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))[0]
+        except (binascii.Error, ValueError, IndexError, TypeError, KeyError):
+            return -1, {'error': 'invalid cursor'}
+    try:
+        limit: int = int(request.args.get('limit', current_app.config['PAGE_SIZE']))
+    except ValueError:
+        return -1, {'error': 'limit must be an integer'}
+    if limit < 1:
+        return -1, {'error': 'limit must be positive'}
+    return 0, {'after': after, 'limit': min(limit, current_app.config['PAGE_SIZE_MAX'])}
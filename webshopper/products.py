@@ -1,16 +1,43 @@
+import itertools
+import logging
 from typing import Tuple
 from typing import List
 from webshopper.auth import login_required
 from webshopper.auth import valid_tokens
 from webshopper.Communicator import Communicator
+from webshopper.Communicator import largest_image_url
 from webshopper.db import DBInterface
+from webshopper.etags import conditional_library
+from webshopper.pagination import encode_cursor
+from webshopper.pagination import page_args
+from webshopper.units import UnitCache
 import sqlite3
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, jsonify, Response, make_response,
+    stream_with_context
 )
 
 bp = Blueprint('products', __name__, url_prefix='/products')
+logger = logging.getLogger(__name__)
+
+
+@bp.route('', methods=('GET',))
+@login_required
+@conditional_library
+def list_products():
+    """
+        One page of the user's saved products in productId order.
+        ?limit=<page size>&cursor=<next_cursor of the previous page>
+        next_cursor is null on the last page.
+    """
+    ret = page_args()
+    if ret[0] != 0:
+        return ret[1], 400
+    ret = DBInterface.get_product_page(session['user_id'], ret[1]['after'], ret[1]['limit'])
+    if ret[0] != 0:
+        return {'error': str(ret[1]['error'])}, 500
+    return {'products': ret[1]['products'], 'next_cursor': encode_cursor(ret[1]['last'])}, 200
 
 
 @bp.route('/search', methods=('POST',))
@@ -20,38 +47,74 @@ def search_products():
     """
         Expects 'search_term' in the JSON.
         Must be >= 3 characters
+        Optional 'start' (1-based position, default 1) pages through the results
+        50 at a time; 'total' in the response is the number of matches Kroger reports.
     """
-    # if request.method == 'OPTIONS':
-    #     print('preflight request')
-    # else:
-    #     print('not preflight')
-
     json = request.json
     search_term = json.get('search_term', None)
     if search_term is None:
         return {'error': 'Search term missing'}, 400
     if session['locationId'] == '':
         return {'error': 'Must set locationId first'}, 400
+    start = json.get('start', 1)
+    if not isinstance(start, int) or not 1 <= start <= current_app.config['SEARCH_MAX_RESULTS']:
+        return {'error': f"start must be between 1 and {current_app.config['SEARCH_MAX_RESULTS']}"}, 400
 
     # Calling Kroger
-    ret = Communicator.search_product(search_term, session['locationId'])
+    ret = Communicator.search_product(search_term, session['locationId'], start=start)
     if ret[0] != 0:
-        print(f' Failure calling search_products: {ret}')
+        logger.warning('failure calling search_product: %s', ret[1])
         return ret[1], 400
     # Call to Kroger succeeded
-    products: list = ret[1]['results']['data']  # Going to be some sort of JSON
-    # Now need to organize the relevant information
-    print(products[0])
-    ret_list: list = []
-    for prod in products:
-        tmp_dict = {
-            'productId': prod['productId'],
-            'upc': prod['upc'],
-            'description': prod['description'],
-            'image_urls': image_urls(prod['images']),
-        }
-        ret_list.append(tmp_dict)
-    return {'products': ret_list}, 200
+    results: dict = ret[1]['results']
+    logger.debug('search for %r returned %d products', search_term, len(results['data']))
+    return {'products': trim_products(results['data']),
+            'start': start,
+            'total': results.get('meta', {}).get('pagination', {}).get('total')}, 200
+
+
+@bp.route('/search_stream', methods=('POST',))
+@login_required
+@valid_tokens
+def search_products_stream():
+    """
+        search_products over every page, up to 'max_results' (default and cap SEARCH_MAX_RESULTS).
+        Streams NDJSON, one line per Kroger page as soon as it arrives:
+            {"start": <1-based position>, "total": <matches>, "products": [...]}
+        Later pages are fetched concurrently and may arrive out of order. A page that fails
+        is sent as {"start": <>, "error": <>} and the rest of the stream carries on.
+    """
+    json = request.json
+    search_term = json.get('search_term', None)
+    if search_term is None:
+        return {'error': 'Search term missing'}, 400
+    if session['locationId'] == '':
+        return {'error': 'Must set locationId first'}, 400
+    max_results = json.get('max_results', current_app.config['SEARCH_MAX_RESULTS'])
+    if not isinstance(max_results, int) or max_results < 1:
+        return {'error': 'max_results must be a positive integer'}, 400
+    max_results = min(max_results, current_app.config['SEARCH_MAX_RESULTS'])
+    pages = Communicator.search_product_pages(search_term, session['locationId'], max_results=max_results)
+    # The first page decides the status code; everything after it is streamed
+    first = next(pages)
+    if first[0] != 0:
+        logger.warning('failure calling search_product: %s', first[1])
+        return first[1], 400
+
+    def generate():
+        for ret in itertools.chain([first], pages):
+            if ret[0] != 0:
+                logger.warning('failure calling search_product: %s', ret[1])
+                line: dict = {'start': ret[1].get('start', 1),
+                              'error': ret[1].get('error_message') or ret[1].get('error')}
+            else:
+                results: dict = ret[1]['results']
+                line = {'start': ret[1]['start'],
+                        'total': results.get('meta', {}).get('pagination', {}).get('total'),
+                        'products': trim_products(results['data'][:max_results - ret[1]['start'] + 1])}
+            yield current_app.json.dumps(line) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @bp.route('/add_product', methods=('POST',))
@@ -66,11 +129,10 @@ def add_product():
     """
     json = request.json
     new_product: dict = json['new_product']
-    ret = validate_new_product(new_product, new_product['includeAlternate'])
+    ret = validate_new_product(new_product, include_alternate(new_product))
     if ret[0] != 0:
-        print(f'error validating serving stuff: {ret}')
+        logger.info('invalid new product: %s', ret[1])
         return ret[1], 400
-    print(new_product)
 
     # Calculating total weight/volume based on the serving size and servings per container
     # Getting the unit_conversion table
@@ -80,11 +142,68 @@ def add_product():
     # Inserting into database
     ret = DBInterface.add_product(session.get('user_id'), new_product)
     if ret[0] != 0:
-        print(f'db error with new product: {ret}')
+        logger.warning('db error with new product: %s', ret[1], extra={'user_id': session.get('user_id')})
         return ret[1], 400
     return {}, 200
 
 
+@bp.route('/add_products', methods=('POST',))
+@login_required
+def add_products():
+    """
+        Bulk add_product: {'new_products': [<product as for add_product>, ...]}, at most
+        BULK_MAX_ITEMS. Each product is validated and converted on its own, and the valid
+        ones are saved in one transaction.
+
+        Returns {'results': [{'productId': <>, 'added': <bool>, 'error': <reason, when not added>}, ...]}
+        in request order. A product failing does not fail the request.
+    """
+    new_products = request.json.get('new_products')
+    if not isinstance(new_products, list) or not new_products:
+        return {'error': 'new_products must be a non-empty list'}, 400
+    if len(new_products) > current_app.config['BULK_MAX_ITEMS']:
+        return {'error': f"at most {current_app.config['BULK_MAX_ITEMS']} products per request"}, 400
+    ret = UnitCache.load()
+    if ret[0] != 0:
+        return ret[1], 500
+    errors: dict = {}  # {<position>: <reason>}
+    valid: list = []
+    seen: set = set()
+    for position, new_product in enumerate(new_products):
+        if not isinstance(new_product, dict) or not isinstance(new_product.get('productId'), str):
+            errors[position] = 'productId missing'
+            continue
+        if new_product['productId'] in seen:
+            errors[position] = 'repeats an earlier product in this request'
+            continue
+        seen.add(new_product['productId'])
+        try:
+            ret = validate_new_product(new_product, include_alternate(new_product))
+            if ret[0] == 0:
+                ret = convert_container_quantity(new_product)
+        except (KeyError, TypeError) as e:
+            ret = -1, {'error': f'missing or invalid field {e}'}
+        if ret[0] != 0:
+            errors[position] = ret[1]['error']
+            continue
+        valid.append(new_product)
+    ret = DBInterface.add_products(session['user_id'], valid)
+    if ret[0] != 0:
+        return ret[1], 500
+    failed: dict = ret[1]['failed']
+    results: list = []
+    for position, new_product in enumerate(new_products):
+        productId = new_product.get('productId') if isinstance(new_product, dict) else None
+        error = errors.get(position) or failed.get(productId)
+        if error is None:
+            results.append({'productId': productId, 'added': True})
+        else:
+            results.append({'productId': productId, 'added': False, 'error': error})
+    logger.debug('bulk added %d of %d products', len(ret[1]['added']), len(new_products),
+                 extra={'user_id': session['user_id']})
+    return {'results': results}, 200
+
+
 @bp.route('edit_product', methods=('POST',))
 @login_required
 def edit_product():
@@ -92,10 +211,9 @@ def edit_product():
 
     :return:
     """
-    print('here')
     json = request.json
     edited_product = json['edited_product']
-    ret = validate_new_product(edited_product, edited_product['includeAlternate'])
+    ret = validate_new_product(edited_product, include_alternate(edited_product))
     if ret[0] != 0:
         return ret[1], 400
     # Calculating total weight/volume based on the serving size and servings per container
@@ -113,11 +231,17 @@ def edit_product():
 @bp.route('delete_product', methods=('POST',))
 @login_required
 def delete_product():
-    """ Expects the productId of the target product """
+    """ Expects the productId of the target product
+
+        Products still used by a recipe's ingredients are kept: the response is a 409 whose
+        'recipes' lists them. Remove those ingredients first.
+    """
     json = request.json
     deleted_prod_id: str = json['deleted_product_id']
     ret = DBInterface.delete_product(session['user_id'], deleted_prod_id)
     if ret[0] != 0:
+        if 'recipes' in ret[1]:
+            return ret[1], 409
         return {'error': ret[1]['error']}, 500
     return {}, 200
 
@@ -129,10 +253,21 @@ def delete_product():
 """
 
 
+def include_alternate(product: dict) -> bool:
+    """ Reads 'includeAlternate', which clients send as 'true'/'false' (or a JSON boolean),
+        and stores it back as 'true' or 'false'. Every product endpoint goes through here.
+    """
+    value = product['includeAlternate']
+    included: bool = value is True or (isinstance(value, str) and value.strip().lower() == 'true')
+    product['includeAlternate'] = 'true' if included else 'false'
+    return included
+
+
 def validate_new_product(new_product: dict, optionals=False) -> Tuple[int, dict]:
     """
         Checks that required numeric fields are floats and positive
-        :param optionals: Skips testing the alternate serving values
+        :param optionals: Whether the alternate serving values are in use. They must be numbers
+            either way, since they are stored, but only need to be positive when in use.
     """
     mandatory = [
         'servingSize',
@@ -143,18 +278,14 @@ def validate_new_product(new_product: dict, optionals=False) -> Tuple[int, dict]
         'alternateSPC'
     ]
 
-    if optionals:
-        mandatory.extend(optional)
-
-    def validator(key: str) -> Tuple[int, dict]:
+    def validator(key: str, positive: bool = True) -> Tuple[int, dict]:
         error: str = ''
         ret_val = 0
         try:
-            float(new_product[key])
-        except ValueError as e:
-            error = f'{key} must be a float'
-            ret_val = -1
-        if float(new_product[key]) <= 0:
+            value: float = float(new_product[key])
+        except (ValueError, TypeError) as e:
+            return -1, {'error': f'{key} must be a float'}
+        if positive and value <= 0:
             error = f'{key} must be positive'
             ret_val = -1
         return ret_val, {'error': error}
@@ -163,10 +294,28 @@ def validate_new_product(new_product: dict, optionals=False) -> Tuple[int, dict]
         ret = validator(item)
         if ret[0] != 0:
             return ret
+    for item in optional:
+        ret = validator(item, positive=optionals)
+        if ret[0] != 0:
+            return ret
 
     return 0, {}
 
 
+def trim_products(products: list) -> List[dict]:
+    """ Kroger product search results -> what the client needs to display and save them """
+    ret_list: list = []
+    for prod in products:
+        tmp_dict = {
+            'productId': prod['productId'],
+            'upc': prod['upc'],
+            'description': prod['description'],
+            'image_urls': image_urls(prod['images']),
+        }
+        ret_list.append(tmp_dict)
+    return ret_list
+
+
 def image_urls(image_list: list) -> List[dict]:
     """  Help function for search_products
 
@@ -174,32 +323,21 @@ def image_urls(image_list: list) -> List[dict]:
             {'perspective': 'front',
             'sizes': [{'size': 'large', 'url': 'http...'}, ...]
             }
+            or, from a projected search (Communicator.project_search), already reduced to
+            {'perspective': 'front', 'url': 'http...'}
 
         Pulls largest image for each perspective
     """
-    size_map = {
-        'thumbnail': 0,
-        'small': 1,
-        'medium': 2,
-        'large': 3,
-        'xlarge': 4
-    }
-    largest: int = -1
     url_list = []
     for entry in image_list:
         tmp_dict = {
             'perspective': entry['perspective'],
         }
         # Finding largest img for the perspective
-        for size_set in entry['sizes']:
-            size = size_set['size']
-            if size_map[size] > largest:
-                largest = size_map[size]
-                tmp_dict['url'] = size_set['url']
+        url = largest_image_url(entry['sizes']) if 'sizes' in entry else entry.get('url')
+        if url is not None:
+            tmp_dict['url'] = url
         url_list.append(tmp_dict)
-
-        largest = -1
-
     return url_list
 
 
@@ -209,20 +347,16 @@ def set_container_quantity(product: dict) -> Tuple[int, dict]:
 
         Dictionary is pass by reference so it is not returned
     """
-    ret = DBInterface.get_unit_translations()
-    if ret[0] != 0:
-        return ret
-    conversion_dict = ret[1]['conversion_dict']
-    # Getting unit type lists
-    ret = DBInterface.get_units()
+    ret = UnitCache.load()
     if ret[0] != 0:
         return ret
-    unit_dict = ret[1]['unit_dict']
-    if product['servingUnit'] in unit_dict['weight']:
-        unit_type = 'weight'
-    elif product['servingUnit'] in unit_dict['volume']:
-        unit_type = 'volume'
-    else:
+    return convert_container_quantity(product)
+
+
+def convert_container_quantity(product: dict) -> Tuple[int, dict]:
+    """ set_container_quantity without the UnitCache.load(), for callers converting a batch """
+    unit_type = UnitCache.unit_type(product['servingUnit'])
+    if unit_type is None:
         # Should never be here
         unit_type = product['servingUnit']
         return -1, {'error': f'${unit_type} is not a recognized weight/measure..'}
@@ -231,14 +365,12 @@ def set_container_quantity(product: dict) -> Tuple[int, dict]:
     if unit_type == 'weight':
         unconverted_total = float(product['servingsPerContainer']) * float(product['servingSize'])
         serving_unit: str = product['servingUnit']
-        total_container_quantity = float(conversion_dict[serving_unit]['gram']) * unconverted_total
+        total_container_quantity = UnitCache.factor(serving_unit, 'gram') * unconverted_total
         product['total_quantity_unit'] = 'gram'
     else:
         unconverted_total = float(product['servingsPerContainer']) * float(product['servingSize'])
-        print(f'unconverted total: {unconverted_total}')
         serving_unit: str = product['servingUnit']
-        total_container_quantity = float(conversion_dict[serving_unit]['ml']) * unconverted_total
-        print(f'converted total: {total_container_quantity}')
+        total_container_quantity = UnitCache.factor(serving_unit, 'ml') * unconverted_total
         product['total_quantity_unit'] = 'ml'
     product['total_container_quantity'] = total_container_quantity
     return 0, {}
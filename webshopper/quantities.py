@@ -0,0 +1,92 @@
+from typing import Tuple
+from typing import List
+
+import numpy as np
+
+from webshopper.units import UnitCache
+
+
+def encode_ingredients(recipes: list) -> Tuple[int, dict]:
+    """
+        Flattens the selected recipes into parallel arrays so that unit conversion, summing
+        and container division in recipes.order_recipes are single numpy operations.
+        UnitCache.load() must have been called first.
+
+        Returns {'product_ids': [<productId>, ...],    in first-seen order
+                 'units': [<unit>, ...],                in first-seen order
+                 'product_index': <int array>,          one entry per ingredient, into product_ids
+                 'unit_index': <int array>,             one entry per ingredient, into units
+                 'quantity': <float array>}             one entry per ingredient
+    """
+    product_ids: List[str] = []
+    product_positions: dict = {}
+    units: List[str] = []
+    unit_positions: dict = {}
+    product_index: List[int] = []
+    unit_index: List[int] = []
+    quantity: List[float] = []
+    for recipe in recipes:
+        ingredients: dict = recipe['ingredients']
+        for ing_id in ingredients:
+            ingredient = ingredients[ing_id]
+            productId = ingredient['productId']
+            unit = ingredient['ingredient_unit']
+            if unit not in unit_positions:
+                if UnitCache.base_factor(unit) is None:
+                    return -1, {'error': f'unit type of ingredient {ingredient} in recipe {recipe} is invalid'}
+                unit_positions[unit] = len(units)
+                units.append(unit)
+            if productId not in product_positions:
+                product_positions[productId] = len(product_ids)
+                product_ids.append(productId)
+            product_index.append(product_positions[productId])
+            unit_index.append(unit_positions[unit])
+            quantity.append(float(ingredient['ingredient_quantity']))
+    return 0, {
+        'product_ids': product_ids,
+        'units': units,
+        'product_index': np.array(product_index, dtype=np.intp),
+        'unit_index': np.array(unit_index, dtype=np.intp),
+        'quantity': np.array(quantity, dtype=np.float64)
+    }
+
+
+def tally_products(encoded: dict) -> np.ndarray:
+    """ Total gram/ml needed per product, aligned with encoded['product_ids'] """
+    factors = np.array([UnitCache.base_factor(unit) for unit in encoded['units']], dtype=np.float64)
+    normalized = factors[encoded['unit_index']] * encoded['quantity']
+    return np.bincount(encoded['product_index'], weights=normalized, minlength=len(encoded['product_ids']))
+
+
+def containers_needed(product_ids: List[str], quantities: np.ndarray, products_dict: dict,
+                      rounding_threshold: float) -> Tuple[int, dict]:
+    """
+        Divides each product's quantity by its container size. Fractions above the
+        threshold are rounded up to the next whole container and reported.
+
+        Returns {'final_tally': {<productId>: <containers>, ...},
+                 'rounded_values': {<productId>: {'product_description', 'original_value',
+                                                  'rounded_value'}, ...}}
+    """
+    missing: list = [productId for productId in product_ids if productId not in products_dict]
+    if missing:
+        return -1, {'error': f'products not found: {missing}'}
+    container_sizes = np.array([products_dict[productId]['total_container_quantity']
+                                for productId in product_ids], dtype=np.float64)
+    containers = quantities / container_sizes
+    round_up = (containers - np.floor(containers)) > rounding_threshold
+    rounded = np.floor(containers + 1)
+    final_tally: dict = {}
+    rounded_values: dict = {}
+    for productId, original, needs_rounding, whole in zip(product_ids, containers.tolist(),
+                                                          round_up.tolist(), rounded.tolist()):
+        if needs_rounding:
+            final_tally[productId] = int(whole)
+            rounded_values[productId] = {
+                'product_description': products_dict[productId]['description'],
+                'original_value': original,
+                'rounded_value': int(whole)
+            }
+        else:
+            final_tally[productId] = original
+    return 0, {'final_tally': final_tally, 'rounded_values': rounded_values}
@@ -0,0 +1,148 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Tuple
+
+from flask import current_app
+
+from webshopper.metrics import Metrics
+
+logger = logging.getLogger(__name__)
+
+# Histogram buckets reaching past the latency ones: queueing for a few seconds is expected
+WAIT_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+
+class RateLimiter:
+    """
+        Static class. Token bucket for outbound Kroger calls, shared by every worker process
+        through a small sqlite file (KROGER_RATE_LIMIT_DB), so the app as a whole stays under
+        the per-app quota instead of each worker keeping its own count.
+
+        The bucket holds up to KROGER_RATE_BURST calls and refills at KROGER_RATE_LIMIT calls
+        per second. acquire() takes a call from it in one BEGIN IMMEDIATE transaction. When the
+        bucket is empty the count goes negative: the caller has reserved the next free slot and
+        sleeps until then, so waiting callers are served in the order they arrived. A caller
+        whose slot is more than KROGER_RATE_MAX_WAIT seconds away does not reserve one and
+        gets an error instead.
+    """
+    _local: threading.local = threading.local()  # {'pid': <>, <path>: Connection}
+
+    @staticmethod
+    def enabled() -> bool:
+        return current_app.config['KROGER_RATE_LIMIT'] > 0
+
+    @staticmethod
+    def _path() -> str:
+        return current_app.config['KROGER_RATE_LIMIT_DB'] or os.path.join(current_app.instance_path,
+                                                                          'kroger_rate.sqlite')
+
+    @staticmethod
+    def _db() -> sqlite3.Connection:
+        """ One connection per thread and file, reopened after a fork """
+        path: str = RateLimiter._path()
+        connections: dict = getattr(RateLimiter._local, 'connections', None)
+        if connections is None or connections['pid'] != os.getpid():
+            connections = {'pid': os.getpid()}
+            RateLimiter._local.connections = connections
+        if path not in connections:
+            # Autocommit, so BEGIN IMMEDIATE below is the only transaction
+            db: sqlite3.Connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute(""" CREATE TABLE IF NOT EXISTS buckets (
+                               name TEXT PRIMARY KEY,
+                               tokens FLOAT NOT NULL,      -- negative while callers are queued
+                               updated_at FLOAT NOT NULL   -- unix timestamp tokens was computed at
+                           ) """)
+            connections[path] = db
+        return connections[path]
+
+    @staticmethod
+    def _tokens(row, now: float, rate: float, burst: float) -> float:
+        """ Bucket level at now from its (tokens, updated_at) row. A missing bucket is full. """
+        if row is None:
+            return burst
+        return min(burst, row[0] + max(0.0, now - row[1]) * rate)
+
+    @staticmethod
+    def _take(db: sqlite3.Connection, name: str, rate: float, burst: float,
+              max_wait: float) -> Tuple[float, float]:
+        """ Takes one call from the bucket inside the caller's transaction, unless the wait for
+            it would exceed max_wait. Returns (<seconds to wait>, <tokens left>).
+        """
+        now: float = time.time()
+        row = db.execute('SELECT tokens, updated_at FROM buckets WHERE name = ?', (name,)).fetchone()
+        tokens: float = RateLimiter._tokens(row, now, rate, burst)
+        wait: float = max(0.0, (1 - tokens) / rate)
+        if wait > max_wait:
+            return wait, tokens
+        db.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated_at) VALUES (?, ?, ?)',
+                   (name, tokens - 1, now))
+        return wait, tokens - 1
+
+    @staticmethod
+    def acquire(name: str = 'kroger') -> Tuple[int, dict]:
+        """ Blocks until a call may be made. Returns {'waited': <seconds>} or an error if the
+            wait would exceed KROGER_RATE_MAX_WAIT. If the bucket cannot be read the call is let
+            through: Kroger's own limit still applies and retries cover its 429s.
+        """
+        if not RateLimiter.enabled():
+            return 0, {'waited': 0}
+        config = current_app.config
+        rate: float = float(config['KROGER_RATE_LIMIT'])
+        max_wait: float = config['KROGER_RATE_MAX_WAIT']
+        try:
+            db: sqlite3.Connection = RateLimiter._db()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                wait, tokens = RateLimiter._take(db, name, rate, float(config['KROGER_RATE_BURST']), max_wait)
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logger.warning('rate limiter unavailable, not limiting: %s', e)
+            return 0, {'waited': 0}
+        if Metrics.enabled:
+            Metrics.set('webshopper_kroger_rate_tokens', (('bucket', name),), tokens)
+        if wait > max_wait:
+            if Metrics.enabled:
+                Metrics.inc('webshopper_kroger_rate_rejected_total', (('bucket', name),))
+            logger.warning('rate limit: next %s slot is %.2fs away, over the %ss limit', name, wait, max_wait)
+            return -1, {'error': f'rate limited: next slot in {wait:.2f}s'}
+        if wait > 0:
+            time.sleep(wait)
+        if Metrics.enabled:
+            Metrics.observe('webshopper_kroger_rate_wait_seconds', (('bucket', name),), wait)
+        return 0, {'waited': wait}
+
+    @staticmethod
+    def budget(name: str = 'kroger') -> Tuple[int, dict]:
+        """ Returns {'tokens': <calls available now, negative while callers are queued>} """
+        config = current_app.config
+        try:
+            row = RateLimiter._db().execute('SELECT tokens, updated_at FROM buckets WHERE name = ?',
+                                            (name,)).fetchone()
+        except sqlite3.Error as e:
+            return -1, {'error': str(e)}
+        return 0, {'tokens': RateLimiter._tokens(row, time.time(), float(config['KROGER_RATE_LIMIT']),
+                                                 float(config['KROGER_RATE_BURST']))}
+
+
+Metrics.describe('webshopper_kroger_rate_tokens', 'gauge',
+                 'Kroger calls left in the shared rate limit bucket, negative while callers queue')
+Metrics.describe('webshopper_kroger_rate_wait_seconds', 'histogram',
+                 'Time Kroger calls waited for the shared rate limiter', WAIT_BUCKETS)
+Metrics.describe('webshopper_kroger_rate_rejected_total', 'counter',
+                 'Kroger calls refused because their rate limiter wait exceeded KROGER_RATE_MAX_WAIT')
+
+
+@Metrics.collector
+def _rate_limit_metrics():
+    if not RateLimiter.enabled():
+        return
+    ret = RateLimiter.budget()
+    if ret[0] == 0:
+        Metrics.set('webshopper_kroger_rate_tokens', (('bucket', 'kroger'),), ret[1]['tokens'])
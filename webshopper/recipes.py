@@ -1,19 +1,45 @@
+import logging
 from typing import Tuple
 from typing import List
 from webshopper.auth import login_required
 from webshopper.auth import valid_tokens
 from webshopper.Communicator import Communicator
 from webshopper.db import DBInterface
+from webshopper.etags import conditional_library
+from webshopper.pagination import encode_cursor
+from webshopper.pagination import page_args
+from webshopper.units import UnitCache
+from webshopper.quantities import containers_needed
+from webshopper.quantities import encode_ingredients
+from webshopper.quantities import tally_products
 import sqlite3
-from math import floor
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, jsonify, Response, make_response
 )
 
 
 ROUNDING_THRESHOLD = .05
 
 bp = Blueprint('recipes', __name__, url_prefix='/recipes')
+logger = logging.getLogger(__name__)
+
+
+@bp.route('', methods=('GET',))
+@login_required
+@conditional_library
+def list_recipes():
+    """
+        One page of the user's recipes, with ingredients, in recipe_id order.
+        ?limit=<page size>&cursor=<next_cursor of the previous page>
+        next_cursor is null on the last page.
+    """
+    ret = page_args()
+    if ret[0] != 0:
+        return ret[1], 400
+    ret = DBInterface.get_recipe_page(session['user_id'], ret[1]['after'], ret[1]['limit'])
+    if ret[0] != 0:
+        return ret[1], 500
+    return {'recipes': ret[1]['recipes'], 'next_cursor': encode_cursor(ret[1]['last'])}, 200
 
 
 @bp.route('/new_recipe', methods=('POST',))
@@ -41,7 +67,6 @@ def new_ingredient():
     :return:
     """
     json: dict = request.json
-    print(f'Here are the json values in new_ingredient: {json}')
     recipe_id: int = json['new_ingredient']['recipe_id']
     productId: str = json['new_ingredient']['productId']
     ingredient_name = json['new_ingredient']['ingredient_name']
@@ -56,11 +81,45 @@ def new_ingredient():
                                      ingredient_unit,
                                      product_description)
     if ret[0] != 0:
-        print(ret)
+        logger.warning('error adding ingredient: %s', ret[1], extra={'user_id': session['user_id']})
         return ret[1], 500
     return ret[1], 200
 
 
+@bp.route('/new_ingredients', methods=('POST',))
+@login_required
+def new_ingredients():
+    """
+        Adds a list of ingredients to a recipe in one round trip, all or nothing:
+        {'recipe_id': <>, 'ingredients': [<new_ingredient fields minus recipe_id>, ...]}
+        At most BULK_MAX_ITEMS ingredients.
+
+        Returns {'ingredient_ids': [...]} in the order given. On a 400, 'index' points at
+        the ingredient that was rejected.
+    """
+    json: dict = request.json
+    recipe_id = json.get('recipe_id')
+    ingredients = json.get('ingredients')
+    if not isinstance(recipe_id, int):
+        return {'error': 'recipe_id must be an integer'}, 400
+    if not isinstance(ingredients, list) or not ingredients:
+        return {'error': 'ingredients must be a non-empty list'}, 400
+    if len(ingredients) > current_app.config['BULK_MAX_ITEMS']:
+        return {'error': f"at most {current_app.config['BULK_MAX_ITEMS']} ingredients per request"}, 400
+    ret = UnitCache.load()
+    if ret[0] != 0:
+        return ret[1], 500
+    for index, ingredient in enumerate(ingredients):
+        ret = validate_ingredient(ingredient)
+        if ret[0] != 0:
+            return {'error': ret[1]['error'], 'index': index}, 400
+    ret = DBInterface.new_ingredients(session['user_id'], recipe_id, ingredients)
+    if ret[0] != 0:
+        logger.info('error adding ingredients: %s', ret[1], extra={'user_id': session['user_id']})
+        return ret[1], 400
+    return ret[1], 200
+
+
 @bp.route('/delete_ingredient', methods=('POST',))
 @login_required
 def delete_ingredient():
@@ -95,42 +154,30 @@ def order_recipes():
         productId values.
 
         We would pull the productId serving information from the DB, then
-    :return:
+    :return: {'rounded_values': {...}, 'results': [{'upc', 'quantity', 'added', 'error'?}, ...]}
+        with one result per cart item (see Communicator.add_to_cart). 500 only if no item
+        made it into the cart.
     """
     # Normalizing product quantities across selected recipes
     json: dict = request.json
     ret = normalize_products_from_recipes(json['selected_recipes'])
     if ret[0] != 0:
         return ret[1], 500
-    order_tally: dict = ret[1]['order_tally']
     # Determining total containers count for each product
-    productIds = list(order_tally.keys())
+    productIds: list = ret[1]['product_ids']
+    quantities = ret[1]['quantities']
     ret = DBInterface.get_specific_prods(session['user_id'], productIds)
     if ret[0] != 0:
         return ret[1], 500
     products_dict = ret[1]['products_dict']
     # Conducting final tally (# of containers (e.g. servings per container) needed for each productId)
-    final_tally: dict = {}
-    rounded_values: dict = {}  # Keyed on productId
-    for prod_id in productIds:
-        final_tally[prod_id] = order_tally[prod_id] / products_dict[prod_id]['total_container_quantity']
-        # Handling rounding
-        floored: int = floor(final_tally[prod_id])
-        diff: float = final_tally[prod_id] - floored
-        if diff > ROUNDING_THRESHOLD:
-            # Rounding to next whole number
-            rounded_values[prod_id] = {
-                'product_description': products_dict[prod_id]['description'],
-                'original_value': final_tally[prod_id],
-            }
-            intermediate_rounding = final_tally[prod_id] + 1
-            final_tally[prod_id] = floor(intermediate_rounding)
-            rounded_values[prod_id]['rounded_value'] = final_tally[prod_id]
+    ret = containers_needed(productIds, quantities, products_dict, ROUNDING_THRESHOLD)
+    if ret[0] != 0:
+        return ret[1], 500
+    final_tally: dict = ret[1]['final_tally']
+    rounded_values: dict = ret[1]['rounded_values']  # Keyed on productId
     # Should have a complete final_tally dictionary {<productId>: <integer>, ...}
-    print(f'Here is the final_tally dict: {final_tally}')
-    list_ft = list(final_tally)
-    print(f'Here is the final_tally in list form: {list_ft}')
-    print(f'Here is the rounded_values dict: {rounded_values}')
+    logger.debug('final tally %s, rounded %s', final_tally, rounded_values, extra={'user_id': session['user_id']})
     # Transforming into a list of dicts before sending off to Kroger
     order_list: list = []
     for productId in final_tally:
@@ -141,50 +188,51 @@ def order_recipes():
         order_list.append(tmp_dict)
     ret = Communicator.add_to_cart(order_list)
     if ret[0] != 0:
-        return ret, 500
-    return {'rounded_values': rounded_values}, 200
+        return ret[1], 500
+    if ret[1]['failed']:
+        logger.info('%d of %d cart items failed', ret[1]['failed'], len(order_list),
+                    extra={'user_id': session['user_id']})
+    response: dict = {'rounded_values': rounded_values, 'results': ret[1]['results']}
+    if order_list and not ret[1]['added']:
+        return dict(response, error='no items could be added to the cart'), 500
+    return response, 200
+
+
+def validate_ingredient(ingredient: dict) -> Tuple[int, dict]:
+    """ Checks the fields of a new ingredient. UnitCache.load() must have been called first. """
+    if not isinstance(ingredient, dict):
+        return -1, {'error': 'ingredient must be an object'}
+    for key in ('productId', 'ingredient_name', 'ingredient_unit', 'product_description'):
+        if not isinstance(ingredient.get(key), str):
+            return -1, {'error': f'{key} missing'}
+    try:
+        quantity = float(ingredient.get('ingredient_quantity'))
+    except (TypeError, ValueError):
+        return -1, {'error': 'ingredient_quantity must be a number'}
+    if quantity <= 0:
+        return -1, {'error': 'ingredient_quantity must be positive'}
+    if UnitCache.unit_type(ingredient['ingredient_unit']) is None:
+        return -1, {'error': f"{ingredient['ingredient_unit']} is not a recognized weight/measure"}
+    return 0, {}
 
 
 def normalize_products_from_recipes(recipes: list) -> Tuple[int, dict]:
     """
         Returns a dictionary with {<productId>: <normalized quantity>, ... }
-        Normalized to gram/ml
+        Normalized to gram/ml. Also returns the same totals as 'product_ids' and the
+        aligned 'quantities' array for quantities.containers_needed.
     :return:
     """
-    ret = DBInterface.get_unit_translations()
+    ret = UnitCache.load()
     if ret[0] != 0:
         return ret
-    conversion_dict = ret[1]['conversion_dict']
-    ret = DBInterface.get_units()
+    # Normalizing per recipe
+    ret = encode_ingredients(recipes)
     if ret[0] != 0:
         return ret
-    unit_dict = ret[1]['unit_dict']  # {'weight': ['gram', 'lb', ...], 'volume': ['cup', ..]}
-    # Normalizing per recipe
-    tally: dict = {}
-    print(recipes)
-    for recipe in recipes:
-        ingredients: dict = recipe['ingredients']
-        for ing_id in ingredients:
-            ingredient = ingredients[ing_id]
-            productId = ingredient['productId']
-            unit = ingredient['ingredient_unit']
-            quantity = ingredient['ingredient_quantity']
-            print(f'conversion_dict: {conversion_dict}')
-            if ingredient['ingredient_unit'] in unit_dict['weight']:
-                normalized_quantity = float(conversion_dict[unit]['gram']) * float(quantity)
-            elif ingredient['ingredient_unit'] in unit_dict['volume']:
-                normalized_quantity = float(conversion_dict[unit]['ml']) * float(quantity)
-            else:
-                return -1, {'error': f'unit type of ingredient {ingredient} in recipe {recipe} is invalid'}
-            if productId in tally:
-                tally[productId] += normalized_quantity
-            else:
-                tally[productId] = normalized_quantity
-    # normalizing across all recipes
-    order_tally: dict = {}
-    for productId in tally:
-        if productId in order_tally:
-            order_tally[productId] += tally[productId]
-        else:
-            order_tally[productId] = tally[productId]
-    return 0, {'order_tally': tally}
+    encoded: dict = ret[1]
+    quantities = tally_products(encoded)
+    order_tally: dict = dict(zip(encoded['product_ids'], quantities.tolist()))
+    return 0, {'order_tally': order_tally,
+               'product_ids': encoded['product_ids'],
+               'quantities': quantities}
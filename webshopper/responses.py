@@ -0,0 +1,132 @@
+import gzip
+import io
+import time
+import zlib
+
+from flask import Response, current_app, request
+from flask.json.provider import DefaultJSONProvider
+
+from webshopper.metrics import Metrics
+
+try:
+    import orjson
+except ImportError:  # Optional. The stdlib encoder is used without it.
+    orjson = None
+
+# Compressing these is worthwhile; images and the like are already compressed
+COMPRESSIBLE_MIMETYPES = ('application/json', 'text/plain', 'text/html')
+
+
+class TimedDumps:
+    """ Records encode time and size of every dumps() while metrics are enabled """
+
+    def dumps(self, obj, **kwargs) -> str:
+        if not Metrics.enabled:
+            return self.encode(obj, **kwargs)
+        start: float = time.perf_counter()
+        encoded: str = self.encode(obj, **kwargs)
+        Metrics.observe('webshopper_json_encode_duration_seconds', (), time.perf_counter() - start)
+        Metrics.inc('webshopper_json_encoded_bytes_total', (), len(encoded))
+        return encoded
+
+
+class StdlibJSONProvider(TimedDumps, DefaultJSONProvider):
+    """ Flask's default provider, timed """
+
+    def encode(self, obj, **kwargs) -> str:
+        return DefaultJSONProvider.dumps(self, obj, **kwargs)
+
+
+class OrjsonProvider(TimedDumps, DefaultJSONProvider):
+    """
+        Flask JSON provider backed by orjson. Serializes the same payloads as the default
+        provider (int dict keys such as recipe ids included) but does not sort keys, which
+        is much of the cost for large libraries. Anything orjson does not know goes through
+        DefaultJSONProvider.default, e.g. dates and dataclasses.
+    """
+    options: int = 0 if orjson is None else orjson.OPT_NON_STR_KEYS
+
+    def encode(self, obj, **kwargs) -> str:
+        if kwargs:
+            # Callers asking for stdlib options (indent, sort_keys, ...) get the stdlib encoder
+            return DefaultJSONProvider.dumps(self, obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return DefaultJSONProvider.loads(self, s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs) -> Response:
+        """ DefaultJSONProvider.response always passes formatting options, which orjson has no use for """
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(f'{self.dumps(obj)}\n', mimetype=self.mimetype)
+
+
+Metrics.describe('webshopper_json_encode_duration_seconds', 'histogram',
+                 'Time spent serializing JSON responses')
+Metrics.describe('webshopper_json_encoded_bytes_total', 'counter',
+                 'Bytes of JSON produced, before compression')
+Metrics.describe('webshopper_http_response_bytes_total', 'counter',
+                 'Response body bytes sent, after compression, by endpoint and content encoding')
+
+
+def gzip_bytes(data: bytes, level: int) -> bytes:
+    """ gzip.compress with mtime 0, so identical bodies compress identically.
+        gzip.compress only takes mtime from Python 3.8.
+    """
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buffer.getvalue()
+
+
+def compress_response(response: Response) -> Response:
+    """
+        after_request hook. gzip or deflate, whichever the client prefers, for buffered
+        responses of at least COMPRESS_MIN_SIZE bytes. Streamed responses (e.g. the NDJSON
+        product search) go out as they are. Also counts bytes on the wire for /metrics.
+    """
+    encoding: str = 'identity'
+    if (current_app.config['COMPRESS_ENABLED']
+            and response.status_code == 200
+            and not response.is_streamed
+            and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers
+            and response.mimetype in COMPRESSIBLE_MIMETYPES):
+        response.vary.add('Accept-Encoding')
+        data: bytes = response.get_data()
+        if len(data) >= current_app.config['COMPRESS_MIN_SIZE']:
+            accepted = request.accept_encodings.best_match(('gzip', 'deflate'))
+            level: int = current_app.config['COMPRESS_LEVEL']
+            if accepted == 'gzip':
+                data = gzip_bytes(data, level)
+            elif accepted == 'deflate':
+                data = zlib.compress(data, level)
+            if accepted is not None:
+                encoding = accepted
+                response.set_data(data)
+                response.headers['Content-Encoding'] = encoding
+                # The compressed bytes differ from the identity ones, so a strong ETag would lie
+                etag, weak = response.get_etag()
+                if etag is not None and not weak:
+                    response.set_etag(etag, weak=True)
+    if Metrics.enabled and not response.is_streamed:
+        Metrics.inc('webshopper_http_response_bytes_total',
+                    (('endpoint', request.endpoint or 'unmatched'), ('encoding', encoding)),
+                    response.content_length or 0)
+    return response
+
+
+def init_app(app):
+    """ Picks the JSON provider (JSON_PROVIDER: 'auto', 'orjson' or 'stdlib') and registers
+        response compression.
+    """
+    choice: str = app.config['JSON_PROVIDER']
+    if choice == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_PROVIDER is 'orjson' but orjson is not installed")
+    if choice == 'orjson' or (choice == 'auto' and orjson is not None):
+        app.json = OrjsonProvider(app)
+    else:
+        app.json = StdlibJSONProvider(app)
+    app.after_request(compress_response)
@@ -1,3 +1,7 @@
+DROP TABLE IF EXISTS sessions;
+DROP TABLE IF EXISTS change_log;
+DROP TABLE IF EXISTS location_cache;
+DROP TABLE IF EXISTS reference_version;
 DROP TABLE IF EXISTS units;
 DROP TABLE IF EXISTS unit_translations;
 DROP TABLE IF EXISTS ingredients;
@@ -74,6 +78,12 @@ CREATE TABLE ingredients (
 
 );
 
+CREATE TABLE location_cache (
+    zipcode TEXT PRIMARY KEY,
+    stores TEXT NOT NULL,       -- JSON list of trimmed stores [{'locationId', 'chain', 'addressLine1'}, ...]
+    fetched_at FLOAT NOT NULL   -- unix timestamp of the Kroger lookup
+);
+
 CREATE TABLE unit_translations (
     from_unit TEXT NOT NULL,
     from_value INTEGER CHECK (from_value IN (1)) DEFAULT 1,  -- This column should always have a value of 1
@@ -87,6 +97,26 @@ CREATE TABLE units (
     unit_type TEXT CHECK(unit_type IN ('weight', 'volume'))
 );
 
+-- Single row. Bumped by the triggers below whenever units or unit_translations change
+-- so that UnitCache knows to reload. Seeded from the clock so a re-init never reuses a version.
+CREATE TABLE reference_version (
+    version INTEGER NOT NULL
+);
+insert into reference_version (version) values (CAST(strftime('%s', 'now') AS INTEGER));
+
+CREATE TRIGGER units_insert AFTER INSERT ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER units_update AFTER UPDATE ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER units_delete AFTER DELETE ON units
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER unit_translations_insert AFTER INSERT ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER unit_translations_update AFTER UPDATE ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
+CREATE TRIGGER unit_translations_delete AFTER DELETE ON unit_translations
+BEGIN UPDATE reference_version SET version = version + 1; END;
+
 
 -----  Units
 -- weight measures
@@ -0,0 +1,186 @@
+import logging
+import secrets
+import time
+from typing import Optional
+from typing import Tuple
+
+import click
+from flask.cli import with_appcontext
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from webshopper.cache import TTLCache
+from webshopper.db import DBInterface
+
+logger = logging.getLogger(__name__)
+
+# Longest sid accepted from a cookie. Ours are 22 characters; anything else is not looked up.
+MAX_SID_LENGTH = 64
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """ Session data held server-side under sid. Loaded once per request by open_session. """
+
+    def __init__(self, initial: dict = None, sid: str = None, expires_at: float = 0):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.new: bool = sid is None
+        self.sid: str = sid or ServerSession.new_sid()
+        self.expires_at: float = expires_at
+        self.rotated_from: Optional[str] = None  # sid to delete on save, see clear()
+        self.modified: bool = False
+        self.accessed: bool = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    @staticmethod
+    def new_sid() -> str:
+        return secrets.token_urlsafe(16)
+
+    def clear(self):
+        """ Also moves the session to a new sid, so that logging in (which clears the session
+            first) never keeps an id that existed before authentication.
+        """
+        super().clear()
+        if not self.new and self.rotated_from is None:
+            self.rotated_from = self.sid
+            self.sid = ServerSession.new_sid()
+            self.new = True
+
+
+class MemorySessionStore:
+    """ LRU of the SESSION_MEMORY_SIZE most recently saved sessions. Per process, so only for
+        single-worker deployments; use 'sqlite' with more than one worker.
+    """
+
+    def __init__(self, maxsize: int, lifetime: float):
+        self._cache: TTLCache = TTLCache(maxsize, lifetime)
+
+    def load(self, sid: str) -> Tuple[int, dict]:
+        state, entry = self._cache.get(sid)
+        if state == 'miss':
+            return 0, {'data': None}
+        return 0, {'data': dict(entry[0]), 'expires_at': entry[1]}
+
+    def save(self, sid: str, data: dict, expires_at: float) -> Tuple[int, dict]:
+        self._cache.set(sid, (data, expires_at))
+        return 0, {}
+
+    def delete(self, sid: str) -> Tuple[int, dict]:
+        self._cache.delete(sid)
+        return 0, {}
+
+
+class SQLiteSessionStore:
+    """ The sessions table, shared by every worker using the same DATABASE """
+
+    @staticmethod
+    def load(sid: str) -> Tuple[int, dict]:
+        return DBInterface.get_session(sid)
+
+    @staticmethod
+    def save(sid: str, data: dict, expires_at: float) -> Tuple[int, dict]:
+        return DBInterface.save_session(sid, data, expires_at)
+
+    @staticmethod
+    def delete(sid: str) -> Tuple[int, dict]:
+        return DBInterface.delete_session(sid)
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+        Keeps session data in a store and only a random session id in the cookie, which is
+        much smaller than the signed cookie holding both Kroger tokens and needs no HMAC work.
+        The store is read once per request, and only when the request has a session cookie;
+        it is written only when the session changed or has used up half of its lifetime.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request) -> ServerSession:
+        sid: str = request.cookies.get(self.get_cookie_name(app))
+        if not sid or len(sid) > MAX_SID_LENGTH:
+            return ServerSession()
+        ret = self.store.load(sid)
+        if ret[0] != 0:
+            logger.error('error loading session: %s', ret[1])
+            return ServerSession()
+        if ret[1]['data'] is None:
+            return ServerSession()
+        return ServerSession(ret[1]['data'], sid, ret[1]['expires_at'])
+
+    def save_session(self, app, session: ServerSession, response):
+        name: str = self.get_cookie_name(app)
+        cookie: dict = {'domain': self.get_cookie_domain(app),
+                        'path': self.get_cookie_path(app),
+                        'secure': self.get_cookie_secure(app),
+                        'samesite': self.get_cookie_samesite(app),
+                        'httponly': self.get_cookie_httponly(app)}
+        # SESSION_COOKIE_PARTITIONED arrived in Flask 3.0, which the Pipfile's Python 3.7 cannot run
+        if hasattr(self, 'get_cookie_partitioned'):
+            cookie['partitioned'] = self.get_cookie_partitioned(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+        if session.rotated_from is not None:
+            self.store.delete(session.rotated_from)
+        if not session:
+            if session.modified:
+                if not session.new:
+                    self.store.delete(session.sid)
+                response.delete_cookie(name, **cookie)
+                response.vary.add('Cookie')
+            return
+
+        lifetime: float = app.permanent_session_lifetime.total_seconds()
+        now: float = time.time()
+        if not (session.new or session.modified
+                or (session.permanent and app.config['SESSION_REFRESH_EACH_REQUEST']
+                    and session.expires_at - now < lifetime / 2)):
+            return
+        ret = self.store.save(session.sid, dict(session), now + lifetime)
+        if ret[0] != 0:
+            logger.error('error saving session: %s', ret[1])
+            return
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), **cookie)
+        response.vary.add('Cookie')
+
+
+@click.group('sessions')
+def sessions_command():
+    """ Manage server-side sessions (SESSION_BACKEND = 'sqlite') """
+
+
+@sessions_command.command('purge')
+@with_appcontext
+def purge_sessions_command():
+    """ Delete expired sessions """
+    ret = DBInterface.purge_sessions()
+    if ret[0] != 0:
+        raise click.ClickException(str(ret[1]))
+    click.echo(f"Purged {ret[1]['deleted']} sessions")
+
+
+def init_app(app):
+    """ SESSION_BACKEND: 'cookie' keeps Flask's signed cookie session; 'memory' and 'sqlite'
+        keep the data server-side behind a session id.
+    """
+    backend: str = app.config['SESSION_BACKEND']
+    if backend == 'memory':
+        app.session_interface = ServerSessionInterface(MemorySessionStore(
+            app.config['SESSION_MEMORY_SIZE'], app.permanent_session_lifetime.total_seconds()))
+    elif backend == 'sqlite':
+        app.session_interface = ServerSessionInterface(SQLiteSessionStore())
+    elif backend != 'cookie':
+        raise RuntimeError(f"SESSION_BACKEND must be 'cookie', 'memory' or 'sqlite', not {backend!r}")
+    app.cli.add_command(sessions_command)
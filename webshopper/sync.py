@@ -0,0 +1,67 @@
+import logging
+
+from webshopper.auth import login_required
+from webshopper.db import DBInterface
+from webshopper.etags import conditional_library
+
+from flask import Blueprint, request, session
+
+bp = Blueprint('sync', __name__, url_prefix='/sync')
+logger = logging.getLogger(__name__)
+
+
+@bp.route('', methods=('GET',))
+@login_required
+@conditional_library
+def sync():
+    """
+        Library changes since the version the client last synced to.
+        ?since=<version from the previous sync, 0 for everything>
+
+        Returns {'version': <pass as since next time>,
+                 'products': [<product>, ...],          added or edited
+                 'recipes': {<recipe_id>: <recipe>, ...},  added or edited, ingredients included
+                 'deleted_products': [<productId>, ...],
+                 'deleted_recipes': [<recipe_id>, ...]}
+        410 means the client's version is unknown here (e.g. the database was reset) and it
+        should reload the library from GET /products and GET /recipes.
+    """
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return {'error': 'since must be a non-negative integer'}, 400
+    user_id: int = session['user_id']
+    ret = DBInterface.get_library_version(user_id)
+    if ret[0] != 0:
+        return ret[1], 500
+    version: int = ret[1]['version']
+    if since > version:
+        return {'error': 'unknown version, reload the library', 'version': version}, 410
+    ret = DBInterface.get_changes(user_id, since)
+    if ret[0] != 0:
+        return ret[1], 500
+    changes: list = ret[1]['changes']
+    if changes:
+        version = max(version, changes[-1]['version'])
+    productIds: list = []
+    recipe_ids: list = []
+    deleted_products: list = []
+    deleted_recipes: list = []
+    for change in changes:
+        if change['entity'] == 'product':
+            (deleted_products if change['deleted'] else productIds).append(change['entity_id'])
+        else:
+            (deleted_recipes if change['deleted'] else recipe_ids).append(change['entity_id'])
+    ret = DBInterface.get_products_by_id(user_id, productIds)
+    if ret[0] != 0:
+        return ret[1], 500
+    products: list = ret[1]['products']
+    ret = DBInterface.get_recipes_by_id(user_id, recipe_ids)
+    if ret[0] != 0:
+        return ret[1], 500
+    recipes: dict = ret[1]['recipes']
+    logger.debug('sync from %d to %d: %d changes', since, version, len(changes), extra={'user_id': user_id})
+    return {'version': version,
+            'products': products,
+            'recipes': recipes,
+            'deleted_products': deleted_products,
+            'deleted_recipes': deleted_recipes}, 200
@@ -0,0 +1,105 @@
+import threading
+import time
+from typing import Tuple
+from typing import Optional
+from webshopper.db import DBInterface
+
+from flask import current_app
+
+
+class UnitCache:
+    """
+        Process-wide cache of the units and unit_translations tables.
+
+        The tables are loaded once per worker and only reloaded when the
+        reference_version row changes (schema.sql triggers bump it on any write),
+        which is checked at most every UNIT_CACHE_CHECK_INTERVAL seconds.
+        Call load() once per request before using the lookups.
+    """
+    _lock: threading.Lock = threading.Lock()
+    _version: Optional[int] = None  # reference_version the cached tables were built from
+    _database: Optional[str] = None  # DATABASE path the cached tables were built from
+    _checked: float = 0  # time.monotonic() of the last version check
+    _tables: dict = {
+        'conversion_dict': {},  # {<from_unit>: {<to_unit>: <to_value>, ...}, ...} as in get_unit_translations
+        'unit_dict': {'weight': [], 'volume': []},  # as in get_units
+        'unit_types': {},  # {<unit>: <'weight', 'volume'>}
+        'factors': {},  # {(<from_unit>, <to_unit>): <float>}
+        'base_factors': {}  # {<unit>: <float>} multiplier to gram (weight) or ml (volume)
+    }
+
+    @staticmethod
+    def load() -> Tuple[int, dict]:
+        """ Makes sure the cached tables are current and returns them """
+        now: float = time.monotonic()
+        database: str = current_app.config['DATABASE']
+        if (UnitCache._version is not None
+                and UnitCache._database == database
+                and now - UnitCache._checked < current_app.config['UNIT_CACHE_CHECK_INTERVAL']):
+            return 0, UnitCache._tables
+        with UnitCache._lock:
+            ret = DBInterface.get_reference_version()
+            if ret[0] != 0:
+                return ret
+            version: int = ret[1]['version']
+            if version != UnitCache._version or database != UnitCache._database:
+                ret = UnitCache._build()
+                if ret[0] != 0:
+                    return ret
+                UnitCache._tables = ret[1]
+                UnitCache._version = version
+                UnitCache._database = database
+            UnitCache._checked = now
+        return 0, UnitCache._tables
+
+    @staticmethod
+    def invalidate():
+        """ Forces a reload on the next load(). Called by init-db """
+        with UnitCache._lock:
+            UnitCache._version = None
+
+    @staticmethod
+    def unit_type(unit: str) -> Optional[str]:
+        """ 'weight', 'volume' or None if the unit is not recognized """
+        return UnitCache._tables['unit_types'].get(unit)
+
+    @staticmethod
+    def factor(from_unit: str, to_unit: str) -> float:
+        """ Multiplier converting one from_unit into to_unit. Raises KeyError for unknown pairs """
+        return UnitCache._tables['factors'][(from_unit, to_unit)]
+
+    @staticmethod
+    def base_factor(unit: str) -> Optional[float]:
+        """ Multiplier normalizing the unit to gram or ml. None if the unit is not recognized """
+        return UnitCache._tables['base_factors'].get(unit)
+
+    @staticmethod
+    def _build() -> Tuple[int, dict]:
+        """ Reads both tables and derives the flat lookup dictionaries """
+        ret = DBInterface.get_unit_translations()
+        if ret[0] != 0:
+            return ret
+        conversion_dict: dict = ret[1]['conversion_dict']
+        ret = DBInterface.get_units()
+        if ret[0] != 0:
+            return ret
+        unit_dict: dict = ret[1]['unit_dict']
+        # Weight is checked before volume everywhere else, so it wins any overlap
+        unit_types: dict = {unit: 'volume' for unit in unit_dict['volume']}
+        unit_types.update({unit: 'weight' for unit in unit_dict['weight']})
+        factors: dict = {}
+        for unit_from in conversion_dict:
+            for unit_to in conversion_dict[unit_from]:
+                factors[(unit_from, unit_to)] = float(conversion_dict[unit_from][unit_to])
+        base_factors: dict = {}
+        for unit, unit_type in unit_types.items():
+            base_unit: str = 'gram' if unit_type == 'weight' else 'ml'
+            if (unit, base_unit) in factors:
+                base_factors[unit] = factors[(unit, base_unit)]
+        return 0, {
+            'conversion_dict': conversion_dict,
+            'unit_dict': unit_dict,
+            'unit_types': unit_types,
+            'factors': factors,
+            'base_factors': base_factors
+        }